@@ -1,2 +1,7 @@
 from .analysis import *
 from .dimension_reduction import *
+from .clustering import *
+from .streaming import *
+from .regression import *
+from .noise_ceiling import *
+from .encoding import *
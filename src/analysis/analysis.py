@@ -3,10 +3,11 @@ import numpy as np
 from typing import Union, List, Callable, Tuple
 import torch
 from tqdm import tqdm
-from scipy.stats import pearsonr, spearmanr
+from scipy.spatial.distance import pdist
+from scipy.stats import pearsonr, spearmanr, rankdata
 from transformers import AutoTokenizer, AutoModel
-from src.utils.utils import normalize_data
-from sklearn.cluster import KMeans
+from src.utils.profiling import stage
+from src.analysis.clustering import compute_kmeans_sweep
 from pyxdameraulevenshtein import (
     damerau_levenshtein_distance,
     normalized_damerau_levenshtein_distance
@@ -73,13 +74,36 @@ def get_model_representations(inputs: Union[List[str], List[dict], torch.tensor]
         return np.stack(hiddens)
 
 
+def get_model_layers_representations(inputs: Union[List[str], List[dict], torch.tensor],
+                                     model: Callable,
+                                     layers: List[int],
+                                     tokenizer: Callable = None) -> dict:
+    """
+    Same as get_model_representations, for several layers with a single forward pass per input.
+
+    :return: {layer: representations of shape (n_inputs, hidden_size)}
+    """
+    model.eval()
+    hiddens = {layer: [] for layer in layers}
+
+    if isinstance(inputs[0], str):
+        inputs = [tokenizer(w, padding=True, return_tensors="pt") for w in inputs]
+
+    with torch.no_grad():
+        for i in tqdm(range(len(inputs))):
+            outputs = model(**inputs[i], output_hidden_states=True)
+            for layer in layers:
+                hidden_states = outputs.last_hidden_state if layer == -1 else outputs.hidden_states[layer]
+                hiddens[layer].append(hidden_states[:, 0].cpu().numpy())
+        return {layer: np.concatenate(hidden) for layer, hidden in hiddens.items()}
+
+
 def compute_kmeans_labels(features: np.array,
                           n_clusters: int,
-                          mode: str = "normal") -> np.array:
-    features = normalize_data(features, mode=mode)
-
-    kmeans = KMeans(n_clusters=n_clusters).fit(features)
-    return kmeans.labels_
+                          mode: str = "normal",
+                          **sweep_args) -> np.array:
+    # Single point of the (cached) k-sweep, see src.analysis.clustering
+    return compute_kmeans_sweep(features, [n_clusters], mode=mode, **sweep_args)["labels"][n_clusters]
 
 
 def all_pairs(elements):
@@ -129,6 +153,153 @@ def compute_all_representations_distances(features,
     return distances
 
 
+def compute_rdm(features: np.array,
+                norm: str = "l2",
+                normalize: bool = True) -> np.array:
+    """
+    Vectorized equivalent of compute_all_representations_distances over all the pairs (all_pairs(range(n))).
+
+    :param features: features of shape (n_samples, n_dims)
+    :param norm: "cosine" (cosine similarity, as in compute_all_representations_distances) or "l2"
+    :param normalize: l2 only, compute the distances between the l2-normalized features
+    :return: the condensed matrix of shape (n_samples * (n_samples - 1) / 2,), in the order of all_pairs
+    """
+    features = np.asarray(features, dtype=np.float64).reshape(len(features), -1)
+    if norm == "cosine":
+        return 1. - pdist(features, metric="cosine")
+    if normalize:
+        features = features / np.linalg.norm(features, axis=1, keepdims=True)
+    return pdist(features, metric="euclidean")
+
+
+def _standardize(values: np.array) -> np.array:
+    values = values - values.mean(axis=-1, keepdims=True)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return values / np.linalg.norm(values, axis=-1, keepdims=True)
+
+
+def standardize_rdms(rdms: np.array) -> Tuple[np.array, np.array]:
+    """
+
+    :param rdms: condensed matrices of shape (..., n_pairs)
+    :return: the centered unit-norm matrices and ranks (Pearson / Spearman correlations are then dot products)
+    """
+    return _standardize(rdms), _standardize(rankdata(rdms, axis=-1))
+
+
+def correlate_rdms(word_rdm: np.array, eeg_rdms: np.array,
+                   standardized: Tuple[np.array, np.array] = None) -> Tuple[np.array, np.array]:
+    """
+    Vectorized pearsonr / spearmanr between a word RDM and a stack of EEG RDMs.
+
+    :param word_rdm: condensed matrix of shape (n_pairs,)
+    :param eeg_rdms: condensed matrices of shape (..., n_pairs)
+    :param standardized: standardize_rdms(eeg_rdms), if already computed (it can be shared by several word RDMs)
+    :return: the Pearson and Spearman correlations between word_rdm and each of the eeg_rdms, of shape (...)
+    """
+    eeg_z, eeg_rank_z = standardize_rdms(eeg_rdms) if standardized is None else standardized
+    word_z, word_rank_z = standardize_rdms(np.asarray(word_rdm, dtype=np.float64))
+    return eeg_z @ word_z, eeg_rank_z @ word_rank_z
+
+
+def compute_window_eeg_rdms(eegs: np.array,
+                            timesteps: int = 31,
+                            pad_step: int = 10,
+                            norms: Tuple[str, ...] = ("cosine", "l2")) -> dict:
+    """
+
+    :param eegs: EEG signals of shape (n_words, n_channels, n_timesteps)
+    :return: {"starts": window starts, "cosine": array, "l2": array}, the RDMs of each time window and channel
+             (same windows as compute_correlations), of shape (n_windows, n_channels, n_pairs)
+    """
+    starts = list(range(0, eegs.shape[-1] - timesteps + 1, pad_step))
+    rdms = {"starts": starts}
+    for norm in norms:
+        rdms[norm] = np.stack([np.stack([compute_rdm(eegs[:, chan_id, start:start + timesteps], norm=norm)
+                                         for chan_id in range(eegs.shape[1])]) for start in starts])
+    return rdms
+
+
+def compute_temporal_generalization(eegs: np.array,
+                                    timesteps: int = 31,
+                                    pad_step: int = 10,
+                                    norm: str = "cosine",
+                                    dtype: type = np.float64) -> dict:
+    """
+    Correlations between the EEG RDMs of every pair of time windows (t, t'), channel by channel. The RDMs of all the
+    windows of a channel are computed, standardized and ranked once: the n_windows x n_windows Pearson (Spearman)
+    correlations are then the Gram matrix of the standardized RDMs (ranks).
+
+    :param eegs: EEG signals of shape (n_words, n_channels, n_timesteps)
+    :param norm: distance of the EEG RDMs, "cosine" or "l2"
+    :param dtype: precision of the standardized RDMs and of the products (np.float32 halves the memory)
+    :return: {"starts": window starts, "pearson": array, "spearman": array}, of shape
+             (n_channels, n_windows, n_windows)
+    """
+    starts = list(range(0, eegs.shape[-1] - timesteps + 1, pad_step))
+    n_channels = eegs.shape[1]
+    generalization = {"starts": starts}
+    for method in ["pearson", "spearman"]:
+        generalization[method] = np.empty((n_channels, len(starts), len(starts)), dtype=dtype)
+
+    for chan_id in range(n_channels):
+        rdms = np.stack([compute_rdm(eegs[:, chan_id, start:start + timesteps], norm=norm) for start in starts])
+        rdms_z, rdms_rank_z = (values.astype(dtype, copy=False) for values in standardize_rdms(rdms))
+        generalization["pearson"][chan_id] = rdms_z @ rdms_z.T
+        generalization["spearman"][chan_id] = rdms_rank_z @ rdms_rank_z.T
+    return generalization
+
+
+def get_distance_pairs(word_rdms: dict) -> List[tuple]:
+    """
+
+    :param word_rdms: {"cosine": rdm, "l2": rdm} (representations) or {"levenshtein": rdm}
+    :return: the (distance name, word rdm, EEG norm) correlated in the tables
+    """
+    if "levenshtein" in word_rdms:
+        return [("levenshtein-l2", word_rdms["levenshtein"], "l2"),
+                ("levenshtein-cosine", word_rdms["levenshtein"], "cosine")]
+    return [("cosine", word_rdms["cosine"], "cosine"), ("l2", word_rdms["l2"], "l2")]
+
+
+def correlate_window_rdms(eeg_rdms: dict,
+                          word_rdms: dict,
+                          list_electrodes: List[str],
+                          timesteps: int = 31,
+                          standardized: dict = None,
+                          regressions: dict = None) -> List[dict]:
+    """
+
+    :param eeg_rdms: output of compute_window_eeg_rdms (only "starts" is needed when standardized is given)
+    :param word_rdms: {"cosine": rdm, "l2": rdm} (representations) or {"levenshtein": rdm}
+    :param standardized: {norm: [standardize_rdms(window rdms) for each window]}, if already computed
+    :param regressions: {distance: ConfoundRegression} (see analysis.regression.build_confound_regressions), adds the
+                        partial correlations and the multiple regression columns to the rows
+    :return: the rows of the correlations table (same rows as compute_correlations)
+    """
+    pairs = get_distance_pairs(word_rdms)
+    regressions = regressions or {}
+
+    rows = []
+    for window_id, start in enumerate(eeg_rdms["starts"]):
+        correlations = []
+        for distance, word_rdm, norm in pairs:
+            window_standardized = standardize_rdms(eeg_rdms[norm][window_id]) if standardized is None \
+                else standardized[norm][window_id]
+            extra_columns = regressions[distance](window_standardized) if distance in regressions else {}
+            correlations.append((distance, *correlate_rdms(word_rdm, None, window_standardized), extra_columns))
+        for chan_id, channel in enumerate(list_electrodes):
+            for distance, pearson, spearman, extra_columns in correlations:
+                rows.append({"Channel": f"Channel {channel} ",
+                             "distance": distance,
+                             "truncate_start": start,
+                             "truncate_end": start + timesteps - 1,
+                             "pearson": pearson[chan_id],
+                             "spearman": spearman[chan_id],
+                             **{column: values[chan_id] for column, values in extra_columns.items()}})
+    return rows
+
+
 def compute_correlations(eegs,
                          cosine_word_distances,
                          l2_word_distances,
@@ -166,43 +337,47 @@ def compute_correlations(eegs,
                         "spearman": None}
 
             # reshaped_eegs = reegs.mean(1)
-            cosine_distances = compute_all_representations_distances(reshaped_eegs, list_paired_indices, norm="cosine")
-            l2_distances = compute_all_representations_distances(reshaped_eegs, list_paired_indices)
-
-            if cosine_word_distances is not None:
-                pears_cos, _ = pearsonr(cosine_word_distances, cosine_distances)
-                spear_cos, _ = spearmanr(cosine_word_distances, cosine_distances)
-
-                row_dict["distance"] = "cosine"
-                row_dict["pearson"] = pears_cos
-                row_dict["spearman"] = spear_cos
-                corr_table.update_table(row_dict)
-
-            if l2_word_distances is not None:
-                pears_l2, _ = pearsonr(l2_word_distances, l2_distances)
-                spear_l2, _ = spearmanr(l2_word_distances, l2_distances)
-
-                row_dict["distance"] = "l2"
-                row_dict["pearson"] = pears_l2
-                row_dict["spearman"] = spear_l2
-                corr_table.update_table(row_dict)
-
-            if dl_distances is not None:
-                pears_dl, _ = pearsonr(dl_distances, l2_distances)
-                spear_dl, _ = spearmanr(dl_distances, l2_distances)
-
-                row_dict["distance"] = "levenshtein-l2"
-                row_dict["pearson"] = pears_dl
-                row_dict["spearman"] = spear_dl
-                corr_table.update_table(row_dict)
-
-                pears_dl_cos, _ = pearsonr(dl_distances, cosine_distances)
-                spear_dl_cos, _ = spearmanr(dl_distances, cosine_distances)
-
-                row_dict["distance"] = "levenshtein-cosine"
-                row_dict["pearson"] = pears_dl_cos
-                row_dict["spearman"] = spear_dl_cos
-
-                corr_table.update_table(row_dict)
-
-            corr_table.save_table()
+            with stage("eeg_distances"):
+                cosine_distances = compute_all_representations_distances(reshaped_eegs, list_paired_indices,
+                                                                         norm="cosine")
+                l2_distances = compute_all_representations_distances(reshaped_eegs, list_paired_indices)
+
+            with stage("correlations"):
+                if cosine_word_distances is not None:
+                    pears_cos, _ = pearsonr(cosine_word_distances, cosine_distances)
+                    spear_cos, _ = spearmanr(cosine_word_distances, cosine_distances)
+
+                    row_dict["distance"] = "cosine"
+                    row_dict["pearson"] = pears_cos
+                    row_dict["spearman"] = spear_cos
+                    corr_table.update_table(row_dict)
+
+                if l2_word_distances is not None:
+                    pears_l2, _ = pearsonr(l2_word_distances, l2_distances)
+                    spear_l2, _ = spearmanr(l2_word_distances, l2_distances)
+
+                    row_dict["distance"] = "l2"
+                    row_dict["pearson"] = pears_l2
+                    row_dict["spearman"] = spear_l2
+                    corr_table.update_table(row_dict)
+
+                if dl_distances is not None:
+                    pears_dl, _ = pearsonr(dl_distances, l2_distances)
+                    spear_dl, _ = spearmanr(dl_distances, l2_distances)
+
+                    row_dict["distance"] = "levenshtein-l2"
+                    row_dict["pearson"] = pears_dl
+                    row_dict["spearman"] = spear_dl
+                    corr_table.update_table(row_dict)
+
+                    pears_dl_cos, _ = pearsonr(dl_distances, cosine_distances)
+                    spear_dl_cos, _ = spearmanr(dl_distances, cosine_distances)
+
+                    row_dict["distance"] = "levenshtein-cosine"
+                    row_dict["pearson"] = pears_dl_cos
+                    row_dict["spearman"] = spear_dl_cos
+
+                    corr_table.update_table(row_dict)
+
+            with stage("save_table"):
+                corr_table.save_table()
@@ -0,0 +1,92 @@
+from typing import Dict, List, Optional, Sequence, Union
+import numpy as np
+from joblib import Parallel, cpu_count, delayed
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from sklearn.metrics import silhouette_score
+from src.utils.utils import normalize_data, hash_content
+
+# Clusterings already computed in this process, keyed by (normalized features hash, k, params)
+_CLUSTERINGS = {}
+
+
+def _next_centers(features: np.array, centers: np.array, labels: np.array) -> np.array:
+    """ Warm start of k + 1 clusters: the k previous centers + the point the farthest from its center """
+    distances = ((features - centers[labels]) ** 2).sum(axis=1)
+    return np.concatenate([centers, features[np.argmax(distances)][None]])
+
+
+def _fit_k_chunk(features: np.array,
+                 sample_ids: np.array,
+                 k_values: List[int],
+                 use_minibatch: bool,
+                 batch_size: int,
+                 random_state: Optional[int]) -> List[dict]:
+    """ Fits consecutive values of k, each fit being initialized with the centers of the previous one """
+    results, centers, labels = [], None, None
+    sample = features[sample_ids]
+    for k in k_values:
+        if centers is not None and len(centers) == k - 1:
+            init, n_init = _next_centers(features, centers, labels), 1
+        else:
+            init, n_init = "k-means++", 3
+        if use_minibatch:
+            model = MiniBatchKMeans(n_clusters=k, init=init, n_init=n_init, batch_size=batch_size,
+                                    random_state=random_state)
+        else:
+            model = KMeans(n_clusters=k, init=init, n_init=n_init, random_state=random_state)
+        model.fit(features)
+        centers, labels = model.cluster_centers_, model.labels_
+
+        # Curves are computed on the same subset for every k
+        sample_labels = labels[sample_ids]
+        inertia = float(((sample - centers[sample_labels]) ** 2).sum())
+        silhouette = float(silhouette_score(sample, sample_labels)) if 1 < k < len(sample) \
+            and len(np.unique(sample_labels)) > 1 else np.nan
+        results.append({"k": k, "labels": labels, "inertia": inertia, "silhouette": silhouette})
+    return results
+
+
+def compute_kmeans_sweep(features: np.array,
+                         k_range: Union[Sequence[int], range],
+                         mode: str = "normal",
+                         minibatch_threshold: int = 10000,
+                         batch_size: int = 1024,
+                         sample_size: int = 5000,
+                         n_jobs: int = -1,
+                         random_state: Optional[int] = 0) -> Dict[str, Union[np.array, dict]]:
+    """
+
+    :param features: features of shape (n_samples, n_dims), normalized once (see normalize_data)
+    :param k_range: numbers of clusters to try
+    :param minibatch_threshold: MiniBatchKMeans is used above this number of samples
+    :param sample_size: number of samples on which the inertia and silhouette curves are computed
+    :param n_jobs: the k range is split into n_jobs chunks of consecutive k fitted in parallel (joblib),
+                   with warm starts inside each chunk
+    :return: {"k": array of k, "labels": {k: labels}, "inertia": array, "silhouette": array}.
+             Each clustering is cached by (features, k, params)
+    """
+    features = np.asarray(normalize_data(np.asarray(features), mode=mode), dtype=np.float32)
+    use_minibatch = len(features) > minibatch_threshold
+    rng = np.random.default_rng(random_state)
+    sample_ids = np.sort(rng.choice(len(features), min(sample_size, len(features)), replace=False))
+    features_key = hash_content(features, use_minibatch, batch_size, sample_ids, random_state)
+
+    k_values = sorted(set(int(k) for k in k_range))
+    missing = [k for k in k_values if (features_key, k) not in _CLUSTERINGS]
+    if len(missing) > 0:
+        n_workers = cpu_count() if n_jobs is None or n_jobs < 0 else n_jobs
+        n_chunks = max(1, min(n_workers, len(missing)))
+        chunks = [list(chunk) for chunk in np.array_split(missing, n_chunks) if len(chunk) > 0]
+        # A single chunk (e.g. compute_kmeans_labels) is fitted in process
+        list_results = Parallel(n_jobs=len(chunks))(
+            delayed(_fit_k_chunk)(features, sample_ids, chunk, use_minibatch, batch_size, random_state)
+            for chunk in chunks)
+        for results in list_results:
+            for result in results:
+                _CLUSTERINGS[(features_key, result["k"])] = result
+
+    results = [_CLUSTERINGS[(features_key, k)] for k in k_values]
+    return {"k": np.array(k_values),
+            "labels": {result["k"]: result["labels"] for result in results},
+            "inertia": np.array([result["inertia"] for result in results]),
+            "silhouette": np.array([result["silhouette"] for result in results])}
@@ -1,24 +1,84 @@
-from typing import Union
+import os
+from typing import Optional, Union
 import numpy as np
 from sklearn.manifold import TSNE
 from sklearn.decomposition import PCA
-from src.utils.utils import normalize_data
+from src.utils.utils import normalize_data, hash_content
 
+# Embeddings already computed in this process, keyed by (features hash, method, params)
+_EMBEDDINGS = {}
+
+
+def _fit_pca(data: np.array, n_components: Optional[int], random_state: Optional[int] = 0, **pca_args) -> np.array:
+    # The randomized solver only computes the leading components: much faster when n_components << dims
+    svd_solver = "randomized" if n_components is not None and n_components < 0.8 * min(data.shape) else "full"
+    pca_args = {"svd_solver": svd_solver, "random_state": random_state, **pca_args}
+    return PCA(n_components=n_components, **pca_args).fit_transform(data)
+
+
+def reduce_dimensions(data: Union[list, np.array],
+                      method: str = "tsne",
+                      n_components: Optional[int] = 2,
+                      normalize: Optional[str] = "min_max",
+                      pca_dims: Optional[int] = 50,
+                      random_state: Optional[int] = 0,
+                      cache_dir: Optional[str] = None,
+                      **method_args) -> np.array:
+    """
+
+    :param data: features of shape (n_samples, n_dims)
+    :param method: tsne or pca
+    :param n_components: dimension of the embeddings (pca only: None keeps all the components)
+    :param normalize: normalization applied before the reduction (min_max, normal or None)
+    :param pca_dims: t-SNE only, the features are first reduced to pca_dims with a randomized PCA (None to disable)
+    :param cache_dir: if given, embeddings are also cached on disk ({key}.npy) and shared between runs
+    :param method_args: other arguments of sklearn TSNE / PCA (Barnes-Hut is used by default for t-SNE)
+    :return: the embeddings of shape (n_samples, n_components). They are cached (in memory and in cache_dir)
+             by (features, method, params): re-plotting the same features is instant
+    """
+    # t-SNE runs in float32, the PCA keeps the precision of sklearn
+    data = np.asarray(data, dtype=np.float32 if method == "tsne" else np.float64)
+    key = hash_content(data, method, n_components, normalize, pca_dims, random_state, method_args)
+    if key in _EMBEDDINGS:
+        return _EMBEDDINGS[key]
+    cache_path = None if cache_dir is None else os.path.join(cache_dir, f"{method}_{key[:20]}.npy")
+    if cache_path is not None and os.path.isfile(cache_path):
+        _EMBEDDINGS[key] = np.load(cache_path)
+        return _EMBEDDINGS[key]
 
-def compute_tsne(data: Union[list, np.array],
-                 normalize: str="min_max",
-                 **tsne_args):
     if normalize is not None:
         data = normalize_data(data, mode=normalize)
-    tsne = TSNE(**tsne_args)
-    features = tsne.fit_transform(data)
+
+    if method == "pca":
+        features = _fit_pca(data, n_components, random_state=random_state, **method_args)
+    elif method == "tsne":
+        # t-SNE neighbours are computed in a low dimensional PCA space (standard pre-processing)
+        if pca_dims is not None and data.shape[1] > pca_dims and data.shape[0] > pca_dims:
+            data = _fit_pca(data, pca_dims, random_state=random_state)
+        tsne_args = {"method": "barnes_hut", "init": "pca", "n_jobs": -1, "random_state": random_state,
+                     **method_args}
+        if n_components > 3:
+            tsne_args["method"] = "exact"  # Barnes-Hut only handles 2 or 3 dimensions
+        features = TSNE(n_components=n_components, **tsne_args).fit_transform(data)
+    else:
+        raise ValueError(f"Unknown dimension reduction method {method}")
+
+    _EMBEDDINGS[key] = features
+    if cache_path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        np.save(cache_path + ".tmp.npy", features)
+        os.replace(cache_path + ".tmp.npy", cache_path)
     return features
 
+
+def compute_tsne(data: Union[list, np.array],
+                 normalize: str="min_max",
+                 **tsne_args):
+    return reduce_dimensions(data, method="tsne", normalize=normalize, **tsne_args)
+
 def compute_pca(data: Union[list, np.array],
                 normalize: str="min_max",
                 **pca_args):
-    if normalize is not None:
-        data = normalize_data(data, mode=normalize)
-    pca = PCA(**pca_args)
-    features = pca.fit_transform(data)
-    return features
+    # All the components by default, as PCA()
+    return reduce_dimensions(data, method="pca", normalize=normalize, n_components=pca_args.pop("n_components", None),
+                             **pca_args)
@@ -0,0 +1,130 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from sklearn.model_selection import KFold
+
+from src.utils.profiling import stage
+
+
+def get_cv_splits(n_samples: int, n_folds: int = 5, seed: int = 0) -> List[Tuple[np.array, np.array]]:
+    """ Shuffled (train ids, test ids) of each fold, shared by all the layers and targets """
+    return list(KFold(n_splits=n_folds, shuffle=True, random_state=seed).split(np.arange(n_samples)))
+
+
+def _ridge_fold(features: np.array,
+                targets: np.array,
+                train: np.array,
+                test: np.array,
+                alphas: np.array,
+                standardize: bool = True) -> Tuple[np.array, np.array]:
+    """
+    Ridge regressions of all the targets for all the alphas from a single SVD of the training features
+    X = U diag(s) V^T: the weights are V diag(s / (s^2 + alpha)) U^T y. The alpha of each target is selected on the
+    training words by the efficient leave-one-out errors r_i / (1 - h_ii) of the same SVD (as sklearn RidgeCV with
+    gcv_mode="svd"), the unpenalized intercept adding 1 / n_train to the leverages h_ii.
+
+    :return: the predictions of the test words of shape (n_test, n_targets), the alpha id of each target
+    """
+    x_train, y_train = features[train], targets[train]
+    x_mean, y_mean = x_train.mean(axis=0), y_train.mean(axis=0)
+    x_scale = x_train.std(axis=0) if standardize else np.ones(x_train.shape[1])
+    x_scale[x_scale == 0] = 1.
+    x_train = (x_train - x_mean) / x_scale
+    y_train = y_train - y_mean
+
+    u, s, vt = np.linalg.svd(x_train, full_matrices=False)
+    # The centering leaves (numerically) null singular values, e.g. the constant direction when there are no more
+    # training words than features: they are not part of the model
+    keep = s > s.max() * max(x_train.shape) * np.finfo(s.dtype).eps
+    u, s, vt = u[:, keep], s[keep], vt[keep]
+    uty = u.T @ y_train
+
+    loo_errors = np.empty((len(alphas), y_train.shape[1]))
+    for alpha_id, alpha in enumerate(alphas):
+        shrink = s ** 2 / (s ** 2 + alpha)
+        residuals = y_train - u @ (shrink[:, None] * uty)
+        leverages = (u ** 2) @ shrink + 1. / len(train)
+        loo_errors[alpha_id] = ((residuals / (1. - leverages)[:, None]) ** 2).sum(axis=0)
+    best = np.argmin(loo_errors, axis=0)
+
+    coefs = (s / (s ** 2 + alphas[:, None]))[best].T * uty
+    x_test = ((features[test] - x_mean) / x_scale) @ vt.T
+    return x_test @ coefs + y_mean, best
+
+
+def compute_encoding_scores(features: np.array,
+                            targets: np.array,
+                            alphas: np.array,
+                            splits: List[Tuple[np.array, np.array]],
+                            num_workers: Optional[int] = None,
+                            standardize: bool = True) -> Dict[str, np.array]:
+    """
+    Cross-validated ridge regression from the word features to every target, the folds being fitted in parallel
+    (threads: the SVD and the products release the GIL).
+
+    :param features: word features of shape (n_words, n_features)
+    :param targets: targets of shape (n_words, ...), e.g. the EEG (n_words, n_channels, n_timesteps)
+    :param alphas: regularization strengths, the best one is selected for each target and fold
+    :param splits: (train ids, test ids) of each fold, see get_cv_splits
+    :return: {"r2": held-out R^2 of the out-of-fold predictions, "alphas": alpha of each fold}, of shape (...) and
+             (n_folds, ...)
+    """
+    shape = targets.shape[1:]
+    features = np.asarray(features, dtype=np.float64).reshape(len(features), -1)
+    targets = np.asarray(targets, dtype=np.float64).reshape(len(targets), -1)
+    alphas = np.asarray(alphas, dtype=np.float64)
+
+    predictions = np.empty_like(targets)
+    fold_alphas = np.empty((len(splits), targets.shape[1]))
+    with ThreadPoolExecutor(max_workers=num_workers or len(splits)) as executor:
+        futures = [executor.submit(_ridge_fold, features, targets, train, test, alphas, standardize)
+                   for train, test in splits]
+        for fold_id, ((_, test), future) in enumerate(zip(splits, futures)):
+            predictions[test], best = future.result()
+            fold_alphas[fold_id] = alphas[best]
+
+    total = ((targets - targets.mean(axis=0)) ** 2).sum(axis=0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        r2 = 1. - ((targets - predictions) ** 2).sum(axis=0) / total
+    return {"r2": r2.reshape(shape), "alphas": fold_alphas.reshape(len(splits), *shape)}
+
+
+def compute_layer_encoding(layer_features: Dict[int, np.array],
+                           eegs: np.array,
+                           alphas: np.array,
+                           n_folds: int = 5,
+                           seed: int = 0,
+                           num_workers: Optional[int] = None,
+                           standardize: bool = True) -> dict:
+    """
+
+    :param layer_features: {layer: word features of shape (n_words, n_features)}
+    :param eegs: EEG signals of shape (n_words, n_channels, n_timesteps)
+    :return: {"layers": layers, "r2": array, "alphas": array}, the held-out R^2 of each channel and timestep of shape
+             (n_layers, n_channels, n_timesteps) and the selected alphas of shape (n_layers, n_folds, n_channels,
+             n_timesteps), the same folds being used for all the layers
+    """
+    splits = get_cv_splits(len(eegs), n_folds=n_folds, seed=seed)
+    layers = list(layer_features)
+    encoding = {"layers": layers, "r2": [], "alphas": []}
+    for layer in layers:
+        with stage("encoding"):
+            scores = compute_encoding_scores(layer_features[layer], eegs, alphas, splits,
+                                             num_workers=num_workers, standardize=standardize)
+        encoding["r2"].append(scores["r2"])
+        encoding["alphas"].append(scores["alphas"])
+    encoding["r2"], encoding["alphas"] = np.stack(encoding["r2"]), np.stack(encoding["alphas"])
+    return encoding
+
+
+def encoding_window_cube(r2: np.array, timesteps: int = 31, pad_step: int = 10) -> dict:
+    """
+
+    :param r2: held-out R^2 of shape (n_layers, n_channels, n_timesteps), see compute_layer_encoding
+    :return: {"starts": window starts, "r2": array}, the R^2 averaged over each time window (same windows as
+             compute_correlations), of shape (n_windows, n_layers, n_channels) as the correlations of
+             load_layer_correlations
+    """
+    starts = list(range(0, r2.shape[-1] - timesteps + 1, pad_step))
+    return {"starts": starts, "r2": np.stack([r2[..., start:start + timesteps].mean(axis=-1) for start in starts])}
@@ -0,0 +1,147 @@
+from typing import Callable, Iterable, List, Optional, Tuple
+
+import numpy as np
+from scipy.stats import rankdata
+
+from src.analysis.analysis import _standardize, compute_window_eeg_rdms, standardize_rdms
+from src.utils.profiling import stage
+
+NOISE_CEILING_BOUNDS = ["upper", "lower"]
+
+
+def _standardized_session_rdms(eeg: np.array, timesteps: int, pad_step: int, norm: str,
+                               dtype: type) -> Tuple[np.array, np.array]:
+    if np.isnan(eeg).any():
+        raise ValueError("The session has missing words (NaN), keep the words recorded in all the sessions")
+    with stage("eeg_distances"):
+        rdms = compute_window_eeg_rdms(eeg, timesteps=timesteps, pad_step=pad_step, norms=(norm,))[norm]
+    return tuple(values.astype(dtype, copy=False) for values in standardize_rdms(rdms))
+
+
+def compute_noise_ceiling(sessions: Callable[[], Iterable[np.array]],
+                          timesteps: int = 31,
+                          pad_step: int = 10,
+                          norms: Tuple[str, ...] = ("cosine", "l2"),
+                          dtype: type = np.float64) -> dict:
+    """
+    Noise ceiling of the EEG RDMs of each time window and channel, estimated from the sessions (Nili et al., 2014):
+        - upper bound: correlation of each session RDM with the mean RDM of all the sessions
+        - lower bound: correlation of each session RDM with the mean RDM of the other sessions (leave-one-out)
+    averaged over the sessions. The sessions are streamed twice, one in memory at a time: the first pass sums the
+    standardized RDMs (ranks), the second correlates each session with the sums. All the windows and channels of a
+    session go through the same batched operations: with the standardized RDMs z and their sum s, the Pearson bounds
+    are z.s / |s| and (z.s - 1) / |s - z|, the Spearman bounds are products with the re-ranked sums.
+
+    :param sessions: function returning a new iterator over the EEG of the sessions, each of shape
+                     (n_words, n_channels, n_timesteps), same words in all the sessions
+    :param norms: distances of the EEG RDMs, "cosine" and / or "l2"
+    :param dtype: precision of the standardized RDMs and of the products (the sums are kept in float64)
+    :return: {"starts": window starts, "n_sessions": int, "{norm}_{pearson|spearman}_{upper|lower}": array} of shape
+             (n_windows, n_channels)
+    """
+    # First pass: sums of the standardized RDMs and ranks, of shape (n_windows, n_channels, n_pairs)
+    sums, n_sessions, starts = {}, 0, None
+    for eeg in sessions():
+        n_sessions += 1
+        starts = list(range(0, eeg.shape[-1] - timesteps + 1, pad_step))
+        for norm in norms:
+            rdms_z, rdms_rank_z = _standardized_session_rdms(eeg, timesteps, pad_step, norm, dtype)
+            if norm not in sums:
+                sums[norm] = [rdms_z.astype(np.float64), rdms_rank_z.astype(np.float64)]
+            else:
+                sums[norm][0] += rdms_z
+                sums[norm][1] += rdms_rank_z
+    if n_sessions < 2:
+        raise ValueError(f"The noise ceiling needs at least 2 sessions, got {n_sessions}")
+
+    sum_norms = {norm: np.linalg.norm(sums[norm][0], axis=-1) for norm in norms}
+    mean_ranks = {norm: _standardize(rankdata(sums[norm][1], axis=-1)).astype(dtype) for norm in norms}
+    ceiling = {"starts": starts, "n_sessions": n_sessions}
+    for norm in norms:
+        for method in ["pearson", "spearman"]:
+            for bound in NOISE_CEILING_BOUNDS:
+                ceiling[f"{norm}_{method}_{bound}"] = np.zeros(sums[norm][0].shape[:2])
+
+    # Second pass: correlations of each session with the mean RDMs
+    for eeg in sessions():
+        for norm in norms:
+            rdms_z, rdms_rank_z = _standardized_session_rdms(eeg, timesteps, pad_step, norm, dtype)
+            with stage("noise_ceiling"):
+                products = np.einsum("wcp,wcp->wc", rdms_z, sums[norm][0])
+                # |s - z|^2 = |s|^2 - 2 z.s + 1 (z has a unit norm)
+                others_norm = np.sqrt(np.clip(sum_norms[norm] ** 2 - 2 * products + 1., 0., None))
+                with np.errstate(invalid="ignore", divide="ignore"):
+                    ceiling[f"{norm}_pearson_upper"] += products / sum_norms[norm]
+                    ceiling[f"{norm}_pearson_lower"] += (products - 1.) / others_norm
+                others_ranks = _standardize(rankdata(sums[norm][1] - rdms_rank_z, axis=-1)).astype(dtype)
+                ceiling[f"{norm}_spearman_upper"] += np.einsum("wcp,wcp->wc", rdms_rank_z, mean_ranks[norm])
+                ceiling[f"{norm}_spearman_lower"] += np.einsum("wcp,wcp->wc", rdms_rank_z, others_ranks)
+
+    for key, values in ceiling.items():
+        if key not in ["starts", "n_sessions"]:
+            ceiling[key] = values / n_sessions
+    return ceiling
+
+
+def get_noise_ceiling(ceiling: dict, distance: str, method: str = "pearson", bound: str = "lower") -> np.array:
+    """
+
+    :param ceiling: output of compute_noise_ceiling (or the npz where it is saved)
+    :param distance: distance of the correlations table (cosine, l2, levenshtein-l2, levenshtein-cosine)
+    :return: the bound of the EEG RDMs correlated with this distance (see get_distance_pairs), of shape
+             (n_windows, n_channels)
+    """
+    if bound not in NOISE_CEILING_BOUNDS:
+        raise ValueError(f"Unknown noise ceiling bound {bound}, expected one of {NOISE_CEILING_BOUNDS}")
+    norm = distance.split("-")[-1]
+    return np.asarray(ceiling[f"{norm}_{method}_{bound}"])
+
+
+def check_noise_ceiling(ceiling: dict,
+                        starts: List[int],
+                        timesteps: int,
+                        band: Optional[str] = None,
+                        label: Optional[str] = None,
+                        n_sentences: Optional[int] = None):
+    """
+    Raises a ValueError if the noise ceiling (npz saved by src/noise_ceiling.py) was not computed on the same words,
+    windows and band as the correlations it normalizes.
+
+    :param starts: window starts of the correlations
+    :param timesteps: window length of the correlations
+    :param band: frequency band of the correlations (None without bands)
+    :param label: POS label selecting the words of the correlations, not checked if None
+    :param n_sentences: number of sentences of the dataset of the correlations, not checked if None
+    """
+    errors = []
+    if int(ceiling["timesteps"]) != timesteps or [int(start) for start in ceiling["starts"]] != list(starts):
+        errors.append(f"windows of {int(ceiling['timesteps'])} steps starting at {list(ceiling['starts'])}, "
+                      f"expected {timesteps} steps starting at {list(starts)}")
+    ceiling_band = str(ceiling["band"]) or None
+    if ceiling_band != band:
+        errors.append(f"band {ceiling_band}, expected {band}")
+    if label is not None and str(ceiling["label"]) != label:
+        errors.append(f"label {ceiling['label']}, expected {label}")
+    if n_sentences is not None and int(ceiling["n_sentences"]) != n_sentences:
+        errors.append(f"{int(ceiling['n_sentences'])} sentences, expected {n_sentences}")
+    if len(ceiling["word_ids"]) != int(ceiling["n_label_words"]):
+        errors.append(f"computed on {len(ceiling['word_ids'])} of the {int(ceiling['n_label_words'])} words of the "
+                      f"label (words missing from some sessions)")
+    if len(errors) > 0:
+        raise ValueError(f"The noise ceiling does not match the correlations: {'; '.join(errors)}")
+
+
+def normalize_by_noise_ceiling(corr_values: np.array, ceiling: np.array) -> np.array:
+    """
+
+    :param corr_values: correlations with the windows on the first axis and the channels on the last one, e.g.
+                        (n_windows, n_channels) or the (n_windows, n_layers, n_channels) cube of load_layer_correlations
+    :param ceiling: noise ceiling of shape (n_windows, n_channels), see get_noise_ceiling
+    :return: the normalized correlations corr_values / ceiling (NaN where the ceiling is not positive)
+    """
+    corr_values = np.asarray(corr_values, dtype=np.float64)
+    if (corr_values.shape[0], corr_values.shape[-1]) != ceiling.shape:
+        raise ValueError(f"Correlations of shape {corr_values.shape} do not match the windows and channels of the "
+                         f"noise ceiling {ceiling.shape}")
+    ceiling = np.where(ceiling > 0, ceiling, np.nan).reshape(len(ceiling), *[1] * (corr_values.ndim - 2), -1)
+    return corr_values / ceiling
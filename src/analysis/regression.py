@@ -0,0 +1,122 @@
+from typing import Dict, List, Sequence
+
+import numpy as np
+import pandas as pd
+from scipy.spatial.distance import pdist
+
+from src.analysis.analysis import get_distance_pairs, standardize_rdms
+
+# Word covariates of data/kiloword_metadata.csv
+KILOWORD_COVARIATES = ["Concreteness", "WordFrequency", "OrthographicDistance", "NumberOfLetters", "BigramFrequency",
+                       "VisualComplexity"]
+
+
+def load_word_covariates(metadata_path: str,
+                         words: Sequence[str],
+                         covariates: Sequence[str] = KILOWORD_COVARIATES) -> pd.DataFrame:
+    """
+
+    :param metadata_path: csv with a WORD column and one column per covariate (e.g. data/kiloword_metadata.csv)
+    :return: the covariates of the words, in the order of words
+    """
+    metadata = pd.read_csv(metadata_path).drop_duplicates("WORD").set_index("WORD")
+    missing = [word for word in words if word not in metadata.index]
+    if len(missing) > 0:
+        raise KeyError(f"{len(missing)} words without covariates in {metadata_path}, e.g. {missing[:5]}")
+    return metadata.loc[list(words), list(covariates)].astype(float).reset_index(drop=True)
+
+
+def compute_covariate_rdms(covariates: pd.DataFrame) -> Dict[str, np.array]:
+    """
+
+    :return: {covariate: condensed matrix of the absolute differences between the words}, in the order of all_pairs
+    """
+    return {name: pdist(covariates[[name]].to_numpy(), metric="cityblock") for name in covariates.columns}
+
+
+def confound_columns(confound_names: Sequence[str]) -> List[str]:
+    """ Extra columns of the correlations table filled by ConfoundRegression ("model" is the word RDM) """
+    predictors = ["model", *confound_names]
+    return ["partial_pearson", "partial_spearman", "r2",
+            *[f"beta_{name}" for name in predictors], *[f"unique_{name}" for name in predictors]]
+
+
+class ConfoundRegression:
+    """
+    Partial correlations and multiple regression between a word RDM (+ confound RDMs) and stacks of EEG RDMs.
+    Everything which only depends on the word and confound RDMs (orthonormal basis of the confounds, inverse Gram
+    matrix of the predictors) is computed once: a stack of EEG RDMs (e.g. all the channels of a window) then goes
+    through a single product with the predictors.
+
+    :param word_rdm: condensed matrix of shape (n_pairs,)
+    :param confound_rdms: {name: condensed matrix of shape (n_pairs,)}
+    """
+
+    def __init__(self, word_rdm: np.array, confound_rdms: Dict[str, np.array]):
+        self.confound_names = list(confound_rdms)
+        word_z, word_rank_z = standardize_rdms(np.asarray(word_rdm, dtype=np.float64))
+        confounds_z, confounds_rank_z = standardize_rdms(np.stack([np.asarray(confound_rdms[name], dtype=np.float64)
+                                                                   for name in self.confound_names]))
+        # Pearson on the values, Spearman on the ranks
+        self._pearson = self._prepare(word_z, confounds_z)
+        self._spearman = self._prepare(word_rank_z, confounds_rank_z)
+
+    @staticmethod
+    def _prepare(word_z: np.array, confounds_z: np.array) -> dict:
+        # The standardized RDMs are centered: the constant is already projected out
+        basis, _ = np.linalg.qr(confounds_z.T)
+        predictors = np.concatenate([word_z[None], confounds_z])
+        word_basis = basis.T @ word_z
+        return {"projection": np.concatenate([predictors, basis.T]).T,
+                "n_predictors": len(predictors),
+                "word_basis": word_basis,
+                "word_residual_norm": np.sqrt(max(1. - word_basis @ word_basis, 0.)),
+                "inv_gram": np.linalg.pinv(predictors @ predictors.T)}
+
+    @staticmethod
+    def _partial(eeg_z: np.array, prepared: dict) -> tuple:
+        products = eeg_z @ prepared["projection"]
+        eeg_predictors, eeg_basis = products[..., :prepared["n_predictors"]], products[..., prepared["n_predictors"]:]
+        residual_norm = np.sqrt(np.clip(1. - (eeg_basis ** 2).sum(axis=-1), 0., None))
+        with np.errstate(invalid="ignore", divide="ignore"):
+            partial = (eeg_predictors[..., 0] - eeg_basis @ prepared["word_basis"]) \
+                / (residual_norm * prepared["word_residual_norm"])
+        return partial, eeg_predictors
+
+    def __call__(self, standardized: tuple) -> Dict[str, np.array]:
+        """
+
+        :param standardized: standardize_rdms(eeg_rdms), of shape (..., n_pairs)
+        :return: {column of confound_columns: values of shape (...)}, the betas being standardized betas and the
+                 unique variance of a predictor the drop of R^2 when it is removed from the regression
+        """
+        eeg_z, eeg_rank_z = standardized
+        partial_pearson, eeg_predictors = self._partial(eeg_z, self._pearson)
+        partial_spearman, _ = self._partial(eeg_rank_z, self._spearman)
+
+        # Least squares of all the EEG RDMs at once: betas = (X X^T)^-1 X e
+        betas = eeg_predictors @ self._pearson["inv_gram"]
+        unique = betas ** 2 / np.diag(self._pearson["inv_gram"])
+        results = {"partial_pearson": partial_pearson, "partial_spearman": partial_spearman,
+                   "r2": (betas * eeg_predictors).sum(axis=-1)}
+        for predictor_id, name in enumerate(["model", *self.confound_names]):
+            results[f"beta_{name}"] = betas[..., predictor_id]
+            results[f"unique_{name}"] = unique[..., predictor_id]
+        return results
+
+
+def build_confound_regressions(word_rdms: Dict[str, np.array],
+                               confound_rdms: Dict[str, np.array]) -> Dict[str, ConfoundRegression]:
+    """
+
+    :param word_rdms: {"cosine": rdm, "l2": rdm} (representations) or {"levenshtein": rdm}
+    :return: {distance: ConfoundRegression} of the distances of the table (see correlate_window_rdms), built once and
+             shared by all the windows
+    """
+    regressions, shared = {}, {}
+    for distance, word_rdm, _ in get_distance_pairs(word_rdms):
+        # The levenshtein distances share the same word RDM
+        if id(word_rdm) not in shared:
+            shared[id(word_rdm)] = ConfoundRegression(word_rdm, confound_rdms)
+        regressions[distance] = shared[id(word_rdm)]
+    return regressions
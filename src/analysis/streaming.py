@@ -0,0 +1,136 @@
+from typing import Callable, Dict, Iterator, List, Union
+
+import numpy as np
+import torch
+from scipy.spatial.distance import cdist, pdist
+
+from src.analysis.analysis import compute_rdm, correlate_window_rdms
+from src.analysis.regression import build_confound_regressions
+from src.utils.profiling import stage
+from src.utils.streaming import BackgroundWriter, prefetch
+
+
+def iter_model_representations(inputs: Union[List[str], List[dict]],
+                               model: Callable,
+                               layer: int = -1,
+                               tokenizer: Callable = None,
+                               batch_size: int = 32) -> Iterator[np.array]:
+    """
+    Same representations as get_model_representations (one forward pass per input), yielded by batches of
+    batch_size inputs of shape (batch_size, hidden_size) as soon as they are computed.
+    """
+    model.eval()
+    batch = []
+    with torch.no_grad():
+        for model_input in inputs:
+            if isinstance(model_input, str):
+                model_input = tokenizer(model_input, padding=True, return_tensors="pt")
+            outputs = model(**model_input, output_hidden_states=(layer != -1))
+            hidden_states = outputs.last_hidden_state if layer == -1 else outputs.hidden_states[layer]
+            batch.append(hidden_states[:, 0].cpu().numpy())
+            if len(batch) == batch_size:
+                yield np.concatenate(batch)
+                batch = []
+    if len(batch) > 0:
+        yield np.concatenate(batch)
+
+
+class IncrementalRDM:
+    """
+    Condensed RDMs (same values and order as compute_rdm) filled block by block as the feature batches arrive:
+    each batch is compared to the previous ones and to itself, so the RDMs are ready when the last batch arrives.
+
+    :param n_samples: total number of samples
+    :param norms: "cosine" (cosine similarity) and / or "l2" (between the l2-normalized features)
+    """
+
+    def __init__(self, n_samples: int, norms: tuple = ("cosine", "l2")):
+        self.n_samples = n_samples
+        self.norms = norms
+        self.rdms = {norm: np.empty(n_samples * (n_samples - 1) // 2) for norm in norms}
+        self._features = None
+        self._n_seen = 0
+
+    def _positions(self, rows: np.array, cols: np.array) -> np.array:
+        # Index of the pair (i, j), i < j, in the condensed matrix
+        return self.n_samples * rows - rows * (rows + 1) // 2 + cols - rows - 1
+
+    def add(self, batch: np.array):
+        batch = np.asarray(batch, dtype=np.float64).reshape(len(batch), -1)
+        batch = batch / np.linalg.norm(batch, axis=1, keepdims=True)
+        if self._features is None:
+            self._features = np.empty((self.n_samples, batch.shape[1]))
+        start, end = self._n_seen, self._n_seen + len(batch)
+        if end > self.n_samples:
+            raise ValueError(f"More than {self.n_samples} samples were added")
+
+        # Pairs (previous sample, new sample) then (new sample, new sample)
+        rows, cols = np.meshgrid(np.arange(start), np.arange(start, end), indexing="ij")
+        inner_rows, inner_cols = np.triu_indices(len(batch), k=1)
+        across = self._positions(rows.ravel(), cols.ravel())
+        inner = self._positions(inner_rows + start, inner_cols + start)
+        previous = self._features[:start]
+        for norm in self.norms:
+            metric = "cosine" if norm == "cosine" else "euclidean"
+            across_values = cdist(previous, batch, metric=metric).ravel()
+            inner_values = pdist(batch, metric=metric)
+            if norm == "cosine":
+                across_values, inner_values = 1. - across_values, 1. - inner_values
+            self.rdms[norm][across] = across_values
+            self.rdms[norm][inner] = inner_values
+        self._features[start:end] = batch
+        self._n_seen = end
+
+    def result(self) -> Dict[str, np.array]:
+        if self._n_seen != self.n_samples:
+            raise ValueError(f"{self._n_seen} / {self.n_samples} samples were added")
+        return self.rdms
+
+
+def compute_streamed_word_rdms(batches: Iterator[np.array], n_words: int, queue_size: int = 4) -> Dict[str, np.array]:
+    """ Word RDMs ({"cosine", "l2"}) computed while the feature batches are produced (in a background thread) """
+    rdm = IncrementalRDM(n_words)
+    for batch in prefetch(batches, maxsize=queue_size):
+        with stage("word_distances"):
+            rdm.add(batch)
+    return rdm.result()
+
+
+def _iter_window_eeg_rdms(eegs: np.array, starts: List[int], timesteps: int) -> Iterator[dict]:
+    for start in starts:
+        with stage("eeg_distances"):
+            window = eegs[..., start:start + timesteps]
+            eeg_rdms = {"starts": [start],
+                        **{norm: np.stack([compute_rdm(window[:, chan_id], norm=norm)
+                                           for chan_id in range(eegs.shape[1])])[None] for norm in ["cosine", "l2"]}}
+        # Yielded outside of the stage: the time blocked on the full prefetch queue is not counted
+        yield eeg_rdms
+
+
+def compute_correlations_streamed(eegs: np.array,
+                                  word_rdms: Dict[str, np.array],
+                                  list_electrodes: List[str],
+                                  corr_table,
+                                  pad_step: int = 10,
+                                  timesteps: int = 31,
+                                  queue_size: int = 2,
+                                  confound_rdms: Dict[str, np.array] = None):
+    """
+    Same table as compute_correlations, as a 3-stage pipeline with bounded queues: the EEG RDMs of the next windows
+    are computed (background thread) while the current window is correlated, and the rows of each window are written
+    by a background writer (the csv is appended, not rewritten).
+
+    :param eegs: EEG signals of shape (n_words, n_channels, n_timesteps)
+    :param word_rdms: {"cosine": rdm, "l2": rdm} (representations) or {"levenshtein": rdm}
+    :param corr_table: CorrelationsTable, filled and saved
+    :param queue_size: maximum number of windows (EEG RDMs or rows) waiting in each queue
+    :param confound_rdms: {name: rdm}, adds the partial correlations and regression columns (see correlate_window_rdms)
+    """
+    starts = list(range(0, eegs.shape[-1] - timesteps + 1, pad_step))
+    regressions = None if confound_rdms is None else build_confound_regressions(word_rdms, confound_rdms)
+    with BackgroundWriter(corr_table, maxsize=queue_size) as writer:
+        for eeg_rdms in prefetch(_iter_window_eeg_rdms(eegs, starts, timesteps), maxsize=queue_size):
+            with stage("correlations"):
+                rows = correlate_window_rdms(eeg_rdms, word_rdms, list(list_electrodes), timesteps=timesteps,
+                                             regressions=regressions)
+            writer.write(rows)
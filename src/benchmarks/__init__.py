@@ -0,0 +1,3 @@
+from .synthetic import DATASET_SHAPES, generate_words, generate_features, generate_eeg, generate_coords, get_tiny_model
+from .runner import Benchmark, run_benchmarks, save_results, load_results, compare_to_baseline
+from .cases import CASES
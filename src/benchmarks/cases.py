@@ -0,0 +1,115 @@
+import os
+import tempfile
+
+import numpy as np
+
+from src.analysis import (
+    all_pairs,
+    compute_all_dl_distance,
+    compute_all_representations_distances,
+    compute_correlations,
+    compute_rdm,
+    compute_window_eeg_rdms,
+    correlate_window_rdms,
+    get_model_representations
+)
+from src.benchmarks.synthetic import (
+    DATASET_SHAPES,
+    generate_coords,
+    generate_eeg,
+    generate_features,
+    generate_words,
+    get_tiny_model
+)
+
+
+class _MemoryTable:
+    """ In-memory stand-in of CorrelationsTable: the csv writes are not part of the benchmark """
+
+    def __init__(self):
+        self.rows = []
+
+    def update_table(self, data_dict_row: dict = None):
+        self.rows.append(dict(data_dict_row))
+
+    def save_table(self):
+        pass
+
+
+def bench_representations_distances(benchmark, n_words: int, dataname: str = None, seed: int = 0):
+    features = generate_features(n_words, seed=seed)
+    list_paired_indices = all_pairs(range(n_words))
+    benchmark(compute_all_representations_distances, features, list_paired_indices, norm="cosine")
+
+
+def bench_rdm(benchmark, n_words: int, dataname: str = None, seed: int = 0):
+    features = generate_features(n_words, seed=seed)
+    benchmark(compute_rdm, features, norm="cosine")
+
+
+def bench_dl_distance(benchmark, n_words: int, dataname: str = None, seed: int = 0):
+    list_paired_words = all_pairs(generate_words(n_words, seed=seed))
+    benchmark(compute_all_dl_distance, list_paired_words, normalize=True)
+
+
+def bench_correlations(benchmark, n_words: int, dataname: str = "kiloword", seed: int = 0):
+    eegs = generate_eeg(n_words, dataname, seed=seed)
+    features = generate_features(n_words, seed=seed)
+    list_paired_indices = all_pairs(range(n_words))
+    cosine_word_distances = compute_rdm(features, norm="cosine")
+    l2_word_distances = compute_rdm(features, norm="l2")
+    list_electrodes = [f"E{chan_id}" for chan_id in range(eegs.shape[1])]
+
+    def run():
+        compute_correlations(eegs, cosine_word_distances, l2_word_distances, None, list_paired_indices,
+                             list_electrodes, _MemoryTable(), pad_step=10, timesteps=31)
+
+    benchmark(run)
+
+
+def bench_window_correlations(benchmark, n_words: int, dataname: str = "kiloword", seed: int = 0):
+    eegs = generate_eeg(n_words, dataname, seed=seed)
+    features = generate_features(n_words, seed=seed)
+    word_rdms = {"cosine": compute_rdm(features, norm="cosine"), "l2": compute_rdm(features, norm="l2")}
+    list_electrodes = [f"E{chan_id}" for chan_id in range(eegs.shape[1])]
+
+    def run():
+        eeg_rdms = compute_window_eeg_rdms(eegs, timesteps=31, pad_step=10)
+        return correlate_window_rdms(eeg_rdms, word_rdms, list_electrodes, timesteps=31)
+
+    benchmark(run)
+
+
+def bench_model_representations(benchmark, n_words: int, dataname: str = None, seed: int = 0):
+    model, tokenizer = get_tiny_model("bert", seed=seed)
+    benchmark(get_model_representations, generate_words(n_words, seed=seed), model, -1, tokenizer)
+
+
+def bench_topomap(benchmark, n_words: int = None, dataname: str = "kiloword", seed: int = 0):
+    import matplotlib
+    matplotlib.use("Agg")
+    from src.vis import get_topomap_interpolator, plot_2d_topomap
+
+    # Grid of 2 x 3 maps, as the figures of the correlations over the layers
+    coords = generate_coords(DATASET_SHAPES[dataname]["n_channels"])
+    values = np.random.default_rng(seed).uniform(-0.3, 0.3, (2, 3, len(coords)))
+    interpolator = get_topomap_interpolator(coords, grid_res=100)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        benchmark(plot_2d_topomap, coords, values, dataname, rows=2, cols=3,
+                  subfig_name=[[f"Layer {i * 3 + j}" for j in range(3)] for i in range(2)],
+                  savepath=os.path.join(tmp_dir, "topomap.png"), interpolator=interpolator)
+
+
+# Hot paths and their default sizes (the legacy loops are benchmarked next to their vectorized counterparts),
+# run by src/run_benchmarks.py or under pytest (tests/benchmarks, parametrized over the benchmark fixture)
+CASES = {
+    "representations_distances": {"fn": bench_representations_distances, "n_words": [100, 500, 1000],
+                                  "datasets": [None]},
+    "rdm": {"fn": bench_rdm, "n_words": [100, 1000, 5000], "datasets": [None]},
+    "dl_distance": {"fn": bench_dl_distance, "n_words": [100, 500, 1000], "datasets": [None]},
+    "correlations": {"fn": bench_correlations, "n_words": [100, 200], "datasets": ["kiloword", "ubira"]},
+    "window_correlations": {"fn": bench_window_correlations, "n_words": [100, 1000],
+                            "datasets": ["kiloword", "ubira"]},
+    "model_representations": {"fn": bench_model_representations, "n_words": [100, 1000], "datasets": [None]},
+    "topomap": {"fn": bench_topomap, "n_words": [None], "datasets": ["kiloword", "ubira"]},
+}
@@ -0,0 +1,127 @@
+import os
+import json
+import platform
+import resource
+import subprocess
+import time
+from datetime import datetime
+from itertools import product
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+
+class Benchmark:
+    """
+    Stand-in of the pytest-benchmark fixture: benchmark(fn, *args, **kwargs) runs fn warmup + rounds times (fewer
+    rounds if max_time is exceeded), stores the timing statistics and returns the output of fn.
+    """
+
+    def __init__(self, rounds: int = 5, warmup: int = 1, max_time: float = 30.):
+        self.rounds = rounds
+        self.warmup = warmup
+        self.max_time = max_time
+        self.stats = None
+
+    def __call__(self, fn, *args, **kwargs):
+        for _ in range(self.warmup):
+            fn(*args, **kwargs)
+        times = []
+        start = time.perf_counter()
+        for _ in range(self.rounds):
+            round_start = time.perf_counter()
+            result = fn(*args, **kwargs)
+            times.append(time.perf_counter() - round_start)
+            if time.perf_counter() - start > self.max_time:
+                break
+        times = np.array(times)
+        self.stats = {"min": float(times.min()), "max": float(times.max()), "mean": float(times.mean()),
+                      "median": float(np.median(times)), "stddev": float(times.std()), "rounds": len(times)}
+        return result
+
+
+def machine_info() -> dict:
+    info = {"node": platform.node(), "machine": platform.machine(), "python": platform.python_version(),
+            "cpu_count": os.cpu_count(), "numpy": np.__version__}
+    try:
+        info["commit"] = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                        check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        info["commit"] = None
+    return info
+
+
+def run_benchmarks(cases: Dict[str, dict],
+                   names: Optional[Sequence[str]] = None,
+                   n_words: Optional[Sequence[int]] = None,
+                   datasets: Optional[Sequence[str]] = None,
+                   rounds: int = 5,
+                   warmup: int = 1,
+                   max_time: float = 30.,
+                   seed: int = 0) -> List[dict]:
+    """
+
+    :param cases: {name: {"fn": fn(benchmark, n_words, dataname, seed), "n_words": sizes, "datasets": names}}
+    :param names: cases to run (all by default)
+    :param n_words: sizes overriding those of the cases (except the cases which do not depend on the words)
+    :param datasets: montages to run (those of the cases by default)
+    :return: one result per case and parameters, with the timing statistics (in seconds) and the peak RSS
+    """
+    results = []
+    for name in names or list(cases):
+        case = cases[name]
+        case_sizes = case["n_words"] if n_words is None or case["n_words"] == [None] else n_words
+        case_datasets = [dataname for dataname in case["datasets"]
+                         if datasets is None or dataname is None or dataname in datasets]
+        for size, dataname in product(case_sizes, case_datasets):
+            params = {"n_words": size, "dataset": dataname}
+            bench_id = f"{name}[{'-'.join(str(value) for value in params.values() if value is not None)}]"
+            benchmark = Benchmark(rounds=rounds, warmup=warmup, max_time=max_time)
+            print(f"Running {bench_id}")
+            try:
+                case["fn"](benchmark, n_words=size, dataname=dataname, seed=seed)
+            except Exception as e:
+                results.append({"name": bench_id, "case": name, "params": params, "stats": None, "error": repr(e)})
+                continue
+            # ru_maxrss is in kilobytes on Linux
+            results.append({"name": bench_id, "case": name, "params": params, "stats": benchmark.stats,
+                            "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024})
+    return results
+
+
+def save_results(results: List[dict], save_path: str):
+    os.makedirs(os.path.dirname(os.path.abspath(save_path)), exist_ok=True)
+    with open(save_path + ".tmp", "w") as f:
+        json.dump({"machine_info": machine_info(), "datetime": datetime.now().isoformat(timespec="seconds"),
+                   "benchmarks": results}, f, indent=2)
+    os.replace(save_path + ".tmp", save_path)
+
+
+def load_results(save_path: str) -> Dict[str, dict]:
+    with open(save_path, "r") as f:
+        return {result["name"]: result for result in json.load(f)["benchmarks"]}
+
+
+def compare_to_baseline(results: List[dict], baseline: Dict[str, dict], tolerance: float = 0.2) -> List[dict]:
+    """
+
+    :param baseline: load_results of a previous run (same machine)
+    :param tolerance: relative change of the median time below which the timings are considered unchanged
+    :return: {"name", "median", "baseline", "ratio", "status"} per result, status being "regression",
+             "improvement", "unchanged", "new" (no baseline) or "failed"
+    """
+    comparison = []
+    for result in results:
+        row = {"name": result["name"], "median": None, "baseline": None, "ratio": None}
+        reference = baseline.get(result["name"], {}).get("stats")
+        if result["stats"] is None:
+            row["status"] = "failed"
+        elif reference is None:
+            row.update(median=result["stats"]["median"], status="new")
+        else:
+            ratio = result["stats"]["median"] / reference["median"]
+            status = "regression" if ratio > 1 + tolerance else "improvement" if ratio < 1 / (1 + tolerance) \
+                else "unchanged"
+            row.update(median=result["stats"]["median"], baseline=reference["median"], ratio=ratio, status=status)
+        comparison.append(row)
+    return comparison
@@ -0,0 +1,137 @@
+import os
+import string
+import tempfile
+from typing import List, Optional, Tuple
+
+import numpy as np
+from scipy.ndimage import gaussian_filter1d
+
+# Montages and epoch lengths of the real recordings
+# (Kiloword: 29 channels, -100 to 920 ms at 250 Hz; UBIRA: 64 channels, 276 samples per word)
+DATASET_SHAPES = {
+    "kiloword": {"n_channels": 29, "n_timesteps": 256},
+    "ubira": {"n_channels": 64, "n_timesteps": 276},
+}
+
+_CONSONANTS = np.array(list("bcdfghjklmnpqrstvwxz"))
+_VOWELS = np.array(list("aeiouy"))
+
+
+def generate_words(n_words: int,
+                   min_length: int = 3,
+                   max_length: int = 12,
+                   seed: int = 0) -> List[str]:
+    """
+
+    :param n_words: number of (unique) words
+    :return: pronounceable random words (alternating consonants and vowels), the same for a given seed
+    """
+    rng = np.random.default_rng(seed)
+    words, seen = [], set()
+    while len(words) < n_words:
+        length = int(rng.integers(min_length, max_length + 1))
+        is_vowel = (np.arange(length) + rng.integers(2)) % 2 == 1
+        word = "".join(np.where(is_vowel, rng.choice(_VOWELS, length), rng.choice(_CONSONANTS, length)))
+        if word not in seen:
+            seen.add(word)
+            words.append(word)
+    return words
+
+
+def generate_features(n_words: int,
+                      n_dims: int = 768,
+                      n_clusters: int = 10,
+                      seed: int = 0) -> np.array:
+    """
+
+    :return: float32 features of shape (n_words, n_dims), drawn around n_clusters random centers
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((n_clusters, n_dims), dtype=np.float32) * 2
+    features = centers[rng.integers(n_clusters, size=n_words)]
+    features += rng.standard_normal((n_words, n_dims), dtype=np.float32)
+    return features
+
+
+def generate_eeg(n_words: int,
+                 dataname: str = "kiloword",
+                 n_channels: Optional[int] = None,
+                 n_timesteps: Optional[int] = None,
+                 n_bands: Optional[int] = None,
+                 seed: int = 0) -> np.array:
+    """
+
+    :param dataname: montage and epoch length (see DATASET_SHAPES), overridden by n_channels / n_timesteps
+    :param n_bands: add a band axis (power envelopes), as returned by the datasets with use_power
+    :return: float32 ERP-like signals of shape (n_words, [n_bands,] n_channels, n_timesteps): an evoked response
+             shared by the words with a word-specific amplitude, plus temporally smoothed noise
+    """
+    shape = DATASET_SHAPES[dataname]
+    n_channels = n_channels or shape["n_channels"]
+    n_timesteps = n_timesteps or shape["n_timesteps"]
+    rng = np.random.default_rng(seed)
+    lead = (n_words,) if n_bands is None else (n_words, n_bands)
+
+    times = np.linspace(0., 1., n_timesteps, dtype=np.float32)
+    peaks = np.stack([np.exp(-(times - latency) ** 2 / (2 * width ** 2))
+                      for latency, width in [(0.1, 0.02), (0.17, 0.03), (0.4, 0.08)]])
+    evoked = rng.standard_normal((n_channels, len(peaks)), dtype=np.float32) @ peaks
+    amplitudes = 1. + 0.3 * rng.standard_normal((*lead, 1, 1), dtype=np.float32)
+    noise = gaussian_filter1d(rng.standard_normal((*lead, n_channels, n_timesteps), dtype=np.float32),
+                              sigma=3, axis=-1)
+    eeg = amplitudes * evoked + noise
+    if n_bands is not None:
+        eeg = np.abs(eeg)
+    return eeg.astype(np.float32)
+
+
+def generate_coords(n_channels: int) -> np.array:
+    """
+
+    :return: 2D coordinates of shape (n_channels, 2) spread over a disk (sunflower layout), as a stand-in for
+             the projected electrodes positions
+    """
+    ids = np.arange(n_channels) + 0.5
+    radius = 0.1 * np.sqrt(ids / n_channels)
+    angles = np.pi * (1 + 5 ** 0.5) * ids
+    return np.stack([radius * np.cos(angles), radius * np.sin(angles)], axis=1)
+
+
+def _write_char_vocab(vocab_dir: str) -> str:
+    # Character-level WordPiece vocabulary: every word is tokenized offline, without any download
+    vocab_path = os.path.join(vocab_dir, "tiny_bert_vocab.txt")
+    if not os.path.isfile(vocab_path):
+        tokens = ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]", *string.ascii_lowercase,
+                  *[f"##{char}" for char in string.ascii_lowercase]]
+        with open(vocab_path + ".tmp", "w") as f:
+            f.write("\n".join(tokens) + "\n")
+        os.replace(vocab_path + ".tmp", vocab_path)
+    return vocab_path
+
+
+def get_tiny_model(name: str = "bert",
+                   hidden_size: int = 32,
+                   n_layers: int = 2,
+                   seed: int = 0,
+                   vocab_dir: Optional[str] = None) -> Tuple:
+    """
+    Randomly initialized model with the same interface as get_model (bert or canine), small enough to benchmark
+    the feature extraction offline.
+
+    :param vocab_dir: folder of the bert vocabulary (the temporary folder by default)
+    :return: the model and its tokenizer
+    """
+    import torch
+    torch.manual_seed(seed)
+    if name == "bert":
+        from transformers import BertConfig, BertModel, BertTokenizer
+        tokenizer = BertTokenizer(_write_char_vocab(vocab_dir or tempfile.gettempdir()))
+        config = BertConfig(vocab_size=tokenizer.vocab_size, hidden_size=hidden_size, num_hidden_layers=n_layers,
+                            num_attention_heads=2, intermediate_size=2 * hidden_size, max_position_embeddings=64)
+        return BertModel(config), tokenizer
+    elif name == "canine":
+        from transformers import CanineConfig, CanineModel, CanineTokenizer
+        config = CanineConfig(hidden_size=hidden_size, num_hidden_layers=n_layers, num_attention_heads=2,
+                              intermediate_size=2 * hidden_size, num_hash_buckets=64, num_hash_functions=2)
+        return CanineModel(config), CanineTokenizer()
+    raise ValueError(f"Unknown tiny model {name} (bert or canine)")
@@ -0,0 +1,35 @@
+import hydra
+import matplotlib
+
+from src.pipeline import ArtifactStore, build_correlation_pipeline
+
+
+@hydra.main(config_path='../configs', config_name='build')
+def main(config):
+    # Figures are rendered headless (and serialized, pyplot is not thread-safe)
+    matplotlib.use("Agg")
+
+    pipeline = build_correlation_pipeline(config, ArtifactStore(config.pipeline.store))
+    targets = None
+    if config.pipeline.targets is not None:
+        # The nodes which are not persisted only run for the stale nodes needing them
+        targets = [name for name, node in pipeline.nodes.items()
+                   if node.persist and any(name.startswith(prefix) for prefix in config.pipeline.targets)]
+
+    plan = pipeline.plan(targets)
+    print(f"\n{len(plan)} / {len(pipeline.nodes)} nodes to (re)compute")
+    if config.pipeline.dry_run:
+        for name in plan:
+            print(f"  {name}")
+        return
+
+    status = pipeline.build(targets, num_workers=config.pipeline.num_workers)
+    for name, state in status.items():
+        if state != "built":
+            print(f"\033[91m {name}: {state} \033[0m")
+    n_built = sum(state == "built" for state in status.values())
+    print(f"\033[96m Build done: {n_built} built, {len(status) - n_built} failed or blocked \033[0m")
+
+
+if __name__ == '__main__':
+    main()
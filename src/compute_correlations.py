@@ -1,7 +1,6 @@
 import os
 import hydra
 import torch
-import numpy as np
 from src.dataset import get_dataset
 from src.analysis import (
     all_pairs,
@@ -12,19 +11,33 @@ from src.analysis import (
     get_model
 )
 from src.evaluation import CorrelationsTable
+from src.utils import enable_profiling, disable_profiling, stage
 
 
 
 @hydra.main(config_path='../configs', config_name='correlations')
 def main(config):
+    if config.profile:
+        enable_profiling()
+    with stage("compute_correlations"):
+        _main(config)
+    if config.profile:
+        report_path = os.path.join(config.save_folder, "profile", config.tab_name.replace(".csv", ".json"))
+        disable_profiling().save(report_path)
+        print(f"Profile saved to {report_path}")
+
+
+def _main(config):
 
     # Initialize the dataset
 
-    model, tokenizer = get_model(config.model.name)
-    dataset = get_dataset(config.data, tokenizer, config.data.dataname)
+    with stage("load_model"):
+        model, tokenizer = get_model(config.model.name)
+    with stage("load_dataset"):
+        dataset = get_dataset(config.data, tokenizer, config.data.dataname)
 
     # Initialize the language model used
-    list_words = [dataset[i]["word"] for i in range(len(dataset))] # getattr(dataset, "list_words")
+    list_words = list(dataset.words)
     list_paired_words = all_pairs(list_words)
     list_paired_indices = all_pairs(range(len(list_words)))
 
@@ -42,41 +55,58 @@ def main(config):
 
 
     if config.word_distance == "levenshtein":
-        dl_word_distances = compute_all_dl_distance(list_paired_words, normalize=True)
+        with stage("word_distances"):
+            dl_word_distances = compute_all_dl_distance(list_paired_words, normalize=True)
         cosine_word_distances = None
         l2_word_distances = None
     elif config.word_distance == "levenshtein_ipa":
         import eng_to_ipa as ipa
-        list_ipa_words = [ipa.convert(word) for word in list_words]
-        list_paired_ipa_words = all_pairs(list_ipa_words)
-        dl_word_distances = compute_all_dl_distance(list_paired_ipa_words, normalize=True)
+        with stage("word_distances"):
+            list_ipa_words = [ipa.convert(word) for word in list_words]
+            list_paired_ipa_words = all_pairs(list_ipa_words)
+            dl_word_distances = compute_all_dl_distance(list_paired_ipa_words, normalize=True)
         cosine_word_distances = None
         l2_word_distances = None
 
     else:
         config.model.layer = int(config.model.layer)
-        word_features = get_model_representations(list_words, model, config.model.layer, tokenizer)
+        with stage("word_features"):
+            word_features = get_model_representations(list_words, model, config.model.layer, tokenizer)
 
         if len(word_features.shape) == 3:
             word_features = word_features.squeeze(1)
 
-        cosine_word_distances = compute_all_representations_distances(word_features,
-                                                                      list_paired_indices,
-                                                                      norm="cosine")
-        l2_word_distances = compute_all_representations_distances(word_features,
-                                                                  list_paired_indices)
-    eeg_signals = np.stack([dataset[i]["raw_eeg_input_ids"] for i in range(len(dataset))])
+        with stage("word_distances"):
+            cosine_word_distances = compute_all_representations_distances(word_features,
+                                                                          list_paired_indices,
+                                                                          norm="cosine")
+            l2_word_distances = compute_all_representations_distances(word_features,
+                                                                      list_paired_indices)
+    eeg_signals = dataset.eeg
     list_electrodes = dataset.channels["#NAME"]
 
-    compute_correlations(eeg_signals,
-                         cosine_word_distances,
-                         l2_word_distances,
-                         dl_word_distances,
-                         list_paired_indices,
-                         list_electrodes,
-                         corr,
-                         pad_step=config.pad_step,
-                         timesteps=config.timesteps)
+    # Frequency-band envelopes: one correlation table per band
+    if eeg_signals.ndim == 4:
+        band_names = list(dataset.bands.keys())
+        list_band_signals = [(eeg_signals[:, band_id], band_names[band_id]) for band_id in range(len(band_names))]
+    else:
+        list_band_signals = [(eeg_signals, None)]
+
+    for band_signals, band_name in list_band_signals:
+        if band_name is not None:
+            corr = CorrelationsTable(name=config.tab_name.replace(".csv", f"_{band_name}.csv"),
+                                     table_folder=corr_save_folder,
+                                     table_columns=config.tab_attrs)
+        with stage("correlations" if band_name is None else f"correlations_{band_name}"):
+            compute_correlations(band_signals,
+                                 cosine_word_distances,
+                                 l2_word_distances,
+                                 dl_word_distances,
+                                 list_paired_indices,
+                                 list_electrodes,
+                                 corr,
+                                 pad_step=config.pad_step,
+                                 timesteps=config.timesteps)
 
     print("Correlations Computed !")
 
@@ -16,6 +16,16 @@ class BaseDataset(Dataset):
         self.tokenizer = tokenizer
         self.filter_labels = config.labels
 
+    @property
+    def eeg(self):
+        """ EEG signals of all the samples in a single array (n_samples, ..., n_channels, n_timesteps), not copied """
+        return self.data.eeg
+
+    @property
+    def words(self):
+        """ Words of all the samples """
+        return self.data.words
+
     def _load_channels(self):
         """ Method to load the electrodes names and 3d Positions"""
         raise NotImplementedError
@@ -0,0 +1,113 @@
+from typing import Dict, List, Optional, Sequence, Union
+
+import numpy as np
+import pandas as pd
+
+
+class WordTable:
+    """
+    Struct-of-arrays storage of the word-level samples of a dataset:
+        - eeg: contiguous array of shape (n_words, ..., n_channels, n_timesteps)
+        - words: array of the words
+        - sent_ids: index of the sentence of each word in the sentence table (sentences)
+        - categorical columns (POS, labels...) stored as integer codes + categories
+        - numeric columns (freq, len...) stored as numpy arrays
+    Indexing the table returns a lightweight sample dict whose EEG entry is a view on the cube.
+    """
+
+    def __init__(self,
+                 eeg: np.array,
+                 words: Sequence[str],
+                 sent_ids: Optional[np.array] = None,
+                 sentences: Optional[pd.DataFrame] = None,
+                 categorical: Optional[Dict[str, Sequence]] = None,
+                 numeric: Optional[Dict[str, Sequence]] = None):
+        self.eeg = np.ascontiguousarray(eeg)
+        self.words = np.asarray(words, dtype=object)
+        self.sent_ids = None if sent_ids is None else np.asarray(sent_ids, dtype=np.int32)
+        self.sentences = sentences
+        self.codes, self.categories = {}, {}
+        for name, values in (categorical or {}).items():
+            self._set_categorical(name, values)
+        self.numeric = {name: np.asarray(values) for name, values in (numeric or {}).items()}
+
+    def _set_categorical(self, name: str, values: Union[Sequence, pd.Categorical]):
+        values = pd.Categorical(values)
+        self.codes[name] = values.codes.astype(np.int16)
+        self.categories[name] = np.asarray(values.categories, dtype=object)
+
+    @classmethod
+    def from_sentences(cls,
+                       list_eeg: List[np.array],
+                       list_labels_df: List[pd.DataFrame],
+                       sent_names: List[str],
+                       categorical_cols: Sequence[str],
+                       numeric_cols: Sequence[str],
+                       filter_labels: Optional[List[str]] = None,
+                       filter_col: str = "pos") -> "WordTable":
+        """
+
+        :param list_eeg: sentence-wise EEG arrays of shape (n_words, ..., n_channels, n_timesteps)
+        :param list_labels_df: sentence-wise word metadata (one row per word)
+        :param sent_names: common ids of the sentences
+        :param categorical_cols: metadata columns stored as categories
+        :param numeric_cols: metadata columns stored as numeric arrays
+        :param filter_labels: if given, only keep the words whose filter_col is in filter_labels
+        :return: the table containing the words of all the sentences
+        """
+        sentences = pd.DataFrame({"common_id": sent_names,
+                                  "sentence": [" ".join(labels_df["word"].values) for labels_df in list_labels_df]})
+        list_masks = [np.ones(len(labels_df), dtype=bool) if filter_labels is None
+                      else labels_df[filter_col].isin(filter_labels).to_numpy() for labels_df in list_labels_df]
+
+        labels_df = pd.concat([df[mask] for df, mask in zip(list_labels_df, list_masks)], ignore_index=True)
+        sent_ids = np.concatenate([np.full(mask.sum(), sent_i, dtype=np.int32)
+                                   for sent_i, mask in enumerate(list_masks)])
+        eeg = np.concatenate([eeg_sig[mask] for eeg_sig, mask in zip(list_eeg, list_masks)])
+
+        return cls(eeg,
+                   labels_df["word"].values,
+                   sent_ids=sent_ids,
+                   sentences=sentences,
+                   categorical={col: labels_df[col].values for col in categorical_cols},
+                   numeric={col: labels_df[col].to_numpy() for col in numeric_cols})
+
+    def __len__(self):
+        return len(self.words)
+
+    def column(self, name: str) -> np.array:
+        """ Returns the (decoded) values of a metadata column """
+        if name in self.codes:
+            codes = self.codes[name]
+            values = np.empty(len(codes), dtype=object)
+            values[codes >= 0] = self.categories[name][codes[codes >= 0]]
+            return values
+        if name == "sentence":
+            return self.sentences["sentence"].values[self.sent_ids]
+        if name == "sent_id":
+            return self.sentences["common_id"].values[self.sent_ids]
+        return self.numeric[name]
+
+    def __getitem__(self, idx: int) -> dict:
+        sample = {"id": idx, "word": self.words[idx], "raw_eeg_input_ids": self.eeg[idx]}
+        if self.sent_ids is not None:
+            sent = self.sentences.iloc[self.sent_ids[idx]]
+            sample["sent_id"] = sent["common_id"]
+            sample["sentence"] = sent["sentence"]
+        for name, codes in self.codes.items():
+            sample[name] = self.categories[name][codes[idx]] if codes[idx] >= 0 else None
+        for name, values in self.numeric.items():
+            sample[name] = values[idx]
+        return sample
+
+    def take(self, indices: Union[np.array, Sequence[int]]) -> "WordTable":
+        """ Returns a new table restricted to the given word indices (or boolean mask) """
+        table = WordTable.__new__(WordTable)
+        table.eeg = self.eeg[indices]
+        table.words = self.words[indices]
+        table.sent_ids = None if self.sent_ids is None else self.sent_ids[indices]
+        table.sentences = self.sentences
+        table.codes = {name: codes[indices] for name, codes in self.codes.items()}
+        table.categories = dict(self.categories)
+        table.numeric = {name: values[indices] for name, values in self.numeric.items()}
+        return table
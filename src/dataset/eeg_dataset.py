@@ -1,15 +1,25 @@
 import os
+from functools import partial
 from glob import glob
-from typing import List, Optional, Dict, Union
-from tqdm import tqdm
+from typing import Iterator, List, Optional, Dict, Tuple, Union
 import numpy as np
 import pandas as pd
-from scipy.signal import hilbert
+from tqdm import tqdm
 from omegaconf import OmegaConf
 from transformers import AutoTokenizer
 from src.dataset.base import BaseDataset
+from src.dataset.columnar import WordTable
+from src.dataset.loader import SentenceCache, load_sentences
+from src.dataset.session_store import SessionStore
+from src.dataset.power import compute_analytic_power, resolve_bands
 
-from src.utils import read_table, parse_table_labels
+from src.utils import read_table, parse_table_labels, RunningMoments
+
+WORD_LABELS_COLS = ["word", "pos", "filename", "freq", "len",
+                    "prev_pos", "next_pos", "prev_freq", "next_freq", "prev_len", "next_len"]
+WORD_CATEGORICAL_COLS = ["pos", "prev_pos", "next_pos", "filename"]
+WORD_NUMERIC_COLS = ["freq", "prev_freq", "next_freq", "len", "prev_len", "next_len"]
+AVERAGE_NUMERIC_COLS = ["n_sessions", "noise_var"]
 
 LIST_LABELS = ["SEPARATION", "LOCATION", "ENTERTAINMENT", "MONEY", "NATURE", "QUANTITY",
                "POLITICS", "RELIGION", "HOUSE", "MOVE", "SPORT",
@@ -20,45 +30,39 @@ LIST_LABELS = ["SEPARATION", "LOCATION", "ENTERTAINMENT", "MONEY", "NATURE", "QU
                "GOVERN", "SCIENCE", "PHILOSOPHY", "FEELING"]
 
 
-def _split_sent_data_into_words_data(start_id: int,
-                                     sent_id: str,
-                                     eeg_sig: np.array,
-                                     labels_df: pd.DataFrame,
-                                     filter_labels: Optional[List[str]] = None):
-    word_data_list = []
-    sentence = " ".join(labels_df["word"].values)
-    for i, row in labels_df.iterrows():
-        sample = {
-            "id": start_id + i,  # Unique key to define the sample
-            "sent_id": sent_id,
-            "word": row["word"],
-            "sentence": sentence,
-            "raw_eeg_input_ids": eeg_sig[i],
-            "pos": row["pos"],
-            "prev_pos": row["prev_pos"],
-            "next_pos": row["next_pos"],
-            "freq": row["freq"],
-            "prev_freq": row["prev_freq"],
-            "next_freq": row["next_freq"],
-            "len": row["len"],
-            "prev_len": row["prev_len"],
-            "next_len": row["next_len"],
-        }
-        # Apply Specific label filtering if needed
-        if filter_labels is not None and sample["pos"] not in filter_labels:
-            continue
-        word_data_list.append(sample)
-
-    return word_data_list
-
-
-def _compute_eeg_power_signal(sent_eeg: np.array):
+def _compute_eeg_power_signal(sent_eeg: np.array,
+                              bands: Optional[Dict] = None,
+                              sfreq: float = 250.,
+                              workers: int = -1):
     """
 
-    :param sent_eeg: "2D array of shape (N_WORDS X TIMESTEPS, Channels)
-    :return:
+    :param sent_eeg: array of shape (..., N_WORDS, CHANNELS, TIMESTEPS)
+    :param bands: mapping {band_name: (low_freq, high_freq)}, if given the band envelopes are returned
+    :return: power of shape (..., N_WORDS, CHANNELS, TIMESTEPS)
+             or (..., N_WORDS, N_BANDS, CHANNELS, TIMESTEPS) when bands are given
+    """
+    *lead, n_words, channels, timesteps = sent_eeg.shape
+    # The analytic signal is computed on the whole sentence: (..., CHANNELS, N_WORDS * TIMESTEPS)
+    sent_eeg = np.swapaxes(sent_eeg, -3, -2).reshape(*lead, channels, n_words * timesteps)
+    power = compute_analytic_power(sent_eeg, axis=-1, bands=bands, sfreq=sfreq, workers=workers)
+    power = np.swapaxes(power.reshape(*power.shape[:-1], n_words, timesteps), -3, -2)
+    if bands is not None:
+        # Put the band axis between the words and the channels
+        power = np.moveaxis(power, 0, -3)
+    return power
+
+
+def _summarize_session_moments(moments: RunningMoments, labels_df: pd.DataFrame):
+    """
+
+    :param moments: running moments over the sessions of the sentence signal
+    :param labels_df: word metadata of the sentence
+    :return: the signal averaged over the sessions and the word metadata, with a per-word noise estimate:
+             the variance across the sessions, averaged over channels and timesteps
     """
-    return np.abs(hilbert(sent_eeg) * np.conjugate(hilbert(sent_eeg)))
+    labels_df = labels_df.assign(n_sessions=moments.count,
+                                 noise_var=moments.variance.reshape(len(labels_df), -1).mean(axis=1))
+    return moments.mean, labels_df
 
 
 def get_dataset_electrodes(rootpath: str, dataname: str) -> Union[pd.DataFrame, List[pd.DataFrame]]:
@@ -86,6 +90,8 @@ class UBIRADataset(BaseDataset):
     def __init__(self, cfg, tokenizer=None):
         super().__init__(cfg, tokenizer)
         self.folders = cfg.list_folders
+        self.bands = resolve_bands(cfg.get("bands", None))
+        self.sfreq = cfg.get("sfreq", 250.)
         self.eegs = []
         self.meta_data = []
         self._load_sentence_labels()
@@ -108,59 +114,74 @@ class UBIRADataset(BaseDataset):
     def _get_sentence_wise_data(self, sent_id: str, mode: str = "average", power: bool = True) -> List:
 
         if mode == "average":
-            list_paths = glob(os.path.join(self.datapath, "*", f"{sent_id}", "*.npy"))
+            list_paths = [path for folder in self.folders
+                          for path in glob(os.path.join(self.datapath, folder, f"{sent_id}", "*.npy"))]
             labels_path = list_paths[0].replace("eeg.npy", "labels.csv")
 
             labels_df = pd.read_csv(labels_path)
-            labels_df = labels_df[["word", "pos", "filename", "freq", "len",
-                                   "prev_pos", "next_pos", "prev_freq", "next_freq", "prev_len", "next_len"]]
+            labels_df = labels_df[WORD_LABELS_COLS]
 
-            # Array of shape (n_sessions, n_words, n_channels, n_timesteps)
-            eeg_sigs_arr = np.stack([np.load(path) for path in list_paths])
-            n_words, channels, timesteps = eeg_sigs_arr[0].shape
-
-            if not power:
-                eeg_sig = np.mean(eeg_sigs_arr, axis=0)
-
-            else:
-                # we want to compute the power, so we reshape the signal
-                eeg_sigs_arr = eeg_sigs_arr.transpose(0, 2, 1, 3)
-                # Reshape the array to (n_sessions,  n_channels, n_words * n_timesteps)
-                eeg_sigs_arr = eeg_sigs_arr.reshape(-1, channels, n_words * timesteps)
-                # Apply the Power computation for each trial
-                eeg_pows_arr = _compute_eeg_power_signal(eeg_sigs_arr)
-                eeg_pows_arr = eeg_pows_arr.reshape(-1, channels, n_words, timesteps).transpose(0, 2, 1, 3)
-                eeg_sig = np.mean(eeg_pows_arr, axis=0)
-            return sent_id, eeg_sig, labels_df
+            # Stream the sessions one at a time: running mean and variance over the sessions
+            # of the arrays of shape (n_words, n_channels, n_timesteps)
+            moments = RunningMoments()
+            for path in list_paths:
+                moments.update(self._session_signal(np.load(path), power))
+            return (sent_id, *_summarize_session_moments(moments, labels_df))
 
         else:
             # We only consider a single session so mode must be in ["session_{i}"]
 
             path = glob(os.path.join(self.datapath, mode, f"{sent_id}", "*.npy"))
             assert len(path) == 1
+            path = path[0]
             labels_path = path.replace("eeg.npy", "labels.csv")
 
             labels_df = pd.read_csv(labels_path)
-            labels_df = labels_df[["word", "pos", "filename", "freq", "len",
-                                   "prev_pos", "next_pos", "prev_freq", "next_freq", "prev_len", "next_len"]]
+            labels_df = labels_df[WORD_LABELS_COLS]
 
             # Array of shape (n_words, n_channels, n_timesteps)
-            eeg_sigs_arr = np.load(path)
-            n_words, channels, timesteps = eeg_sigs_arr.shape
+            eeg_sig = self._session_signal(np.load(path), power)
+            return sent_id, eeg_sig, labels_df
 
-            if not power:
-                eeg_sig = eeg_sigs_arr
+    def _session_signal(self, eeg_sigs_arr: np.array, power: bool = True) -> np.array:
+        """ Signal of a sentence within a single session (its power if required) """
+        if not power:
+            return eeg_sigs_arr
+        # Apply the Power computation for each trial
+        return _compute_eeg_power_signal(eeg_sigs_arr, bands=self.bands, sfreq=self.sfreq,
+                                         workers=self.config.get("fft_workers", -1))
 
-            else:
-                # we want to compute the power, so we reshape the signal
-                eeg_sigs_arr = eeg_sigs_arr.transpose(1, 0, 2)
-                # Reshape the array to (n_channels, n_words * n_timesteps)
-                eeg_sigs_arr = eeg_sigs_arr.reshape(-1, n_words * timesteps)
-                # Apply the Power computation for each trial
-                eeg_pows_arr = _compute_eeg_power_signal(eeg_sigs_arr)
-                eeg_pows_arr = eeg_pows_arr.reshape(-1, n_words, timesteps).transpose(1, 0, 2)
-                eeg_sig = eeg_pows_arr
-            return sent_id, eeg_sig, labels_df
+    def _load_sentences_from_stores(self, sent_ids: List[str], power: bool = True,
+                                    cache: Optional[SentenceCache] = None) -> List:
+        """
+
+        :param sent_ids: common ids of the sentences
+        :return: the list of (sent_id, eeg_sig, labels_df) averaged over the sessions, read from the
+                 SessionStore of each session (a few large reads per session, one session in memory at a time)
+        """
+        cached = {sent_id: cache.load(sent_id) for sent_id in sent_ids} if cache is not None else {}
+        missing = [sent_id for sent_id in sent_ids if cached.get(sent_id) is None]
+
+        moments = {sent_id: RunningMoments() for sent_id in missing}
+        labels = {}
+        for folder in tqdm(self.folders, desc="Reading session stores"):
+            session_path = os.path.join(self.datapath, folder)
+            if len(missing) == 0 or not SessionStore.exists(session_path):
+                continue
+            for sent_id, (eeg_sigs_arr, labels_df) in SessionStore(session_path).read_sentences(missing).items():
+                moments[sent_id].update(self._session_signal(eeg_sigs_arr, power))
+                labels.setdefault(sent_id, labels_df[WORD_LABELS_COLS])
+
+        sentences = []
+        for sent_id in sent_ids:
+            if cached.get(sent_id) is not None:
+                sentences.append((sent_id, *cached[sent_id]))
+                continue
+            eeg_sig, labels_df = _summarize_session_moments(moments[sent_id], labels[sent_id])
+            if cache is not None:
+                cache.save(sent_id, eeg_sig, labels_df)
+            sentences.append((sent_id, eeg_sig, labels_df))
+        return sentences
 
     def _load_data(self, mode: str = "word", use_power: bool = True):
         """
@@ -168,41 +189,84 @@ class UBIRADataset(BaseDataset):
         :param mode: (str) whether we load the signals on the sentence of word level
         :return: the data from the specified folder (6 in this dataset)
         """
-        self.data = []
-        self.start_id = 0
-
-        # Iterate on sentence level
-        for sent_i, row in tqdm(self.sentence_labels.iterrows(), total=self.config.n_sentences):
-            if sent_i > self.config.n_sentences:
-                break
-            sent_id_name = row["common_id"]
-
-            _, eeg_sig, labels_df = self._get_sentence_wise_data(sent_id_name, mode="average", power=use_power)
-
-            if mode == "word":
-                word_data_list = _split_sent_data_into_words_data(self.start_id + sent_i,
-                                                                  sent_id_name,
-                                                                  eeg_sig,
-                                                                  labels_df,
-                                                                  filter_labels=self.filter_labels)
-                self.data.extend(word_data_list)
-                self.start_id += len(word_data_list) - 1
-
-            elif mode == "sentence":
-                continue
+        cache = None
+        if self.config.get("cache_dir", None):
+            cache = SentenceCache(self.config.cache_dir, self.folders, use_power=use_power, mode="average",
+                                  bands=self.bands)
+
+        # Load the sentences (in parallel, from the cache when possible)
+        sent_ids = self.sentence_labels["common_id"].values[:self.config.n_sentences + 1]
+        if self.config.get("storage", "npy") == "store":
+            sentences = self._load_sentences_from_stores(list(sent_ids), power=use_power, cache=cache)
+        else:
+            sentences = load_sentences(sent_ids,
+                                       partial(self._get_sentence_wise_data, mode="average", power=use_power),
+                                       cache=cache,
+                                       num_workers=self.config.get("num_workers", 1))
+
+        if mode == "word":
+            # Store the words of all the sentences column-wise (a single contiguous EEG array)
+            sent_names, list_eeg, list_labels_df = zip(*sentences)
+            self.data = WordTable.from_sentences(list(list_eeg),
+                                                 list(list_labels_df),
+                                                 list(sent_names),
+                                                 categorical_cols=WORD_CATEGORICAL_COLS,
+                                                 numeric_cols=WORD_NUMERIC_COLS + AVERAGE_NUMERIC_COLS,
+                                                 filter_labels=self.filter_labels)
+
+        elif mode == "sentence":
+            self.data = []
 
     def _get_dataset_words(self):
-        list_words = []
-        for i in range(len(self.data)):
-            list_words.append(self.data[i]["word"])
-        return list_words
+        # The sentence mode has no word table (empty dataset)
+        return self.data.words if isinstance(self.data, WordTable) else []
+
+    def _read_session_sentence(self, sent_id: str, folder: str, power: bool = True) -> tuple:
+        """ (sent_id, eeg_sig, labels_df) of a sentence in a single session, (sent_id, None, None) if it is missing """
+        paths = glob(os.path.join(self.datapath, folder, f"{sent_id}", "*.npy"))
+        if len(paths) == 0:
+            return sent_id, None, None
+        labels_df = pd.read_csv(paths[0].replace("eeg.npy", "labels.csv"))[WORD_LABELS_COLS]
+        return sent_id, self._session_signal(np.load(paths[0]), power), labels_df
+
+    def iter_session_signals(self, power: Optional[bool] = None) -> Iterator[Tuple[str, np.array]]:
+        """
+        Streams the sessions which are averaged in self.eeg, one session in memory at a time.
+
+        :param power: whether to compute the power of the signals (config.use_power by default)
+        :return: (session folder, EEG of shape (n_words, ..., n_channels, n_timesteps)), same words and order as
+                 self.eeg, NaN for the words of the sentences missing from the session
+        """
+        power = self.config.use_power if power is None else power
+        sent_ids = list(self.data.sentences["common_id"].values)
+        for folder in self.folders:
+            session_path = os.path.join(self.datapath, folder)
+            if self.config.get("storage", "npy") == "store":
+                sentences = {} if not SessionStore.exists(session_path) else \
+                    {sent_id: (self._session_signal(eeg_sig, power), labels_df[WORD_LABELS_COLS])
+                     for sent_id, (eeg_sig, labels_df) in SessionStore(session_path).read_sentences(sent_ids).items()}
+            else:
+                read_fn = partial(self._read_session_sentence, folder=folder, power=power)
+                sentences = {sent_id: (eeg_sig, labels_df) for sent_id, eeg_sig, labels_df
+                             in load_sentences(sent_ids, read_fn, num_workers=self.config.get("num_workers", 1))
+                             if eeg_sig is not None}
+
+            session_eeg = np.full(self.eeg.shape, np.nan, dtype=self.eeg.dtype)
+            for sent_i, sent_id in enumerate(sent_ids):
+                if sent_id not in sentences:
+                    continue
+                eeg_sig, labels_df = sentences[sent_id]
+                # Same words as WordTable.from_sentences
+                mask = np.ones(len(labels_df), dtype=bool) if self.filter_labels is None \
+                    else labels_df["pos"].isin(self.filter_labels).to_numpy()
+                session_eeg[self.data.sent_ids == sent_i] = eeg_sig[mask]
+            yield folder, session_eeg
 
 
 class KilowordDataset(BaseDataset):
 
     def __init__(self, config, tokenizer=None):
         super().__init__(config, tokenizer)
-        self.data = []
         self._load_channels()
         self._load_labels()
         self.words_list = self._get_dataset_words()
@@ -222,13 +286,13 @@ class KilowordDataset(BaseDataset):
         # Filter the labels
         if self.filter_labels is not None:
             if self.filter_labels == "OBJECT":
-                all_ids = self.labels[self.labels["MATERIAL"] == "YES"].index
+                self.all_ids = self.labels[self.labels["MATERIAL"] == "YES"].index
             elif self.filter_labels == "ABSTRACT":
-                all_ids = self.labels[self.labels["MATERIAL"] != "YES"].index
+                self.all_ids = self.labels[self.labels["MATERIAL"] != "YES"].index
             else:
-                all_ids = self.labels_df[self.labels_df[self.filter_labels] is True].index
+                self.all_ids = self.labels_df[self.labels_df[self.filter_labels] == True].index
         else:
-            self.all_ids = len(self.labels)
+            self.all_ids = np.arange(len(self.labels))
 
     def _get_dataset_words(self):
         return self.labels["WORD"].values[self.all_ids]
@@ -239,20 +303,15 @@ class KilowordDataset(BaseDataset):
     def _load_data(self):
         # THen retrieve all the filtered data
         eeg_data = read_table(os.path.join(self.datapath, "KWORD_ERP_LEXICAL_DECISION_DGMH2015.csv"))
-
-        grouped_data = eeg_data.groupby("WORD")
-        for i, word in enumerate(self.words_list):
-            da = grouped_data.get_group(word)
-            da = da[~da['ELECNAME'].isin(["REJ1", "REJ2", "REJ3"])]
-            d = da.drop(columns=['WORD#', 'WORD', 'ELEC#', 'ELECNAME']).to_numpy()
-            sample = {
-                "raw_eeg_input_ids": d,
-                "id": i,
-                "pos": None,
-                "len": len(word),
-                "word": word
-            }
-            self.data.append(sample)
+        eeg_data = eeg_data[~eeg_data['ELECNAME'].isin(["REJ1", "REJ2", "REJ3"])]
+
+        grouped_data = eeg_data.drop(columns=['WORD#', 'ELEC#', 'ELECNAME']).groupby("WORD")
+        eeg = np.stack([grouped_data.get_group(word).drop(columns=["WORD"]).to_numpy()
+                        for word in self.words_list])
+        self.data = WordTable(eeg,
+                              self.words_list,
+                              categorical={"pos": [None] * len(self.words_list)},
+                              numeric={"len": [len(word) for word in self.words_list]})
 
 
 def get_dataset(config: Union[Dict, OmegaConf],
@@ -0,0 +1,89 @@
+import os
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+# Bump when the content of the cached entries changes
+CACHE_VERSION = 2
+
+
+class SentenceCache:
+    """
+    On-disk cache of the sentence-wise EEG signals (averaged over the sessions and optionally
+    power-transformed). Each sentence is stored as a {key}_eeg.npy / {key}_labels.csv pair, the key
+    being built from (sentence id, sessions, use_power, mode, frequency bands).
+    """
+
+    def __init__(self,
+                 cache_dir: str,
+                 sessions: Sequence[str],
+                 use_power: bool = True,
+                 mode: str = "average",
+                 bands: Optional[Dict[str, Tuple[float, float]]] = None):
+        self.cache_dir = cache_dir
+        self.sessions = sorted(sessions)
+        self.use_power = use_power
+        self.mode = mode
+        self.bands = bands
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _key(self, sent_id: str) -> str:
+        raw_key = "|".join([sent_id, ",".join(self.sessions), str(self.use_power), self.mode, str(CACHE_VERSION)])
+        if self.bands is not None:
+            raw_key += "|" + ",".join(f"{name}:{low}-{high}" for name, (low, high) in self.bands.items())
+        return f"{sent_id}_{hashlib.sha1(raw_key.encode()).hexdigest()[:16]}"
+
+    def _paths(self, sent_id: str) -> Tuple[str, str]:
+        key = self._key(sent_id)
+        return (os.path.join(self.cache_dir, f"{key}_eeg.npy"),
+                os.path.join(self.cache_dir, f"{key}_labels.csv"))
+
+    def load(self, sent_id: str) -> Optional[Tuple[np.array, pd.DataFrame]]:
+        eeg_path, labels_path = self._paths(sent_id)
+        if not (os.path.isfile(eeg_path) and os.path.isfile(labels_path)):
+            return None
+        return np.load(eeg_path), pd.read_csv(labels_path)
+
+    def save(self, sent_id: str, eeg_sig: np.array, labels_df: pd.DataFrame) -> None:
+        eeg_path, labels_path = self._paths(sent_id)
+        # Write in temporary files first so that concurrent readers never see a partial entry
+        with open(eeg_path + ".tmp", "wb") as f:
+            np.save(f, eeg_sig)
+        labels_df.to_csv(labels_path + ".tmp", index=False)
+        os.replace(labels_path + ".tmp", labels_path)
+        os.replace(eeg_path + ".tmp", eeg_path)
+
+
+def load_sentences(sent_ids: Sequence[str],
+                   load_fn: Callable[[str], Tuple[str, np.array, pd.DataFrame]],
+                   cache: Optional[SentenceCache] = None,
+                   num_workers: int = 1) -> List[Tuple[str, np.array, pd.DataFrame]]:
+    """
+
+    :param sent_ids: common ids of the sentences to load
+    :param load_fn: function loading a single sentence from the raw session files,
+                    returns (sent_id, eeg_sig, labels_df)
+    :param cache: if given, sentences are read from (and written to) this cache
+    :param num_workers: number of threads loading the sentences (file reads and numpy release the GIL)
+    :return: the list of (sent_id, eeg_sig, labels_df), in the same order as sent_ids
+    """
+
+    def _load(sent_id: str):
+        if cache is not None:
+            cached = cache.load(sent_id)
+            if cached is not None:
+                return (sent_id, *cached)
+        sent_id, eeg_sig, labels_df = load_fn(sent_id)
+        if cache is not None:
+            cache.save(sent_id, eeg_sig, labels_df)
+        return sent_id, eeg_sig, labels_df
+
+    if num_workers is None or num_workers <= 1:
+        return [_load(sent_id) for sent_id in tqdm(sent_ids, desc="Loading sentences")]
+
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        return list(tqdm(executor.map(_load, sent_ids), total=len(sent_ids), desc="Loading sentences"))
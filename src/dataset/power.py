@@ -0,0 +1,82 @@
+from typing import Dict, Optional, Sequence, Tuple, Union
+
+import numpy as np
+from scipy import fft as sp_fft
+
+# UBIRA recordings are filtered between 1 and 40 Hz
+FREQUENCY_BANDS = {
+    "theta": (4., 8.),
+    "alpha": (8., 13.),
+    "beta": (13., 30.),
+    "gamma": (30., 40.),
+}
+
+
+def resolve_bands(bands: Union[None, str, Sequence[str], Dict[str, Sequence[float]]]) \
+        -> Optional[Dict[str, Tuple[float, float]]]:
+    """
+
+    :param bands: either None, a list of band names (keys of FREQUENCY_BANDS)
+                  or a mapping {band_name: (low_freq, high_freq)}
+    :return: the mapping {band_name: (low_freq, high_freq)}, or None if no band is required
+    """
+    if bands is None or (isinstance(bands, str) and bands.lower() in ["none", "null", ""]):
+        return None
+    if isinstance(bands, str):
+        bands = [bands]
+    if hasattr(bands, "keys"):
+        return {str(name): (float(bands[name][0]), float(bands[name][1])) for name in bands.keys()}
+    return {name: FREQUENCY_BANDS[name] for name in bands}
+
+
+def _analytic_multiplier(n_fft: int) -> np.array:
+    """ Spectrum weights turning a real signal into its analytic signal (same as scipy.signal.hilbert) """
+    h = np.zeros(n_fft)
+    if n_fft % 2 == 0:
+        h[0] = h[n_fft // 2] = 1
+        h[1:n_fft // 2] = 2
+    else:
+        h[0] = 1
+        h[1:(n_fft + 1) // 2] = 2
+    return h
+
+
+def compute_analytic_power(signal: np.array,
+                           axis: int = -1,
+                           bands: Optional[Dict[str, Tuple[float, float]]] = None,
+                           sfreq: float = 250.,
+                           workers: int = -1) -> np.array:
+    """
+    Computes the power (squared envelope) of the analytic signal with a single forward FFT, zero-padded
+    to the next fast length. The band envelopes are obtained by masking the same spectrum.
+
+    :param signal: real array
+    :param axis: time axis
+    :param bands: mapping {band_name: (low_freq, high_freq)} (see resolve_bands)
+    :param sfreq: sampling frequency of the signal (Hz)
+    :param workers: number of workers used by scipy.fft (-1 for all the cpus)
+    :return: array with the same shape as signal if bands is None,
+             otherwise of shape (n_bands, *signal.shape), the bands being ordered as in the mapping
+    """
+    axis = axis % signal.ndim
+    n_times = signal.shape[axis]
+    n_fft = sp_fft.next_fast_len(n_times, real=False)
+
+    spectrum = sp_fft.fft(signal, n=n_fft, axis=axis, workers=workers)
+    spectrum = np.moveaxis(spectrum, axis, -1)
+
+    h = _analytic_multiplier(n_fft)
+    if bands is None:
+        masks = h[None]
+    else:
+        freqs = np.abs(sp_fft.fftfreq(n_fft, d=1. / sfreq))
+        masks = np.stack([h * ((freqs >= low) & (freqs < high)) for (low, high) in bands.values()])
+    masks = masks.reshape((len(masks),) + (1,) * (spectrum.ndim - 1) + (n_fft,))
+
+    analytic = sp_fft.ifft(spectrum[None] * masks, axis=-1, workers=workers)[..., :n_times]
+    power = analytic.real ** 2 + analytic.imag ** 2
+    power = np.moveaxis(power, -1, axis + 1)
+
+    if bands is None:
+        return power[0]
+    return power
@@ -4,7 +4,8 @@ import numpy as np
 import pandas as pd
 from tqdm import tqdm
 from glob import glob
-from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from src.dataset.session_store import SessionStoreWriter
 
 
 def get_sentences_from_session(datapath: str, session_folder: str) -> None:
@@ -48,59 +49,61 @@ def get_unique_and_single_sentences_from_session(datapath: str, session_folder:
     # Load the csv file containing all the sentences (computed with previous function get_sentences_from_session)
     src_path = os.path.join(datapath, session_folder)
     sentence_df = pd.read_csv(os.path.join(src_path, "all_sentences.csv"))
-    list_sentences = sentence_df["sent_content"].values
 
-    counted_list_sentences = dict(Counter(list_sentences))
+    # Separate Unique and duplicate sentences (read at least twice) and save them in different files
+    is_duplicate = _hash_sentences(sentence_df["sent_content"]).duplicated(keep=False).to_numpy()
 
-    # Separate Unique and duplicate sentences and save them in different files
-    unique_list = []
-    duplicate_list = []
+    sentence_df[~is_duplicate].to_csv(os.path.join(src_path, "all_unique_sentences.csv"), index=False)
+    sentence_df[is_duplicate].to_csv(os.path.join(src_path, "all_duplicate_sentences.csv"), index=False)
 
-    for sentence, count in counted_list_sentences.items():
-        if count >= 2:
-            duplicate_list.append(sentence)
-        else:
-            unique_list.append(sentence)
 
-    unique_sent_df = pd.DataFrame(columns=sentence_df.columns)
-    duplicate_sent_df = pd.DataFrame(columns=sentence_df.columns)
+def _hash_sentences(sentences: pd.Series) -> pd.Series:
+    """ 64-bit hash key of each sentence content """
+    return pd.util.hash_pandas_object(sentences.astype(str), index=False)
 
-    for i, row in sentence_df.iterrows():
-        if row["sent_content"] in duplicate_list:
-            duplicate_sent_df.loc[len(duplicate_sent_df)] = row
-        else:
-            unique_sent_df.loc[len(unique_sent_df)] = row
 
-    unique_sent_df.to_csv(os.path.join(src_path, "all_unique_sentences.csv"), index=False)
-    duplicate_sent_df.to_csv(os.path.join(src_path, "all_duplicate_sentences.csv"), index=False)
+def _session_sort_key(session_folder: str):
+    # session_2 < session_10
+    suffix = session_folder.split("_")[-1]
+    return (0, int(suffix), session_folder) if suffix.isdigit() else (1, 0, session_folder)
 
 
-def label_all_sentences_from_sessions(datapath: str, use_duplicates: bool=False):
+def label_all_sentences_from_sessions(datapath: str, use_duplicates: bool = False):
+    """
+
+    :param datapath: Path to the folder containing the data (one folder per session)
+    :param use_duplicates: if True, drop the sentences read in every session and save the table
+                           in duplicate_sentences_indices.csv (sentences_indices.csv otherwise)
+    :return: creates a table giving a common id to each sentence, as well as its sent_ident
+             and fif file within each session where it was read
+    """
     list_folders = [os.path.join(datapath, fold) for fold in os.listdir(datapath)
                     if os.path.isdir(os.path.join(datapath, fold))]
-    lfold = sorted([fold for fold in os.listdir(datapath) if os.path.isdir(os.path.join(datapath, fold))])
+    lfold = sorted([fold for fold in os.listdir(datapath) if os.path.isdir(os.path.join(datapath, fold))],
+                   key=_session_sort_key)
     fif_fold = [f"{fold}_fif_name" for fold in lfold]
 
-    list_sent_df = [pd.read_csv(os.path.join(fold,  "all_unique_sentences.csv")) for fold in list_folders]
-    sent_df = pd.concat(list_sent_df)
-    sent_occurences = dict(Counter(sent_df["sent_content"]))
-    sent_occurences = dict(sorted(sent_occurences.items(), key=lambda item: item[1], reverse=True))
+    list_sent_df = [pd.read_csv(os.path.join(fold, "all_unique_sentences.csv")) for fold in list_folders]
+    sent_df = pd.concat(list_sent_df, ignore_index=True)
+    sent_df["sent_key"] = _hash_sentences(sent_df["sent_content"]).to_numpy()
 
-    sentences_indices = pd.DataFrame(columns=["common_id", "sent_content", *lfold, *fif_fold])
+    # Number of occurrences of each sentence (in order of first appearance), sorted by decreasing occurrences
+    sent_occurences = sent_df.groupby("sent_key", sort=False).agg(sent_content=("sent_content", "first"),
+                                                                  occs=("sent_content", "size"))
+    sent_occurences = sent_occurences.iloc[np.argsort(-sent_occurences["occs"].to_numpy(), kind="stable")]
+    sent_occurences["common_id"] = [f"common_sent_{i}" for i in range(len(sent_occurences))]
+    if use_duplicates:
+        sent_occurences = sent_occurences[sent_occurences["occs"] != len(list_folders)]
 
-    for i, (sent, occs) in enumerate(sent_occurences.items()):
-        if use_duplicates and occs == len(list_folders):
-            continue
-        # Initialize the row to append to the csv
-        row = [f"common_sent_{i}", sent, *[""] * len(lfold), *[""] * len(fif_fold)]
-        # Get the sessions in which the sentence appears
-        sent_rows = sent_df[sent_df["sent_content"] == sent]
-        print(f"In sentence {i}: {occs} occurences")
-        for session in sent_rows["session_id"].values:
-            sess_id = int(session.split("_")[-1])
-            row[sess_id + 2] = sent_rows[sent_rows["session_id"] == session]["sent_ident"].values[0]
-            row[sess_id + 2 + len(lfold)] = sent_rows[sent_rows["session_id"] == session]["fif_file"].values[0]
-        sentences_indices.loc[len(sentences_indices)] = row
+    # sent_ident and fif file of each sentence within each session
+    sessions_df = sent_df.drop_duplicates(["sent_key", "session_id"])
+    sent_idents = sessions_df.pivot(index="sent_key", columns="session_id", values="sent_ident")
+    fif_files = sessions_df.pivot(index="sent_key", columns="session_id", values="fif_file")
+    fif_files.columns = [f"{session}_fif_name" for session in fif_files.columns]
+
+    sentences_indices = sent_occurences[["common_id", "sent_content"]].join(sent_idents).join(fif_files)
+    sentences_indices = sentences_indices.reindex(columns=["common_id", "sent_content", *lfold, *fif_fold])
+    sentences_indices = sentences_indices.fillna("").reset_index(drop=True)
 
     if use_duplicates:
         sentences_indices.to_csv(os.path.join(datapath, "duplicate_sentences_indices.csv"), index=False)
@@ -108,56 +111,140 @@ def label_all_sentences_from_sessions(datapath: str, use_duplicates: bool=False)
         sentences_indices.to_csv(os.path.join(datapath, "sentences_indices.csv"), index=False)
 
 
+def _sentence_files_exist(dest_folder: str, sent_common_id: str) -> bool:
+    return os.path.isfile(os.path.join(dest_folder, f"{sent_common_id}_eeg.npy")) and \
+        os.path.isfile(os.path.join(dest_folder, f"{sent_common_id}_labels.csv"))
+
+
+def _write_sentence_files(dest_folder: str, sent_common_id: str, sent_eeg: np.array, labels_df: pd.DataFrame):
+    os.makedirs(dest_folder, exist_ok=True)
+    # Write in temporary files so that an interrupted run never leaves a sentence half written
+    eeg_path = os.path.join(dest_folder, f"{sent_common_id}_eeg.npy")
+    labels_path = os.path.join(dest_folder, f"{sent_common_id}_labels.csv")
+    with open(eeg_path + ".tmp", "wb") as f:
+        np.save(f, sent_eeg)
+    labels_df.to_csv(labels_path + ".tmp", index=False)
+    os.replace(labels_path + ".tmp", labels_path)
+    os.replace(eeg_path + ".tmp", eeg_path)
+
+
+def _create_session_sentence_files(datapath: str,
+                                   session_folder: str,
+                                   session_sentences: pd.DataFrame,
+                                   storage: str = "npy") -> dict:
+    """
 
+    :param datapath: Path to the folder containing the data
+    :param session_folder: folder of the session (e.g. session_0)
+    :param session_sentences: table with columns (common_id, sent_ident, fif_file) of the sentences to write
+    :param storage: "npy" (one folder per sentence) or "store" (single SessionStore for the session)
+    :return: the number of sentences written and skipped (already written) for the session
+    """
+    session_path = os.path.join(datapath, session_folder)
+    store_writer = SessionStoreWriter(session_path) if storage == "store" else None
+
+    def is_written(sent_common_id: str) -> bool:
+        if store_writer is not None:
+            return sent_common_id in store_writer
+        return _sentence_files_exist(os.path.join(session_path, sent_common_id), sent_common_id)
+
+    n_written, n_skipped = 0, 0
+    for fif_file, fif_sentences in session_sentences.groupby("fif_file", sort=False):
+        # Skip the sentences that were already written
+        missing = np.array([not is_written(sent_common_id) for sent_common_id in fif_sentences["common_id"].values],
+                           dtype=bool)
+        n_skipped += int((~missing).sum())
+        fif_sentences = fif_sentences[missing]
+        if len(fif_sentences) == 0:
+            continue
 
-def create_sentence_level_files(datapath: str, process_duplicates: bool=False):
+        # Read the fif file once and extract all the sentences it contains
+        epochs = mne.read_epochs(os.path.join(session_path, fif_file), preload=True, verbose=50)
+        eeg_data = epochs.get_data()
+        metadata = epochs.metadata.reset_index(drop=True)
+        words_ids_per_sentence = metadata.groupby("sent_ident").indices
+
+        for sent_common_id, sent_ident in zip(fif_sentences["common_id"].values, fif_sentences["sent_ident"].values):
+            word_in_sent_ids = words_ids_per_sentence[sent_ident]
+            if store_writer is not None:
+                store_writer.append(sent_common_id, eeg_data[word_in_sent_ids], metadata.iloc[word_in_sent_ids])
+            else:
+                _write_sentence_files(os.path.join(session_path, sent_common_id), sent_common_id,
+                                      eeg_data[word_in_sent_ids], metadata.iloc[word_in_sent_ids])
+            n_written += 1
+        if store_writer is not None:
+            store_writer.flush()
+        del epochs, eeg_data
+
+    if store_writer is not None:
+        store_writer.close()
+    return {"session": session_folder, "written": n_written, "skipped": n_skipped}
+
+
+def convert_sentence_files_to_store(datapath: str, session_folder: str) -> None:
+    """
 
-    def retrieve_session_id_from_name(filename: str):
-        return filename.split("_")[1]
+    :param datapath: Path to the folder containing the data
+    :param session_folder: folder of the session (e.g. session_0)
+    :return: packs the per-sentence npy/csv files of the session (created by create_sentence_level_files
+             with storage="npy") into the session's SessionStore
+    """
+    session_path = os.path.join(datapath, session_folder)
+    list_sent_ids = sorted(fold for fold in os.listdir(session_path)
+                           if _sentence_files_exist(os.path.join(session_path, fold), fold))
+    with SessionStoreWriter(session_path) as store_writer:
+        for sent_common_id in tqdm(list_sent_ids, desc=f"Packing {session_folder}"):
+            if sent_common_id in store_writer:
+                continue
+            dest_folder = os.path.join(session_path, sent_common_id)
+            store_writer.append(sent_common_id,
+                                np.load(os.path.join(dest_folder, f"{sent_common_id}_eeg.npy")),
+                                pd.read_csv(os.path.join(dest_folder, f"{sent_common_id}_labels.csv")))
+
+
+def create_sentence_level_files(datapath: str,
+                                process_duplicates: bool = False,
+                                num_workers: int = None,
+                                storage: str = "npy"):
+    """
 
-    # def retrieve_fif_file_from_sent_id(sent_name_id: str):
-        # sess_0_newsgroup-groups.google.com_hiddennook_f50294175d32a8ac_ENG_20041120_152800.txt_sent_40
+    :param datapath: Path to the folder containing the data
+    :param process_duplicates: whether to process the duplicate sentences (duplicate_sentences_indices.csv)
+                               or the unique sentences (sentences_indices.csv)
+    :param num_workers: number of processes (one session per process), defaults to the number of cpus
+    :param storage: "npy" or "store" (see SessionStore)
+    :return: writes {sent_common_id}_eeg.npy and {sent_common_id}_labels.csv in session_folder/sent_common_id
+             (or appends the sentence to the session's SessionStore), every fif file being read only once.
+             Sentences already written are skipped.
+    """
     if process_duplicates:
         all_sentence_labels = pd.read_csv(os.path.join(datapath, "duplicate_sentences_indices.csv"))
-        all_sentence_labels.fillna("", inplace=True)
     else:
         all_sentence_labels = pd.read_csv(os.path.join(datapath, "sentences_indices.csv"))
-    #
-    # list_folders = [os.path.join(datapath, fold) for fold in os.listdir(datapath)
-    #                 if os.path.isdir(os.path.join(datapath, fold))]
+    all_sentence_labels.fillna("", inplace=True)
 
     session_cols = sorted([fold for fold in all_sentence_labels.columns
                            if fold.startswith("session") and not fold.endswith("_fif_name")])
-    session_fif_cols = sorted([fold for fold in all_sentence_labels.columns
-                               if fold.startswith("session") and fold.endswith("_fif_name")])
-
-    for i, row in tqdm(all_sentence_labels.iterrows()):
-        sent_common_id = row["common_id"]
-        # if i < 109:
-        #     continue
-        print("\nSentence ", row[0])
-        for sess_name, fif_id in zip(session_cols, session_fif_cols):
-            if sess_name != "" or len(sess_name) > 0:
-                session_folder = f"session_{retrieve_session_id_from_name(sess_name)}"
-                if row[fif_id] != "nan" and row[fif_id] != "":
-
-                    # Create the sentence folder if it does not exist
-                    dest_folder = os.path.join(datapath, session_folder, sent_common_id)
-                    os.makedirs(dest_folder, exist_ok=True)
-
-                    # Retrieve the data in the right fif file and extract the sentence-wise data
-                    # print(f"Row contains {row[fif_id]}")
-                    fif_name = os.path.join(datapath, session_folder, row[fif_id])
-                    epochs = mne.read_epochs(fif_name, preload=True, verbose=50)
-                    eeg_data = epochs.get_data()
-
-                    epochs.metadata.index = range(len(epochs.metadata))
-                    labels_df = epochs.metadata[epochs.metadata["sent_ident"] == row[sess_name]]
-                    word_in_sent_ids = labels_df.index.to_numpy()
-
-                    sent_eeg = eeg_data[word_in_sent_ids]
-                    np.save(os.path.join(dest_folder, f"{sent_common_id}_eeg.npy"), sent_eeg)
-                    labels_df.to_csv(os.path.join(dest_folder, f"{sent_common_id}_labels.csv"), index=False)
+
+    # One row per (sentence, session) in which the sentence was read
+    list_session_sentences = []
+    for sess_name in session_cols:
+        session_sentences = pd.DataFrame({"common_id": all_sentence_labels["common_id"].values,
+                                          "sent_ident": all_sentence_labels[sess_name].astype(str).values,
+                                          "fif_file": all_sentence_labels[f"{sess_name}_fif_name"].astype(str).values})
+        session_sentences = session_sentences[~session_sentences["fif_file"].isin(["", "nan"])]
+        if len(session_sentences) > 0:
+            list_session_sentences.append((sess_name, session_sentences))
+
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = [executor.submit(_create_session_sentence_files, datapath, session_folder, session_sentences, storage)
+                   for session_folder, session_sentences in list_session_sentences]
+        progress = tqdm(as_completed(futures), total=len(futures), desc="Creating sentence-level files")
+        for future in progress:
+            report = future.result()
+            progress.write(f"{report['session']}: {report['written']} sentences written, "
+                           f"{report['skipped']} already existing")
+
 
 def convert_data_from_fif_to_npy_and_csv(datapath: str, session_folder: str, filename: str) -> None:
     """
@@ -0,0 +1,124 @@
+import os
+from typing import Dict, Iterable, List, Tuple
+
+import h5py
+import numpy as np
+import pandas as pd
+
+STORE_NAME = "session_store.h5"
+INDEX_NAME = "session_store_index.csv"
+
+
+class SessionStore:
+    """
+    Consolidated storage of the sentence-level EEG data of a single session:
+        - session_store.h5: chunked array "eeg" of shape (n_words, n_channels, n_timesteps)
+          holding the words of all the sentences one after the other
+        - session_store_index.csv: one row per word, with the sentence common_id, the row
+          of the word in the "eeg" array (offset) and the word metadata
+    """
+
+    def __init__(self, session_path: str):
+        self.session_path = session_path
+        self.store_path = os.path.join(session_path, STORE_NAME)
+        self.index_path = os.path.join(session_path, INDEX_NAME)
+        self.index = pd.read_csv(self.index_path) if os.path.isfile(self.index_path) else None
+        self._sentence_rows = {} if self.index is None else self.index.groupby("common_id", sort=False).indices
+
+    @staticmethod
+    def exists(session_path: str) -> bool:
+        return os.path.isfile(os.path.join(session_path, STORE_NAME)) and \
+            os.path.isfile(os.path.join(session_path, INDEX_NAME))
+
+    def __contains__(self, sent_id: str) -> bool:
+        return sent_id in self._sentence_rows
+
+    @property
+    def sentence_ids(self) -> List[str]:
+        return list(self._sentence_rows.keys())
+
+    def read_sentences(self, sent_ids: Iterable[str], max_gap: int = 256) -> Dict[str, Tuple[np.array, pd.DataFrame]]:
+        """
+
+        :param sent_ids: common ids of the sentences to read (those missing from the session are ignored)
+        :param max_gap: rows separated by less than max_gap unused rows are read in the same request
+        :return: {sent_id: (eeg of shape (n_words, n_channels, n_timesteps), word metadata)}
+        """
+        sent_ids = [sent_id for sent_id in sent_ids if sent_id in self]
+        if len(sent_ids) == 0:
+            return {}
+        offsets = np.sort(np.concatenate([self.index["offset"].values[self._sentence_rows[sent_id]]
+                                          for sent_id in sent_ids]))
+
+        # Coalesce the rows into a few large contiguous reads
+        breaks = np.where(np.diff(offsets) - 1 > max_gap)[0] + 1
+        runs = [(run[0], run[-1] + 1) for run in np.split(offsets, breaks)]
+        with h5py.File(self.store_path, "r") as f:
+            eeg_runs = [(start, f["eeg"][start:stop]) for start, stop in runs]
+
+        data = {}
+        run_starts = np.array([start for start, _ in eeg_runs])
+        for sent_id in sent_ids:
+            labels_df = self.index.iloc[self._sentence_rows[sent_id]]
+            sent_offsets = labels_df["offset"].values
+            run_id = np.searchsorted(run_starts, sent_offsets[0], side="right") - 1
+            start, eeg_run = eeg_runs[run_id]
+            data[sent_id] = (eeg_run[sent_offsets - start],
+                             labels_df.drop(columns=["common_id", "offset"]).reset_index(drop=True))
+        return data
+
+
+class SessionStoreWriter:
+    """
+    Appends sentences to the SessionStore of a session. Sentences already in the store are skipped,
+    the index being re-written (atomically) after each flush.
+    """
+
+    def __init__(self, session_path: str, chunk_words: int = 64):
+        self.session_path = session_path
+        self.chunk_words = chunk_words
+        self.store_path = os.path.join(session_path, STORE_NAME)
+        self.index_path = os.path.join(session_path, INDEX_NAME)
+        index = pd.read_csv(self.index_path) if os.path.isfile(self.index_path) else None
+        self.list_index = [] if index is None else [index]
+        self.n_words = 0 if index is None else len(index)
+        self.written_ids = set() if index is None else set(index["common_id"].unique())
+        self.file = h5py.File(self.store_path, "a")
+
+    def __contains__(self, sent_id: str) -> bool:
+        return sent_id in self.written_ids
+
+    def append(self, sent_id: str, eeg: np.array, labels_df: pd.DataFrame):
+        if sent_id in self:
+            return
+        if "eeg" not in self.file:
+            self.file.create_dataset("eeg", shape=(0, *eeg.shape[1:]), maxshape=(None, *eeg.shape[1:]),
+                                     dtype=eeg.dtype, chunks=(self.chunk_words, *eeg.shape[1:]))
+        dset = self.file["eeg"]
+        # Rows beyond the index (interrupted run) are overwritten
+        dset.resize(self.n_words + len(eeg), axis=0)
+        dset[self.n_words:self.n_words + len(eeg)] = eeg
+
+        labels_df = labels_df.reset_index(drop=True)
+        labels_df.insert(0, "offset", np.arange(self.n_words, self.n_words + len(eeg)))
+        labels_df.insert(0, "common_id", sent_id)
+        self.list_index.append(labels_df)
+        self.n_words += len(eeg)
+        self.written_ids.add(sent_id)
+
+    def flush(self):
+        self.file.flush()
+        if len(self.list_index) > 0:
+            self.list_index = [pd.concat(self.list_index, ignore_index=True)]
+            self.list_index[0].to_csv(self.index_path + ".tmp", index=False)
+            os.replace(self.index_path + ".tmp", self.index_path)
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
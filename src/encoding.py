@@ -0,0 +1,127 @@
+import os
+
+import hydra
+import matplotlib
+import numpy as np
+
+from src.analysis import (
+    compute_layer_encoding,
+    encoding_window_cube,
+    get_model,
+    get_model_layers_representations
+)
+from src.dataset import get_dataset, project_3d_coordinates_in_plan
+from src.sweep import LEVENSHTEIN_REPRS, build_label_table, get_band_names, select_label_ids
+
+
+def build_result_name(shortname: str, label: str, band: str, window: dict = None) -> str:
+    name = f"enc_{shortname}_{label}"
+    if window is not None:
+        name += f"_t{window['timesteps']}_p{window['pad_step']}"
+    return name if band is None else f"{name}_{band}"
+
+
+def matches_parameters(encoding: dict, layers: list, alphas: np.array, enc_config) -> bool:
+    """ Whether a saved encoding was fitted with the layers, alphas, folds and scaling of the current config """
+    if "alpha_grid" not in encoding:
+        return False
+    return ([int(layer) for layer in encoding["layers"]] == [int(layer) for layer in layers]
+            and np.array_equal(encoding["alpha_grid"], alphas)
+            and int(encoding["n_folds"]) == enc_config.n_folds
+            and int(encoding["seed"]) == enc_config.seed
+            and bool(encoding["standardize"]) == enc_config.standardize)
+
+
+def get_window_titles(starts: list, timesteps: int, sfreq: float = None) -> list:
+    if sfreq is None:
+        return [f"{start} to {start + timesteps - 1}" for start in starts]
+    return [f"{int(start * 1000 / sfreq)} to {int((start + timesteps - 1) * 1000 / sfreq)} ms" for start in starts]
+
+
+def save_figures(cube: np.array, window_titles: list, electrodes: dict, shortname: str, dataname: str, name: str,
+                 dest_folder: str, vis_config):
+    from src.vis import get_topomap_interpolator, render_layer_figures
+
+    # The layer figures are grids of topomaps: a single layer cannot be laid out
+    if cube.shape[1] < 2:
+        return
+    os.makedirs(dest_folder, exist_ok=True)
+    vmax = float(np.nanmax(np.abs(cube))) if np.isfinite(cube).any() else 1.
+    render_layer_figures(electrodes["pos"], electrodes["names"], cube, window_titles, shortname, dataname, vis_config,
+                         dest_folder, file_prefix=name,
+                         interpolator=get_topomap_interpolator(electrodes["pos"][:, :2], grid_res=vis_config.grid_res),
+                         value_range=(-vmax, vmax))
+
+
+@hydra.main(config_path='../configs', config_name='encoding')
+def main(config):
+    matplotlib.use("Agg")
+    enc_config = config.encoding
+    alphas = np.logspace(enc_config.alphas.min, enc_config.alphas.max, enc_config.alphas.num)
+
+    for dataname in config.grid.datasets:
+        data_config = config.datasets[dataname].copy()
+        data_config.labels = None
+        dataset = get_dataset(data_config, None, dataname)
+        electrodes = {"names": list(dataset.channels["#NAME"]),
+                      "pos": project_3d_coordinates_in_plan(dataset.channels[["X", "Y", "Z"]].to_numpy())}
+        label_table = build_label_table(dataset, dataname)
+        sfreq = data_config.get("sfreq", None)
+
+        for repr_config in config.grid.representations:
+            if repr_config.name in LEVENSHTEIN_REPRS:
+                continue
+            # All the layers in one pass over the words, shared by the labels, bands and windows, only computed
+            # if an encoding is missing
+            features = {}
+
+            for label in config.grid.labels[dataname]:
+                label_ids = select_label_ids(label_table, label)
+                result_folder = os.path.join(config.save_folder, dataname, label, "npz")
+                os.makedirs(result_folder, exist_ok=True)
+                for band_id, band in enumerate(get_band_names(data_config)):
+                    name = build_result_name(repr_config.shortname, label, band)
+                    result_path = os.path.join(result_folder, f"{name}.npz")
+                    encoding = None
+                    if os.path.isfile(result_path) and not config.overwrite:
+                        encoding = dict(np.load(result_path))
+                        if not matches_parameters(encoding, list(config.grid.layers), alphas, enc_config):
+                            print(f"{result_path} was fitted with other parameters, refitting it")
+                            encoding = None
+                    if encoding is None:
+                        if len(features) == 0:
+                            print(f"\nComputing the {repr_config.shortname} representations of {len(dataset.words)}"
+                                  f" words")
+                            model, tokenizer = get_model(repr_config.name)
+                            features = get_model_layers_representations(list(dataset.words), model,
+                                                                        list(config.grid.layers), tokenizer)
+                        eeg = dataset.eeg[:, band_id] if dataset.eeg.ndim == 4 else dataset.eeg
+                        print(f"Encoding {dataname} {name} ({len(label_ids)} words, {len(alphas)} alphas)")
+                        encoding = compute_layer_encoding({layer: layer_features[label_ids]
+                                                           for layer, layer_features in features.items()},
+                                                          eeg[label_ids],
+                                                          alphas,
+                                                          n_folds=enc_config.n_folds,
+                                                          seed=enc_config.seed,
+                                                          num_workers=enc_config.num_workers,
+                                                          standardize=enc_config.standardize)
+                        np.savez(result_path, channels=np.array(electrodes["names"]), alpha_grid=alphas,
+                                 n_folds=enc_config.n_folds, seed=enc_config.seed,
+                                 standardize=enc_config.standardize, **encoding)
+
+                    # The fits do not depend on the windows: the R^2 of each timestep is averaged over the windows
+                    for window in config.grid.windows:
+                        cube = encoding_window_cube(encoding["r2"], timesteps=window.timesteps,
+                                                    pad_step=window.pad_step)
+                        window_name = build_result_name(repr_config.shortname, label, band, window)
+                        np.savez(os.path.join(result_folder, f"{window_name}.npz"), layers=encoding["layers"],
+                                 channels=np.array(electrodes["names"]), **cube)
+                        if enc_config.figures:
+                            save_figures(cube["r2"], get_window_titles(cube["starts"], window.timesteps, sfreq),
+                                         electrodes, repr_config.shortname, dataname, window_name,
+                                         os.path.join(config.save_folder, dataname, label, "image"), config.vis)
+    print("Encoding computed !")
+
+
+if __name__ == '__main__':
+    main()
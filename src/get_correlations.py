@@ -1,17 +1,23 @@
 import argparse
 import os.path
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import pandas as pd
 
 from src.config import Config as cfg
-from src.utils import read_table, parse_table_labels
+from src.utils import read_table, parse_table_labels, enable_profiling, disable_profiling, stage
 from src.analysis import (
     all_pairs,
-    get_model_representations,
-    compute_all_representations_distances,
     compute_all_dl_distance,
-    compute_correlations
+    compute_correlations_streamed,
+    compute_covariate_rdms,
+    compute_rdm,
+    confound_columns,
+    load_word_covariates,
+    KILOWORD_COVARIATES,
+    compute_streamed_word_rdms,
+    iter_model_representations
 )
 from src.evaluation import CorrelationsTable
 
@@ -37,6 +43,8 @@ def arg_parser():
                         help="File containing the annotations")
     parser.add_argument("--use_model_cache", action="store_true", default=True,
                         help="whether to load pre-computed word representations or not")
+    parser.add_argument("--no_model_cache", dest="use_model_cache", action="store_false",
+                        help="compute the word representations with the model")
     parser.add_argument("--eeg_path", type=str, default=cfg.DATA,
                         help="File containing the EEG recordings")
     parser.add_argument("--word_dist_repr", type=str, default="bert",
@@ -58,13 +66,124 @@ def arg_parser():
                         help="padding step")
     parser.add_argument("--timesteps", type=int, default=31,
                         help="duration of the eeg signals extracted")
+    parser.add_argument("--batch_size", type=int, default=32,
+                        help="words per feature batch sent from the model to the word distances")
+    parser.add_argument("--queue_size", type=int, default=4,
+                        help="maximum number of batches / windows waiting between two stages")
+    parser.add_argument("--confounds", action="store_true", default=False,
+                        help="add the partial correlations and the regression on the covariate RDMs to the table")
+    parser.add_argument("--metadata_path", type=str,
+                        default=os.path.join(os.path.dirname(__file__), "..", "data", "kiloword_metadata.csv"),
+                        help="File containing the covariates of the words")
+    parser.add_argument("--covariates", type=str, nargs="+", default=KILOWORD_COVARIATES,
+                        help="covariates whose RDMs are confounds")
+    parser.add_argument("--profile", action="store_true", default=False,
+                        help="write a per-stage timing/memory report in {save_folder}/profile")
     return parser.parse_args()
 
 
 def main(args):
+    if args.profile:
+        enable_profiling()
+    with stage("get_correlations"):
+        _main(args)
+    if args.profile:
+        profiler = disable_profiling()
+        report_path = os.path.join(args.save_folder, "profile", args.tab_name.replace(".csv", ".json"))
+        profiler.save(report_path)
+        print(f"Profile saved to {report_path}")
+
+
+def _load_eeg_signals(eeg_path: str, list_words: np.array) -> tuple:
+    # Download the EEG data and drop non-useful info
+    with stage("load_eeg_csv"):
+        eeg_data = read_table(eeg_path)
+
+    with stage("build_eeg_cube"):
+        grouped_data = eeg_data.groupby("WORD")
+        list_eegs = []
+        for word in list_words:
+            da = grouped_data.get_group(word)
+            da = da[~da['ELECNAME'].isin(["REJ1", "REJ2", "REJ3"])]
+            d = da.drop(columns=['WORD#', 'WORD', 'ELEC#', 'ELECNAME']).to_numpy()
+            list_eegs.append(d)
+        eeg_signals = np.stack(list_eegs)
+
+    list_electrodes = pd.unique(eeg_data["ELECNAME"])[3:]
+    return eeg_signals, list_electrodes
+
+
+def _get_model(word_dist_repr: str) -> tuple:
+    if word_dist_repr == "bert":
+        from transformers import BertTokenizer, BertConfig, BertModel
+        tokenizer = BertTokenizer.from_pretrained("bert-base-uncased")
+        model = BertModel.from_pretrained("bert-base-uncased")
+    elif word_dist_repr == "bert_random":
+        from transformers import BertTokenizer, BertConfig, BertModel
+        tokenizer = BertTokenizer.from_pretrained("bert-base-uncased")
+        model = BertModel(BertConfig())
+    elif word_dist_repr == "canine_s":
+        from transformers import CanineTokenizer, CanineConfig, CanineModel
+        tokenizer = CanineTokenizer.from_pretrained("google/canine-s")
+        model = CanineModel.from_pretrained("google/canine-s")
+    elif word_dist_repr == "canine_c":
+        from transformers import CanineTokenizer, CanineConfig, CanineModel
+        tokenizer = CanineTokenizer.from_pretrained("google/canine-c")
+        model = CanineModel.from_pretrained("google/canine-s")
+    elif word_dist_repr == "canine_s_random":
+        from transformers import CanineTokenizer, CanineConfig, CanineModel
+        tokenizer = CanineTokenizer.from_pretrained("google/canine-s")
+        model = CanineModel(CanineConfig())
+    elif word_dist_repr == "canine_c_random":
+        from transformers import CanineTokenizer, CanineConfig, CanineModel
+        tokenizer = CanineTokenizer.from_pretrained("google/canine-c")
+        model = CanineModel(CanineConfig())
+    else:
+        raise ValueError(f"No model for {word_dist_repr} (use the cached representations)")
+    return model, tokenizer
+
+
+def _compute_word_rdms(args, list_words: np.array, all_ids: np.array) -> dict:
+    """
+
+    :return: {"levenshtein": rdm} or {"cosine": rdm, "l2": rdm}, in the order of all_pairs(list_words)
+    """
+    if args.word_dist_repr == "levenshtein":
+        with stage("word_distances"):
+            return {"levenshtein": np.asarray(compute_all_dl_distance(all_pairs(list_words), normalize=True))}
+    elif args.word_dist_repr == "levenshtein_ipa":
+        import eng_to_ipa as ipa
+        with stage("word_distances"):
+            list_ipa_words = [ipa.convert(word) for word in list_words]
+            return {"levenshtein": np.asarray(compute_all_dl_distance(all_pairs(list_ipa_words), normalize=True))}
+
+    if args.use_model_cache:
+        with stage("word_features"):
+            if "random" in args.word_dist_repr:
+                word_features = np.load(
+                    os.path.join(args.save_folder,
+                                 "word_features",
+                                 f"kiloword_random_{args.word_dist_repr.split('_random')[0].split('random_')[0]}_features.npy"))[all_ids]
+            else:
+                word_features = np.load(
+                    os.path.join(args.save_folder, "word_features",
+                                 f"kiloword_trained_{args.word_dist_repr}_features.npy"))[all_ids]
+        print("\n\n\n\n", word_features.shape)
+        with stage("word_distances"):
+            return {"cosine": compute_rdm(word_features, norm="cosine"), "l2": compute_rdm(word_features, norm="l2")}
+
+    # The word distances of each batch of features are computed while the model processes the next words
+    model, tokenizer = _get_model(args.word_dist_repr)
+    batches = iter_model_representations(list(list_words), model, tokenizer=tokenizer, batch_size=args.batch_size)
+    with stage("word_features"):
+        return compute_streamed_word_rdms(batches, len(list_words), queue_size=args.queue_size)
+
+
+def _main(args):
     # Download the labels
-    labels = read_table(args.labels_path)
-    labels_table = parse_table_labels(labels, LIST_LABELS, labelcolname="SEMANTIC_FIELD")
+    with stage("load_labels"):
+        labels = read_table(args.labels_path)
+        labels_table = parse_table_labels(labels, LIST_LABELS, labelcolname="SEMANTIC_FIELD")
 
     all_ids = np.arange(len(labels))
 
@@ -82,8 +201,6 @@ def main(args):
     args.tab_name = "_".join([args.word_dist_repr, args.tab_name])
     # Get the list of words and their pairs
     list_words = labels["WORD"].values[all_ids]
-    list_paired_words = all_pairs(list_words)
-    list_paired_indices = all_pairs(range(len(list_words)))
 
     if args.focus_label is not None:
         corr_save_folder = os.path.join(args.save_folder, args.focus_label)
@@ -95,95 +212,34 @@ def main(args):
     corr_save_folder = os.path.join(corr_save_folder, "csv")
     os.makedirs(corr_save_folder, exist_ok=True)
 
+    # Confound RDMs (absolute differences of the covariates of the words)
+    confound_rdms = None
+    table_columns = list(args.tab_attrs)
+    if args.confounds:
+        confound_rdms = compute_covariate_rdms(load_word_covariates(args.metadata_path, list_words, args.covariates))
+        table_columns += confound_columns(args.covariates)
+
     # Initialize Experiment table
     corr = CorrelationsTable(name=args.tab_name,
                              table_folder=corr_save_folder,
-                             table_columns=args.tab_attrs)
-
-    # Download the EEG data and drop non-useful info
-    eeg_data = read_table(args.eeg_path)
-
-    grouped_data = eeg_data.groupby("WORD")
-    list_eegs = []
-    for word in list_words:
-        da = grouped_data.get_group(word)
-        da = da[~da['ELECNAME'].isin(["REJ1", "REJ2", "REJ3"])]
-        d = da.drop(columns=['WORD#', 'WORD', 'ELEC#', 'ELECNAME']).to_numpy()
-        list_eegs.append(d)
-    eeg_signals = np.stack(list_eegs)
-
-    list_electrodes = pd.unique(eeg_data["ELECNAME"])[3:]
-
-    dl_word_distances = None
-    cosine_word_distances = None
-    l2_word_distances = None
-
-    if args.word_dist_repr == "levenshtein":
-        dl_word_distances = compute_all_dl_distance(list_paired_words, normalize=True)
-    elif args.word_dist_repr == "levenshtein_ipa":
-        import eng_to_ipa as ipa
-        list_ipa_words = [ipa.convert(word) for word in list_words]
-        list_paired_ipa_words = all_pairs(list_ipa_words)
-        dl_word_distances = compute_all_dl_distance(list_paired_ipa_words, normalize=True)
-    else:
-        if args.use_model_cache:
-            if "random" in args.word_dist_repr:
-                word_features = np.load(
-                    os.path.join(args.save_folder,
-                                 "word_features",
-                                 f"kiloword_random_{args.word_dist_repr.split('_random')[0].split('random_')[0]}_features.npy"))[all_ids]
-            else:
-                word_features = np.load(
-                    os.path.join(args.save_folder, "word_features",
-                                 f"kiloword_trained_{args.word_dist_repr}_features.npy"))[all_ids]
+                             table_columns=table_columns)
 
-        else:
-            if args.word_dist_repr == "bert":
-                from transformers import BertTokenizer, BertConfig, BertModel
-                tokenizer = BertTokenizer.from_pretrained("bert-base-uncased")
-                model = BertModel.from_pretrained("bert-base-uncased")
-            elif args.word_dist_repr == "bert_random":
-                from transformers import BertTokenizer, BertConfig, BertModel
-                tokenizer = BertTokenizer.from_pretrained("bert-base-uncased")
-                model = BertModel(BertConfig())
-            elif args.word_dist_repr == "canine_s":
-                from transformers import CanineTokenizer, CanineConfig, CanineModel
-                tokenizer = CanineTokenizer.from_pretrained("google/canine-s")
-                model = CanineModel.from_pretrained("google/canine-s")
-            elif args.word_dist_repr == "canine_c":
-                from transformers import CanineTokenizer, CanineConfig, CanineModel
-                tokenizer = CanineTokenizer.from_pretrained("google/canine-c")
-                model = CanineModel.from_pretrained("google/canine-s")
-            elif args.word_dist_repr == "canine_s_random":
-                from transformers import CanineTokenizer, CanineConfig, CanineModel
-                tokenizer = CanineTokenizer.from_pretrained("google/canine-s")
-                model = CanineModel(CanineConfig())
-
-            elif args.word_dist_repr == "canine_c_random":
-                from transformers import CanineTokenizer, CanineConfig, CanineModel
-                tokenizer = CanineTokenizer.from_pretrained("google/canine-c")
-                model = CanineModel(CanineConfig())
-
-            word_features = get_model_representations(list_words, model, tokenizer)
+    # The EEG data is loaded in the background while the word distances are computed
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        eeg_future = executor.submit(_load_eeg_signals, args.eeg_path, list_words)
+        word_rdms = _compute_word_rdms(args, list_words, all_ids)
+        eeg_signals, list_electrodes = eeg_future.result()
 
-        print("\n\n\n\n", word_features.shape)
-        if len(word_features.shape) == 3:
-            word_features = word_features.squeeze(1)
-        cosine_word_distances = compute_all_representations_distances(word_features,
-                                                                      list_paired_indices,
-                                                                      norm="cosine")
-        l2_word_distances = compute_all_representations_distances(word_features,
-                                                                  list_paired_indices)
-
-    compute_correlations(eeg_signals,
-                         cosine_word_distances,
-                         l2_word_distances,
-                         dl_word_distances,
-                         list_paired_indices,
-                         list_electrodes,
-                         corr,
-                         pad_step=args.pad_step,
-                         timesteps=args.timesteps)
+    # EEG distances, correlations and table writes overlap (bounded queues between the stages)
+    with stage("compute_correlations"):
+        compute_correlations_streamed(eeg_signals,
+                                      word_rdms,
+                                      list_electrodes,
+                                      corr,
+                                      pad_step=args.pad_step,
+                                      timesteps=args.timesteps,
+                                      queue_size=args.queue_size,
+                                      confound_rdms=confound_rdms)
 
     print("DONE")
 
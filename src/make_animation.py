@@ -14,7 +14,8 @@ def main(cfg: DictConfig) -> None:
     save_path = os.path.join(cfg.destpath, cfg.data.dataname, "image", cfg.corr, cfg.distance)
     os.makedirs(save_path, exist_ok=True)
 
-    output_path = create_valid_gif(save_path, cfg.label_name, cfg.model.shortname, over_layers=True)
+    output_path = create_valid_gif(save_path, model_name=cfg.model.shortname, labels=cfg.label_name,
+                                   over_layers=True, extension=cfg.extension, fps=cfg.fps)
     logger.info(f"Animation saved to {output_path} ")
 
 
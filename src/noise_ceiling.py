@@ -0,0 +1,111 @@
+import os
+import shutil
+
+import hydra
+import matplotlib
+import numpy as np
+
+from src.analysis import compute_noise_ceiling
+from src.dataset import get_dataset, project_3d_coordinates_in_plan
+from src.sweep import build_label_table, get_band_names, select_label_ids
+from src.utils import split_into_chunks
+
+
+def build_result_name(label: str, window: dict, band: str) -> str:
+    name = f"nc_{label}_t{window['timesteps']}_p{window['pad_step']}"
+    return name if band is None else f"{name}_{band}"
+
+
+def spill_sessions(dataset, session_folder: str) -> tuple:
+    """
+
+    :return: the paths of the EEG of each session (saved one session at a time) and the mask of the words recorded in
+             all the sessions
+    """
+    os.makedirs(session_folder, exist_ok=True)
+    session_paths, complete = [], np.ones(len(dataset.eeg), dtype=bool)
+    for folder, session_eeg in dataset.iter_session_signals():
+        session_paths.append(os.path.join(session_folder, f"{folder}.npy"))
+        np.save(session_paths[-1], session_eeg)
+        complete &= ~np.isnan(session_eeg.reshape(len(session_eeg), -1)).any(axis=1)
+    return session_paths, complete
+
+
+def save_figures(ceiling: dict, electrodes: dict, times: list, name: str, dest_folder: str, vis_config: dict):
+    from src.vis import plot_2d_topomap
+
+    os.makedirs(dest_folder, exist_ok=True)
+    for key, values in ceiling.items():
+        if key in ["starts", "n_sessions"]:
+            continue
+        vmax = float(np.nanmax(np.abs(values))) if np.isfinite(values).any() else 1.
+        values = split_into_chunks(list(values), vis_config.chunk_size)
+        plot_2d_topomap(electrodes["pos"][:, :2], values, dataname="ubira", grid_res=vis_config.grid_res,
+                        rows=len(values), cols=len(values[0]), size=vis_config.size, edgecolor=vis_config.edgecolor,
+                        subfig_name=split_into_chunks([f"{time:.0f} ms" for time in times], vis_config.chunk_size),
+                        coords_name=electrodes["names"], dpi=vis_config.dpi, title=f"{key} {name}",
+                        vmin=-vmax, vmax=vmax, savepath=os.path.join(dest_folder, f"{key}_{name}.png"))
+
+
+@hydra.main(config_path='../configs', config_name='noise_ceiling')
+def main(config):
+    matplotlib.use("Agg")
+    nc_config = config.noise_ceiling
+    dtype = np.float32 if nc_config.float32 else np.float64
+
+    data_config = config.datasets.ubira.copy()
+    data_config.labels = None
+    dataset = get_dataset(data_config, None, "ubira")
+    list_electrodes = list(dataset.channels["#NAME"])
+    electrodes = {"names": list_electrodes,
+                  "pos": project_3d_coordinates_in_plan(dataset.channels[["X", "Y", "Z"]].to_numpy())}
+    label_table = build_label_table(dataset, "ubira")
+
+    # The sessions are read (and their power computed) once, then streamed from disk by each noise ceiling
+    session_folder = os.path.join(config.save_folder, "ubira", "sessions")
+    session_paths, complete = spill_sessions(dataset, session_folder)
+    print(f"{len(session_paths)} sessions, {complete.sum()} / {len(complete)} words recorded in all the sessions")
+
+    for label in config.grid.labels.ubira:
+        label_ids = select_label_ids(label_table, label)
+        n_label_words = len(label_ids)
+        label_ids = label_ids[complete[label_ids]]
+        result_folder = os.path.join(config.save_folder, "ubira", label, "npz")
+        os.makedirs(result_folder, exist_ok=True)
+        for band_id, band in enumerate(get_band_names(data_config)):
+
+            def sessions():
+                for path in session_paths:
+                    session_eeg = np.load(path, mmap_mode="r")
+                    session_eeg = session_eeg[:, band_id] if session_eeg.ndim == 4 else session_eeg
+                    yield np.asarray(session_eeg[label_ids])
+
+            for window in config.grid.windows:
+                name = build_result_name(label, window, band)
+                result_path = os.path.join(result_folder, f"{name}.npz")
+                if os.path.isfile(result_path) and not config.overwrite:
+                    continue
+                print(f"Noise ceiling {name} ({len(label_ids)} / {n_label_words} words)")
+                ceiling = compute_noise_ceiling(sessions,
+                                                timesteps=window.timesteps,
+                                                pad_step=window.pad_step,
+                                                norms=tuple(nc_config.norms),
+                                                dtype=dtype)
+                # Words, windows and band of the ceiling, checked before normalizing correlations (see render.yaml)
+                np.savez(result_path, channels=np.array(list_electrodes), word_ids=label_ids,
+                         words=np.asarray(dataset.words)[label_ids], n_label_words=n_label_words, label=label,
+                         n_sentences=data_config.n_sentences, band=band or "", timesteps=window.timesteps,
+                         pad_step=window.pad_step, **ceiling)
+
+                if nc_config.figures:
+                    times = np.array(ceiling["starts"]) * 1000 / data_config.sfreq
+                    save_figures(ceiling, electrodes, list(times), name,
+                                 os.path.join(config.save_folder, "ubira", label, "image"), config.vis)
+
+    if not nc_config.keep_sessions:
+        shutil.rmtree(session_folder)
+    print("Noise ceiling computed !")
+
+
+if __name__ == '__main__':
+    main()
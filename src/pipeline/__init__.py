@@ -0,0 +1,3 @@
+from .graph import ArtifactStore, Node, Pipeline, source_fingerprint
+from .stages import build_correlation_pipeline
+from .work_queue import WorkQueue, SweepJobRunner, build_sweep_jobs, run_worker, run_local_workers
@@ -0,0 +1,215 @@
+import os
+import pickle
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+from tqdm import tqdm
+
+from src.utils import hash_content
+
+
+def source_fingerprint(path: str) -> List[tuple]:
+    """ Cheap fingerprint of raw data: (name, size, mtime) of the files of a folder (not recursive) or of a file """
+    if os.path.isfile(path):
+        stat = os.stat(path)
+        return [(os.path.basename(path), stat.st_size, stat.st_mtime_ns)]
+    if not os.path.isdir(path):
+        return []
+    return sorted((entry.name, entry.stat().st_size, entry.stat().st_mtime_ns) for entry in os.scandir(path))
+
+
+class Node:
+    """
+    Stage of the pipeline: output = fn(*[outputs of deps], **params).
+
+    :param name: unique name of the node (e.g. "word_rdm:kiloword:MONEY:bert")
+    :param deps: names of the nodes whose outputs are the inputs of fn
+    :param params: parameters of fn, part of the fingerprint of the output
+    :param version: bump when fn changes to invalidate the stored outputs
+    :param persist: store the output (otherwise it is recomputed whenever a stale node needs it)
+    :param produces_files: the output is a list of file paths, the node is stale if one of them is missing
+    :param lock: nodes sharing a lock never run concurrently (e.g. "matplotlib")
+    :param fingerprint_deps: deps whose fingerprints are part of the fingerprint of the output (all the deps by
+                             default), e.g. the inputs of a batched dep whose params cover other outputs too
+    """
+
+    def __init__(self,
+                 name: str,
+                 fn: Callable,
+                 deps: Sequence[str] = (),
+                 params: Optional[dict] = None,
+                 version: int = 1,
+                 persist: bool = True,
+                 produces_files: bool = False,
+                 lock: Optional[str] = None,
+                 fingerprint_deps: Optional[Sequence[str]] = None):
+        self.name = name
+        self.fn = fn
+        self.deps = list(deps)
+        self.params = params or {}
+        self.version = version
+        self.persist = persist
+        self.produces_files = produces_files
+        self.lock = lock
+        self.fingerprint_deps = self.deps if fingerprint_deps is None else list(fingerprint_deps)
+
+
+class ArtifactStore:
+    """ Outputs of the nodes, pickled in {store_dir}/{node name}/{fingerprint}.pkl """
+
+    def __init__(self, store_dir: str):
+        self.store_dir = store_dir
+
+    def path(self, name: str, fingerprint: str) -> str:
+        safe_name = name.replace(os.sep, "_").replace(":", "__")
+        return os.path.join(self.store_dir, safe_name, f"{fingerprint[:20]}.pkl")
+
+    def exists(self, name: str, fingerprint: str) -> bool:
+        return os.path.isfile(self.path(name, fingerprint))
+
+    def load(self, name: str, fingerprint: str) -> Any:
+        with open(self.path(name, fingerprint), "rb") as f:
+            return pickle.load(f)
+
+    def save(self, name: str, fingerprint: str, output: Any):
+        path = self.path(name, fingerprint)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", "wb") as f:
+            pickle.dump(output, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(path + ".tmp", path)
+
+
+class Pipeline:
+    """
+    DAG of nodes whose outputs are fingerprinted by (name, version, params, fingerprints of the fingerprint_deps).
+    build() only recomputes the nodes whose fingerprint has no stored output, and runs independent nodes
+    concurrently (threads: the stages are numpy / torch / scipy calls).
+    """
+
+    def __init__(self, store: ArtifactStore):
+        self.store = store
+        self.nodes = {}
+        self._fingerprints = {}
+
+    def add(self, node: Node) -> Node:
+        if node.name in self.nodes:
+            raise KeyError(f"Node {node.name} already exists")
+        self.nodes[node.name] = node
+        return node
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.nodes
+
+    def fingerprint(self, name: str) -> str:
+        if name not in self._fingerprints:
+            node = self.nodes[name]
+            self._fingerprints[name] = hash_content(node.name, node.version, node.params,
+                                                    [self.fingerprint(dep) for dep in node.fingerprint_deps])
+        return self._fingerprints[name]
+
+    def is_fresh(self, name: str) -> bool:
+        node = self.nodes[name]
+        if not node.persist or not self.store.exists(name, self.fingerprint(name)):
+            return False
+        if node.produces_files:
+            return all(os.path.isfile(path) for path in self.store.load(name, self.fingerprint(name)))
+        return True
+
+    def plan(self, targets: Optional[Sequence[str]] = None) -> List[str]:
+        """
+        Returns the nodes to (re)compute to get the targets (all the persisted nodes by default: the other ones only
+        run when a stale node needs them)
+        """
+        targets = [name for name, node in self.nodes.items() if node.persist] if targets is None else targets
+        to_run, visited = set(), set()
+
+        def visit(name: str):
+            if name in visited:
+                return
+            visited.add(name)
+            if self.is_fresh(name):
+                return
+            to_run.add(name)
+            for dep in self.nodes[name].deps:
+                visit(dep)
+
+        for target in targets:
+            visit(target)
+        return [name for name in self.nodes if name in to_run]
+
+    def build(self, targets: Optional[Sequence[str]] = None, num_workers: int = 4) -> Dict[str, str]:
+        """
+
+        :return: the state of each node of the plan: "built", "failed" (with the error) or "blocked" (a dep failed)
+        """
+        to_run = self.plan(targets)
+        status = {}
+        waiting = {name: set(dep for dep in self.nodes[name].deps if dep in to_run) for name in to_run}
+        consumers = {}
+        for name in to_run:
+            for dep in self.nodes[name].deps:
+                consumers[dep] = consumers.get(dep, 0) + 1
+        outputs = {}
+        locks = {node.lock: threading.Lock() for node in self.nodes.values() if node.lock is not None}
+
+        load_lock = threading.Lock()
+
+        def get_input(name: str):
+            # Fresh deps are loaded once from the store and shared by their consumers
+            with load_lock:
+                if name not in outputs:
+                    outputs[name] = self.store.load(name, self.fingerprint(name))
+                return outputs[name]
+
+        def run(name: str):
+            node = self.nodes[name]
+            inputs = [get_input(dep) for dep in node.deps]
+            if node.lock is None:
+                return node.fn(*inputs, **node.params)
+            with locks[node.lock]:
+                return node.fn(*inputs, **node.params)
+
+        def release_inputs(name: str):
+            # Outputs are kept in memory only while a node of the plan still needs them
+            for dep in self.nodes[name].deps:
+                consumers[dep] -= 1
+                if consumers[dep] == 0:
+                    outputs.pop(dep, None)
+
+        def block(name: str):
+            for other, deps in waiting.items():
+                if name in deps and other not in status:
+                    status[other] = "blocked"
+                    block(other)
+
+        with ThreadPoolExecutor(max_workers=num_workers) as executor, \
+                tqdm(total=len(to_run), desc="Building") as progress:
+            running = {}
+            while True:
+                for name in to_run:
+                    if name not in status and name not in running.values() and len(waiting[name]) == 0:
+                        running[executor.submit(run, name)] = name
+                if len(running) == 0:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    progress.update(1)
+                    try:
+                        output = future.result()
+                    except Exception as e:
+                        status[name] = f"failed: {e!r}"
+                        block(name)
+                        release_inputs(name)
+                        continue
+                    node = self.nodes[name]
+                    if node.persist:
+                        self.store.save(name, self.fingerprint(name), output)
+                    if consumers.get(name, 0) > 0:
+                        outputs[name] = output
+                    status[name] = "built"
+                    release_inputs(name)
+                    for other in to_run:
+                        waiting[other].discard(name)
+        return status
@@ -0,0 +1,194 @@
+import os
+from typing import List
+
+import numpy as np
+import pandas as pd
+from omegaconf import OmegaConf
+
+from src.analysis import (
+    build_confound_regressions,
+    compute_window_eeg_rdms,
+    correlate_window_rdms,
+    get_model,
+    get_model_layers_representations,
+    standardize_rdms
+)
+from src.pipeline.graph import ArtifactStore, Node, Pipeline, source_fingerprint
+from src.sweep import (
+    LEVENSHTEIN_REPRS,
+    build_grid,
+    build_label_table,
+    build_table_path,
+    compute_word_rdms,
+    get_band_names,
+    get_confound_rdms,
+    get_tab_attrs,
+    representation_name,
+    save_table,
+    select_label_ids
+)
+
+
+def load_eeg_cube(dataname: str, data_config: dict, source: list) -> dict:
+    """ Raw data -> EEG cube of all the words of the dataset (source is only part of the fingerprint) """
+    from src.dataset import get_dataset
+    dataset = get_dataset(OmegaConf.create(data_config), None, dataname)
+    return {"eeg": np.asarray(dataset.eeg),
+            "words": np.asarray(dataset.words, dtype=object),
+            "channels": list(dataset.channels["#NAME"]),
+            "label_table": build_label_table(dataset, dataname)}
+
+
+def extract_features(cube: dict, name: str, layers: List[int]) -> dict:
+    """ Words -> {layer: features} of all the words of the dataset, all the layers in one forward pass """
+    model, tokenizer = get_model(name)
+    return get_model_layers_representations(list(cube["words"]), model, layers, tokenizer)
+
+
+def select_layer(features: dict, name: str, layer: int) -> np.array:
+    """ Features of all the layers -> features of one layer (name is only part of the fingerprint) """
+    return features[layer]
+
+
+def word_rdm_stage(cube: dict, *features: np.array, label: str, representation: dict, layer: int) -> dict:
+    """ Features of the layer -> word RDMs ({"cosine", "l2"} or {"levenshtein"}) of the words of the label """
+    label_ids = select_label_ids(cube["label_table"], label)
+    label_features = {} if len(features) == 0 else {layer: features[0][label_ids]}
+    return compute_word_rdms(cube["words"][label_ids], representation, label_features, layer)
+
+
+def eeg_rdm_stage(cube: dict, label: str, band_id: int, timesteps: int, pad_step: int) -> dict:
+    """
+    EEG cube + window -> standardized EEG RDMs of each time window and channel (float32), ready to be correlated
+    with any word RDM
+    """
+    eeg = cube["eeg"] if cube["eeg"].ndim == 3 else cube["eeg"][:, band_id]
+    eeg_rdms = compute_window_eeg_rdms(eeg[select_label_ids(cube["label_table"], label)],
+                                       timesteps=timesteps, pad_step=pad_step)
+    standardized = {}
+    for norm in ["cosine", "l2"]:
+        standardized[norm] = [tuple(values.astype(np.float32) for values in standardize_rdms(rdms))
+                              for rdms in eeg_rdms[norm]]
+    return {"starts": eeg_rdms["starts"], "standardized": standardized}
+
+
+def correlations_stage(cube: dict, eeg_rdms: dict, word_rdms: dict, dataname: str, label: str, timesteps: int,
+                       tab_attrs: List[str], confounds: dict, table_path: str) -> List[str]:
+    """ RDMs -> correlations table (same rows as analysis.compute_correlations, + the confound regression columns) """
+    confound_rdms = get_confound_rdms(confounds, dataname, cube["words"][select_label_ids(cube["label_table"], label)])
+    regressions = None if confound_rdms is None else build_confound_regressions(word_rdms, confound_rdms)
+    rows = correlate_window_rdms({"starts": eeg_rdms["starts"]}, word_rdms, cube["channels"],
+                                 timesteps=timesteps, standardized=eeg_rdms["standardized"], regressions=regressions)
+    save_table(pd.DataFrame(rows).reindex(columns=tab_attrs), table_path)
+    return [table_path]
+
+
+def figures_stage(*tables: List[str], dataname: str, rootpath: str, shortname: str, label: str,
+                  tab_attrs: List[str], vis: dict, dest_folder: str, file_suffix: str) -> List[str]:
+    """ Correlation tables of the layers of a model -> topomaps of the layers, one figure per time window """
+    from src.dataset import get_dataset_electrodes, project_3d_coordinates_in_plan
+    from src.vis import get_topomap_interpolator, load_layer_correlations, render_layer_figures
+
+    data_path_name = "eeg_POS" if dataname == "ubira" else dataname
+    electrodes = get_dataset_electrodes(rootpath, data_path_name)
+    list_electrodes = electrodes["#NAME"].tolist()
+    electrodes_pos = project_3d_coordinates_in_plan(electrodes[["X", "Y", "Z"]].to_numpy())
+    interpolator = get_topomap_interpolator(electrodes_pos[:, :2], grid_res=vis["grid_res"])
+
+    table_paths = [paths[0] for paths in tables]
+    list_paths = []
+    for distance in ["cosine", "l2"]:
+        corr_values, window_titles, _ = load_layer_correlations(os.path.dirname(table_paths[0]),
+                                                                [os.path.basename(path) for path in table_paths],
+                                                                tab_attrs, distance)
+        for corr_type in ["pearson", "spearman"]:
+            figure_folder = os.path.join(dest_folder, corr_type, distance)
+            os.makedirs(figure_folder, exist_ok=True)
+            list_paths.extend(render_layer_figures(electrodes_pos, list_electrodes, corr_values[corr_type],
+                                                   window_titles, shortname, dataname, vis, figure_folder,
+                                                   file_prefix=f"{corr_type}_{shortname}_{label}{file_suffix}",
+                                                   interpolator=interpolator))
+    return list_paths
+
+
+def build_correlation_pipeline(config, store: ArtifactStore) -> Pipeline:
+    """
+
+    :param config: sweep-like config (datasets, grid, save_folder, tab_attrs) + pipeline and vis sections
+    :return: the DAG raw data -> EEG cube -> EEG RDMs, words -> features -> word RDMs, RDMs -> correlation tables
+             -> figures, for every point of the grid
+    """
+    pipeline = Pipeline(store)
+    tab_attrs = get_tab_attrs(config)
+    confounds = OmegaConf.to_container(config.confounds, resolve=True) if "confounds" in config else None
+    vis = OmegaConf.to_container(config.vis, resolve=True)
+    cells = build_grid(config)
+
+    for dataname in config.grid.datasets:
+        data_config = OmegaConf.to_container(config.datasets[dataname], resolve=True)
+        data_config["labels"] = None
+        cube_name = f"eeg_cube:{dataname}"
+        pipeline.add(Node(cube_name, load_eeg_cube,
+                          params={"dataname": dataname, "data_config": data_config,
+                                  "source": source_fingerprint(data_config["datapath"])}))
+        dataset_cells = [cell for cell in cells if cell["dataset"] == dataname]
+
+        # All the layers of a model in one forward pass (not stored), split into per-layer features fingerprinted by
+        # (model, layer) only: adding a layer to the grid does not invalidate the others
+        for name in sorted(set(cell["representation"]["name"] for cell in dataset_cells) - set(LEVENSHTEIN_REPRS)):
+            model_cells = [cell for cell in dataset_cells if cell["representation"]["name"] == name]
+            shortname = model_cells[0]["representation"]["shortname"]
+            layers = sorted(set(cell["layer"] for cell in model_cells))
+            pipeline.add(Node(f"features:{dataname}:{shortname}", extract_features, deps=[cube_name],
+                              params={"name": name, "layers": layers}, persist=False))
+            for layer in layers:
+                pipeline.add(Node(f"features:{dataname}:{shortname}:{layer}", select_layer,
+                                  deps=[f"features:{dataname}:{shortname}"], params={"name": name, "layer": layer},
+                                  fingerprint_deps=[cube_name]))
+
+        figure_tables = {}
+        for cell in dataset_cells:
+            repr_config, label, window = cell["representation"], cell["label"], cell["window"]
+            repr_name = representation_name(repr_config, cell["layer"])
+            window_name = f"t{window['timesteps']}_p{window['pad_step']}"
+
+            word_rdm_name = f"word_rdm:{dataname}:{label}:{repr_name}"
+            if word_rdm_name not in pipeline:
+                features_deps = [] if repr_config["name"] in LEVENSHTEIN_REPRS \
+                    else [f"features:{dataname}:{repr_config['shortname']}:{cell['layer']}"]
+                pipeline.add(Node(word_rdm_name, word_rdm_stage, deps=[cube_name, *features_deps],
+                                  params={"label": label, "representation": repr_config, "layer": cell["layer"]}))
+
+            for band_id, band in enumerate(get_band_names(config.datasets[dataname])):
+                eeg_rdm_name = f"eeg_rdm:{dataname}:{label}:{band}:{window_name}"
+                if eeg_rdm_name not in pipeline:
+                    pipeline.add(Node(eeg_rdm_name, eeg_rdm_stage, deps=[cube_name],
+                                      params={"label": label, "band_id": band_id, **window},
+                                      persist=config.pipeline.persist_eeg_rdms))
+
+                table_path = build_table_path(config.save_folder, dataname, label, repr_name, window, band)
+                correlations_name = f"correlations:{dataname}:{label}:{repr_name}:{band}:{window_name}"
+                pipeline.add(Node(correlations_name, correlations_stage,
+                                  deps=[cube_name, eeg_rdm_name, word_rdm_name],
+                                  params={"dataname": dataname, "label": label, "timesteps": window["timesteps"],
+                                          "tab_attrs": tab_attrs, "confounds": confounds, "table_path": table_path},
+                                  produces_files=True))
+                figure_key = (label, repr_config["shortname"], band, window_name)
+                if repr_config["name"] not in LEVENSHTEIN_REPRS:
+                    figure_tables.setdefault(figure_key, []).append((cell["layer"], correlations_name))
+
+        if not config.pipeline.figures:
+            continue
+        for (label, shortname, band, window_name), layer_tables in figure_tables.items():
+            # The layer figures are grids of topomaps: a single layer cannot be laid out
+            if len(layer_tables) < 2:
+                continue
+            suffix = f"_{window_name}" if band is None else f"_{window_name}_{band}"
+            pipeline.add(Node(f"figures:{dataname}:{label}:{shortname}:{band}:{window_name}", figures_stage,
+                              deps=[name for _, name in sorted(layer_tables)],
+                              params={"dataname": dataname, "rootpath": config.datasets[dataname].rootpath,
+                                      "shortname": shortname, "label": label, "tab_attrs": tab_attrs, "vis": vis,
+                                      "dest_folder": os.path.join(config.save_folder, dataname, label, "image"),
+                                      "file_suffix": suffix},
+                              produces_files=True, lock="matplotlib"))
+    return pipeline
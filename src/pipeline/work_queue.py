@@ -0,0 +1,359 @@
+import os
+import json
+import re
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from omegaconf import OmegaConf
+
+from src.analysis import get_model, get_model_layers_representations
+from src.sweep import (
+    LEVENSHTEIN_REPRS,
+    build_grid,
+    build_label_table,
+    compute_word_rdms,
+    correlate_group,
+    get_confound_rdms,
+    get_tab_attrs,
+    list_pending_cells,
+    representation_name,
+    save_table,
+    select_label_ids
+)
+
+# Job descriptors move between the state folders of the queue with atomic renames (a job is in a single state)
+STATES = ["pending", "claimed", "done", "failed"]
+
+
+class WorkQueue:
+    """
+    Queue of json job descriptors on a shared filesystem, without any scheduler service:
+        - {queue_dir}/pending/{job_id}.json: jobs waiting for a worker
+        - {queue_dir}/claimed/{job_id}.json: jobs being processed, the mtime of the file is the heartbeat of the worker
+        - {queue_dir}/done/{job_id}.json, {queue_dir}/failed/{job_id}.json: finished jobs, with their outcome
+    A worker claims a job by renaming it from pending to claimed: the rename succeeds for a single worker, which then
+    records its claim token in the descriptor. Claims whose heartbeat is older than lease_timeout (dead or
+    disconnected worker) are moved back to pending, each re-lease counting as a failed attempt.
+
+    :param lease_timeout: seconds without heartbeat after which a claim is re-leased
+    :param max_attempts: number of failures (errors or expired leases) after which a job is moved to failed
+    """
+
+    def __init__(self, queue_dir: str, lease_timeout: float = 600., max_attempts: int = 3):
+        self.queue_dir = queue_dir
+        self.lease_timeout = lease_timeout
+        self.max_attempts = max_attempts
+        for state in [*STATES, "tmp"]:
+            os.makedirs(os.path.join(queue_dir, state), exist_ok=True)
+
+    def path(self, state: str, job_id: str) -> str:
+        return os.path.join(self.queue_dir, state, f"{job_id}.json")
+
+    def list(self, state: str) -> List[str]:
+        return sorted(name[:-len(".json")] for name in os.listdir(os.path.join(self.queue_dir, state))
+                      if name.endswith(".json"))
+
+    def read(self, state: str, job_id: str) -> dict:
+        with open(self.path(state, job_id), "r") as f:
+            return json.load(f)
+
+    def _write(self, state: str, job: dict):
+        # Written in tmp then renamed: the other workers never read a partial descriptor
+        tmp_path = os.path.join(self.queue_dir, "tmp", f"{job['job_id']}.{uuid.uuid4().hex}.json")
+        with open(tmp_path, "w") as f:
+            json.dump(job, f, indent=2)
+        os.replace(tmp_path, self.path(state, job["job_id"]))
+
+    def _now(self) -> float:
+        # Clock of the filesystem (the heartbeats are compared to it, not to the clocks of the machines)
+        clock_path = os.path.join(self.queue_dir, "tmp", ".clock")
+        with open(clock_path, "a"):
+            os.utime(clock_path, None)
+        return os.stat(clock_path).st_mtime
+
+    def submit(self, jobs: List[dict]) -> int:
+        """ Adds the jobs which are neither pending nor claimed (previous outcomes are discarded) """
+        active = set(self.list("pending")) | set(self.list("claimed"))
+        n_submitted = 0
+        for job in jobs:
+            if job["job_id"] in active:
+                continue
+            for state in ["done", "failed"]:
+                if os.path.isfile(self.path(state, job["job_id"])):
+                    os.remove(self.path(state, job["job_id"]))
+            self._write("pending", dict(job, attempts=0))
+            n_submitted += 1
+        return n_submitted
+
+    def claim(self, worker_id: str) -> Optional[dict]:
+        for job_id in self.list("pending"):
+            try:
+                # The heartbeat is refreshed first: the mtime is kept by the rename, the claim is never seen stale
+                os.utime(self.path("pending", job_id), None)
+                os.rename(self.path("pending", job_id), self.path("claimed", job_id))
+            except FileNotFoundError:
+                # Claimed by another worker in the meantime
+                continue
+            job = self.read("claimed", job_id)
+            # The token identifies this claim: a re-leased then re-claimed job belongs to its new owner
+            job.update(worker=worker_id, claim=uuid.uuid4().hex)
+            self._write("claimed", job)
+            return job
+        return None
+
+    def heartbeat(self, job_id: str) -> bool:
+        """ Returns False if the claim was lost (re-leased after a timeout) """
+        try:
+            os.utime(self.path("claimed", job_id), None)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def release_stale(self) -> List[str]:
+        """
+        Moves the claims without heartbeat for lease_timeout seconds back to pending, or to failed once the job
+        reached max_attempts (e.g. a job killing its workers)
+
+        :return: the ids of the re-leased jobs
+        """
+        now, released = self._now(), []
+        for job_id in self.list("claimed"):
+            reaped_path = os.path.join(self.queue_dir, "tmp", f"{job_id}.{uuid.uuid4().hex}.reaped")
+            try:
+                if now - os.stat(self.path("claimed", job_id)).st_mtime < self.lease_timeout:
+                    continue
+                # Taken out of claimed first: a single process re-leases the claim
+                os.rename(self.path("claimed", job_id), reaped_path)
+            except FileNotFoundError:
+                continue
+            with open(reaped_path, "r") as f:
+                job = json.load(f)
+            job.update(attempts=job.get("attempts", 0) + 1, error=f"lease expired after {self.lease_timeout}s")
+            if job["attempts"] >= self.max_attempts:
+                self._write("failed", job)
+            else:
+                self._write("pending", {key: value for key, value in job.items() if key not in ["worker", "claim"]})
+            os.remove(reaped_path)
+            released.append(job_id)
+        return released
+
+    def complete(self, job: dict, result: dict):
+        # The claim may have been re-leased meanwhile: the results are committed anyway (tables are written
+        # atomically and are the same), and the job is not processed again
+        job = dict(job, result=result)
+        self._write("done", job)
+        for state in ["claimed", "pending"]:
+            try:
+                os.remove(self.path(state, job["job_id"]))
+            except FileNotFoundError:
+                pass
+
+    def fail(self, job: dict, error: str):
+        try:
+            owner = self.read("claimed", job["job_id"]).get("claim")
+        except FileNotFoundError:
+            owner = None
+        if owner is None or owner != job.get("claim"):
+            # Lost claim: re-leased, and possibly claimed by another worker which is now in charge of the job
+            return
+        failing_path = os.path.join(self.queue_dir, "tmp", f"{job['job_id']}.{uuid.uuid4().hex}.failing")
+        try:
+            # Taken out of claimed first, as in release_stale: the claim is either failed here or re-leased
+            os.rename(self.path("claimed", job["job_id"]), failing_path)
+        except FileNotFoundError:
+            return
+        with open(failing_path, "r") as f:
+            if json.load(f).get("claim") != job.get("claim"):
+                # Re-leased and re-claimed since the token was read: given back to its new owner
+                os.rename(failing_path, self.path("claimed", job["job_id"]))
+                return
+        job = dict(job, attempts=job.get("attempts", 0) + 1, error=error)
+        if job["attempts"] >= self.max_attempts:
+            self._write("failed", job)
+        else:
+            self._write("pending", {key: value for key, value in job.items() if key not in ["worker", "claim"]})
+        os.remove(failing_path)
+
+    def counts(self) -> Dict[str, int]:
+        return {state: len(self.list(state)) for state in STATES}
+
+
+class _Heartbeat:
+    """ Refreshes the claim of a job in a background thread while the worker processes it """
+
+    def __init__(self, queue: WorkQueue, job_id: str, interval: float):
+        self.queue = queue
+        self.job_id = job_id
+        self.interval = interval
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            if not self.queue.heartbeat(self.job_id):
+                self.lost = True
+                return
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._stop.set()
+        self._thread.join()
+        return False
+
+
+def _safe_name(value) -> str:
+    return re.sub(r"[^A-Za-z0-9_.-]+", "-", str(value))
+
+
+def build_sweep_jobs(config, cells_per_job: Optional[int] = None) -> Tuple[List[dict], int]:
+    """
+
+    :param config: sweep config (configs/sweep.yaml)
+    :param cells_per_job: maximum number of tables per job (all the tables sharing the EEG data by default)
+    :return: the job descriptors of the pending cells of the grid (one job per dataset, label, window and band, as
+             the sweep jobs: the EEG RDMs are computed once per job) and the number of existing tables
+    """
+    cells = build_grid(config)
+    for cell in cells:
+        cell["repr_name"] = representation_name(cell["representation"], cell["layer"])
+
+    confounds = OmegaConf.to_container(config.confounds, resolve=True) if "confounds" in config else None
+    jobs, n_existing = [], 0
+    for dataname in config.grid.datasets:
+        pending, existing = list_pending_cells(config, dataname, cells)
+        n_existing += len(existing)
+        data_config = OmegaConf.to_container(config.datasets[dataname], resolve=True)
+        data_config["labels"] = None
+
+        groups = {}
+        for cell in pending:
+            group_key = (cell["label"], cell["window"]["timesteps"], cell["window"]["pad_step"], cell["band"],
+                         cell["band_id"])
+            groups.setdefault(group_key, []).append({key: cell[key] for key in
+                                                     ["representation", "layer", "repr_name", "table_path"]})
+        for (label, timesteps, pad_step, band, band_id), group_cells in groups.items():
+            chunk_size = cells_per_job or len(group_cells)
+            job_id = "__".join(_safe_name(value) for value in [dataname, label, f"t{timesteps}_p{pad_step}", band])
+            for chunk_id, start in enumerate(range(0, len(group_cells), chunk_size)):
+                jobs.append({"job_id": job_id if chunk_size >= len(group_cells) else f"{job_id}__{chunk_id}",
+                             "dataset": dataname,
+                             "data_config": data_config,
+                             "label": label,
+                             "window": {"timesteps": timesteps, "pad_step": pad_step},
+                             "band": band,
+                             "band_id": band_id,
+                             "tab_attrs": get_tab_attrs(config),
+                             "confounds": confounds,
+                             "cells": group_cells[start:start + chunk_size]})
+    return jobs, n_existing
+
+
+class SweepJobRunner:
+    """ Processes sweep jobs, keeping the datasets and the features in memory between the jobs of a worker """
+
+    def __init__(self):
+        self.datasets = {}
+        self.features = {}
+
+    def dataset_inputs(self, job: dict) -> dict:
+        if job["dataset"] not in self.datasets:
+            from src.dataset import get_dataset
+            dataset = get_dataset(OmegaConf.create(job["data_config"]), None, job["dataset"])
+            self.datasets[job["dataset"]] = {"eeg": dataset.eeg,
+                                             "words": np.asarray(dataset.words),
+                                             "electrodes": list(dataset.channels["#NAME"]),
+                                             "label_table": build_label_table(dataset, job["dataset"])}
+        return self.datasets[job["dataset"]]
+
+    def layer_features(self, dataname: str, words: np.array, name: str, layers: List[int]) -> dict:
+        # Features of all the words of the dataset, the missing layers being computed in a single pass
+        features = self.features.setdefault((dataname, name), {})
+        missing = [layer for layer in layers if layer not in features]
+        if len(missing) > 0:
+            model, tokenizer = get_model(name)
+            features.update(get_model_layers_representations(list(words), model, missing, tokenizer))
+        return features
+
+    def __call__(self, job: dict) -> dict:
+        inputs = self.dataset_inputs(job)
+        label_ids = select_label_ids(inputs["label_table"], job["label"])
+
+        word_rdms = {}
+        for cell in job["cells"]:
+            repr_config, features = cell["representation"], {}
+            if repr_config["name"] not in LEVENSHTEIN_REPRS:
+                layers = sorted(set(other["layer"] for other in job["cells"]
+                                    if other["representation"]["name"] == repr_config["name"]))
+                layer_features = self.layer_features(job["dataset"], inputs["words"], repr_config["name"], layers)
+                features = {cell["layer"]: layer_features[cell["layer"]][label_ids]}
+            word_rdms[cell["table_path"]] = compute_word_rdms(inputs["words"][label_ids], repr_config, features,
+                                                              cell["layer"])
+
+        eeg = inputs["eeg"][:, job["band_id"]] if inputs["eeg"].ndim == 4 else inputs["eeg"]
+        confound_rdms = get_confound_rdms(job.get("confounds", None), job["dataset"], inputs["words"][label_ids])
+        tables = correlate_group(eeg[label_ids], inputs["electrodes"], job["window"], word_rdms, job["tab_attrs"],
+                                 confound_rdms=confound_rdms)
+        for table_path, table in tables.items():
+            save_table(table, table_path)
+        return {"tables": list(tables)}
+
+
+def run_worker(queue_dir: str,
+               worker_id: Optional[str] = None,
+               lease_timeout: float = 600.,
+               heartbeat_interval: float = 30.,
+               poll_interval: float = 10.,
+               max_attempts: int = 3,
+               max_jobs: Optional[int] = None) -> Dict[str, int]:
+    """
+    Claims and processes jobs until the queue is empty (no pending nor claimed job) or max_jobs jobs are processed.
+    Stale claims of the other workers are re-leased while waiting.
+
+    :return: the number of jobs done and failed by the worker
+    """
+    queue = WorkQueue(queue_dir, lease_timeout=lease_timeout, max_attempts=max_attempts)
+    worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+    runner = SweepJobRunner()
+    stats = {"done": 0, "failed": 0}
+    while max_jobs is None or stats["done"] + stats["failed"] < max_jobs:
+        for job_id in queue.release_stale():
+            print(f"[{worker_id}] Re-leased the stale job {job_id}")
+        job = queue.claim(worker_id)
+        if job is None:
+            if len(queue.list("claimed")) == 0:
+                break
+            # Claimed jobs may still be re-leased if their worker died
+            time.sleep(poll_interval)
+            continue
+
+        print(f"[{worker_id}] Processing {job['job_id']} ({len(job['cells'])} tables)")
+        start = time.time()
+        try:
+            with _Heartbeat(queue, job["job_id"], heartbeat_interval) as heartbeat:
+                result = runner(job)
+        except Exception as e:
+            print(f"\033[91m [{worker_id}] FAILED {job['job_id']}: {e!r} \033[0m")
+            queue.fail(job, repr(e))
+            stats["failed"] += 1
+            continue
+        queue.complete(job, dict(result, worker=worker_id, seconds=round(time.time() - start, 1),
+                                 lost_claim=heartbeat.lost))
+        stats["done"] += 1
+    return stats
+
+
+def run_local_workers(queue_dir: str, num_workers: int, **worker_args) -> List[Dict[str, int]]:
+    """ Runs num_workers workers as local processes (same behaviour as workers on several machines) """
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = [executor.submit(run_worker, queue_dir, f"{socket.gethostname()}:local-{worker_id}", **worker_args)
+                   for worker_id in range(num_workers)]
+        return [future.result() for future in futures]
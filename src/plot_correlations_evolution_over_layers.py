@@ -1,20 +1,13 @@
 import os
 
 import hydra
-import numpy as np
-from tqdm import tqdm
 
 from src.dataset import (
     get_dataset_electrodes,
     project_3d_coordinates_in_plan
 )
-from src.evaluation import CorrelationsTable
-from src.utils import (
-    extract_correlations_and_periods,
-    split_into_chunks
-)
-from src.vis import build_destination_folder
-from src.vis import plot_2d_topomap
+from src.vis import build_destination_folder, FigureCache
+from src.vis import get_topomap_interpolator, list_layer_tables, load_layer_correlations, render_layer_figures
 
 
 @hydra.main(config_path='../configs', config_name='plot')
@@ -31,84 +24,30 @@ def main(config):
     # Get the src folder where the correlations tables are stored
     corr_save_folder = os.path.join(config.save_folder, "csv")
 
-    # Build the destination path/folder
-
     # Load the list of correlations tables corresponding to each layer
     # of the chosen LM (take care of ordering them correctly)
-    list_corr_names = [filename for filename in os.listdir(corr_save_folder)
-                       if modelname in filename and "random" not in filename and "layer" in filename]
-
-    reordered_list_corr_names = [(int(name.split(f"layer_")[1].split("_")[0]), name) for name in list_corr_names]
-    reordered_list_corr_names.sort()
-    list_corr_names = [elt[1] for elt in reordered_list_corr_names]
-
+    list_corr_names = list_layer_tables(corr_save_folder, modelname)
     print("\n CORRELATIONS NAMES", list_corr_names)
 
-    list_corr_tabs = [CorrelationsTable(name=tab_name,
-                                        table_folder=corr_save_folder,
-                                        table_columns=config.tab_attrs,
-                                        eval=True) for tab_name in list_corr_names]
-    print(list_corr_tabs[0].name)
-
-    # Re-order the table by time-wise
-    list_results_grouped_tabs = [corr.extract_sub_table(attribute="distance", value=config.distance,
-                                                        groupby_key="truncate_start") for corr in list_corr_tabs]
-
-    # Extract the correlations
-    pears_corr_values, spear_corr_values, sub_titles = [], [], []
-    fig_sub_titles = []
-    for layer_id in range(len(list_results_grouped_tabs)):
-        pears_corr_val, spear_corr_val, sub_title = extract_correlations_and_periods(
-            list_results_grouped_tabs[layer_id])
-        pears_corr_values.append(pears_corr_val)
-        # print("Layer ID ", layer_id, "pears", len(pears_corr_val), len(pears_corr_val[0]))
-        # print("Layer ID", layer_id,  "spear", len(spear_corr_val), len(spear_corr_val[0]))
-        spear_corr_values.append(spear_corr_val)
-        if layer_id == 0:
-            fig_sub_titles.extend(sub_title)
-        sub_titles.append(f"{modelname}_layer_{layer_id}")
+    # Correlations of shape (n_windows, n_layers, n_channels)
+    corr_values, window_titles, table_path = load_layer_correlations(corr_save_folder, list_corr_names,
+                                                                     config.tab_attrs, config.distance)
 
-    # Permute the time window and the layers
-    pears_corr_values = np.transpose(pears_corr_values, (1, 0, 2))
-    spear_corr_values = np.transpose(spear_corr_values, (1, 0, 2))
-
-    # Reshape the plots
-    # print("subtitles", sub_titles)
-    sub_titles = split_into_chunks(sub_titles, config.vis.chunk_size)
-    # print("subtitles APRES", sub_titles)
+    # The electrodes never move: the interpolation weights are shared by all the figures
+    interpolator = get_topomap_interpolator(electrodes_pos[:, :2], grid_res=config.vis.grid_res)
 
     # Plot correlations topographies
-
-    pears_dest_file_path = build_destination_folder(list_corr_tabs[-1].table_path, config.data.dataname,
-                                                    config.save_folder, config.distance, "pearson")
-    spear_dest_file_path = build_destination_folder(list_corr_tabs[-1].table_path, config.data.dataname,
-                                                    config.save_folder, config.distance, "spearman")
-
-    n_rows, n_cols = len(sub_titles), len(sub_titles[0])
-    # print(n_rows, n_cols, len(sub_titles), len(pears_corr_values[0][0]))
-
-    for subtitle_id in tqdm(range(len(fig_sub_titles)), desc="Generating Correlation plots"):
-        # Reshape the plots
-        pears_corr_val = split_into_chunks(pears_corr_values[subtitle_id], config.vis.chunk_size)
-        spear_corr_val = split_into_chunks(spear_corr_values[subtitle_id], config.vis.chunk_size)
-
-        plot_2d_topomap(electrodes_pos[:, :2], pears_corr_val, dataname=config.data.dataname,
-                        grid_res=config.vis.grid_res,
-                        rows=n_rows, size=config.vis.size, cols=n_cols, edgecolor=config.vis.edgecolor,
-                        subfig_name=sub_titles,
-                        coords_name=list_electrodes, dpi=config.vis.dpi, title=fig_sub_titles[subtitle_id],
-                        savepath=pears_dest_file_path + f"/pearson_{modelname}"
-                                                        f"_{config.label_name}"
-                                                        f"_{fig_sub_titles[subtitle_id]}.png")
-
-        plot_2d_topomap(electrodes_pos[:, :2], spear_corr_val, dataname=config.data.dataname,
-                        grid_res=config.vis.grid_res,
-                        rows=n_rows, size=config.vis.size, cols=n_cols, edgecolor=config.vis.edgecolor,
-                        subfig_name=sub_titles,
-                        coords_name=list_electrodes, dpi=config.vis.dpi, title=fig_sub_titles[subtitle_id],
-                        savepath=spear_dest_file_path + f"/spearman_{modelname}"
-                                                        f"_{config.label_name}"
-                                                        f"_{fig_sub_titles[subtitle_id]}.png")
+    for corr_type in ["pearson", "spearman"]:
+        dest_file_path = build_destination_folder(table_path, config.data.dataname,
+                                                  config.save_folder, config.distance, corr_type)
+        # Unchanged figures (same correlations, vis config and renderer) are not re-rendered
+        cache = FigureCache(dest_file_path) if config.use_cache else None
+        render_layer_figures(electrodes_pos, list_electrodes, corr_values[corr_type], window_titles,
+                             modelname, config.data.dataname, config.vis, dest_file_path,
+                             file_prefix=f"{corr_type}_{modelname}_{config.label_name}",
+                             interpolator=interpolator, cache=cache)
+        if cache is not None:
+            cache.save()
     print("\033[96m JOB Done ! \033[0m")
 
 
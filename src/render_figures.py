@@ -0,0 +1,32 @@
+import hydra
+from omegaconf import OmegaConf
+
+from src.dataset import (
+    get_dataset_electrodes,
+    project_3d_coordinates_in_plan
+)
+from src.vis import build_render_specs, render_batch
+
+
+@hydra.main(config_path='../configs', config_name='render')
+def main(config):
+    # Load the dataset electrodes locations and names
+    data_path_name = "eeg_POS" if config.data.dataname == "ubira" else config.data.dataname
+    electrodes = get_dataset_electrodes(config.data.rootpath, data_path_name)
+    list_electrodes = electrodes["#NAME"].tolist()
+    electrodes_pos = project_3d_coordinates_in_plan(electrodes[["X", "Y", "Z"]].to_numpy())
+
+    specs = build_render_specs(list(config.labels), list(config.models), list(config.distances), list(config.corrs))
+    manifest = render_batch(specs, OmegaConf.to_container(config, resolve=True), electrodes_pos, list_electrodes,
+                            num_workers=config.num_workers, manifest_path=config.manifest)
+
+    failed = [spec for spec in manifest["specs"] if spec["error"] is not None]
+    for spec in failed:
+        print(f"\033[91m Failed {spec['label']} / {spec['model']} / {spec['distance']} / {spec['corr']}:"
+              f" {spec['error']} \033[0m")
+    print(f"\033[96m {len(manifest['files'])} figures written ({len(failed)}/{len(specs)} specs failed),"
+          f" manifest in {config.manifest} \033[0m")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+import os
+import shutil
+from datetime import datetime
+
+import hydra
+import matplotlib
+from omegaconf import OmegaConf
+
+from src.benchmarks import CASES, compare_to_baseline, load_results, run_benchmarks, save_results
+
+
+def _to_list(values):
+    return None if values is None else OmegaConf.to_container(values)
+
+
+@hydra.main(config_path='../configs', config_name='benchmark')
+def main(config):
+    matplotlib.use("Agg")
+    results = run_benchmarks(CASES,
+                             names=_to_list(config.cases),
+                             n_words=_to_list(config.n_words),
+                             datasets=_to_list(config.datasets),
+                             rounds=config.rounds,
+                             warmup=config.warmup,
+                             max_time=config.max_time,
+                             seed=config.seed)
+
+    save_path = os.path.join(config.save_folder, f"benchmark_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    save_results(results, save_path)
+    print(f"\nResults saved to {save_path}")
+
+    baseline = load_results(config.baseline) if os.path.isfile(config.baseline) else {}
+    comparison = compare_to_baseline(results, baseline, tolerance=config.tolerance)
+    print(f"\n{'benchmark':<45} {'median (s)':>12} {'baseline (s)':>12} {'ratio':>7}  status")
+    for row in comparison:
+        median = "-" if row["median"] is None else f"{row['median']:.4f}"
+        reference = "-" if row["baseline"] is None else f"{row['baseline']:.4f}"
+        ratio = "-" if row["ratio"] is None else f"{row['ratio']:.2f}"
+        color = {"regression": "\033[91m", "improvement": "\033[92m"}.get(row["status"], "")
+        print(f"{color}{row['name']:<45} {median:>12} {reference:>12} {ratio:>7}  {row['status']}\033[0m")
+    for result in results:
+        if result["stats"] is None:
+            print(f"\033[91m FAILED {result['name']}: {result['error']} \033[0m")
+
+    if config.save_baseline:
+        shutil.copyfile(save_path, config.baseline)
+        print(f"Baseline saved to {config.baseline}")
+    if config.fail_on_regression and any(row["status"] in ["regression", "failed"] for row in comparison):
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
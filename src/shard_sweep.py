@@ -0,0 +1,40 @@
+import hydra
+
+from src.pipeline import WorkQueue, build_sweep_jobs, run_local_workers, run_worker
+
+
+def _submit(config, queue: WorkQueue):
+    jobs, n_existing = build_sweep_jobs(config, cells_per_job=config.queue.cells_per_job)
+    n_submitted = queue.submit(jobs)
+    print(f"{n_existing} tables already computed, {sum(len(job['cells']) for job in jobs)} tables in {len(jobs)} jobs,"
+          f" {n_submitted} submitted ({len(jobs) - n_submitted} already pending or claimed)")
+
+
+@hydra.main(config_path='../configs', config_name='shard')
+def main(config):
+    queue = WorkQueue(config.queue.dir, lease_timeout=config.queue.lease_timeout,
+                      max_attempts=config.queue.max_attempts)
+    worker_args = {"lease_timeout": config.queue.lease_timeout,
+                   "heartbeat_interval": config.queue.heartbeat_interval,
+                   "poll_interval": config.queue.poll_interval,
+                   "max_attempts": config.queue.max_attempts,
+                   "max_jobs": config.queue.max_jobs}
+
+    if config.queue.role in ["coordinator", "local"]:
+        _submit(config, queue)
+    if config.queue.role == "worker":
+        stats = run_worker(config.queue.dir, **worker_args)
+        print(f"Worker done: {stats}")
+    elif config.queue.role == "local":
+        list_stats = run_local_workers(config.queue.dir, config.num_workers, **worker_args)
+        print(f"Workers done: {list_stats}")
+    elif config.queue.role not in ["coordinator", "status"]:
+        raise ValueError(f"Unknown role {config.queue.role} (coordinator, worker, local or status)")
+
+    print(f"\033[96m Queue {config.queue.dir}: {queue.counts()} \033[0m")
+    for job_id in queue.list("failed"):
+        print(f"\033[91m FAILED {job_id}: {queue.read('failed', job_id)['error']} \033[0m")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,276 @@
+import os
+import json
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from itertools import product
+from typing import Dict, List, Optional, Tuple
+
+import hydra
+import numpy as np
+import pandas as pd
+from omegaconf import OmegaConf
+from tqdm import tqdm
+
+from src.dataset import get_dataset
+from src.dataset.power import resolve_bands
+from src.analysis import (
+    all_pairs,
+    build_confound_regressions,
+    compute_all_dl_distance,
+    compute_covariate_rdms,
+    compute_rdm,
+    confound_columns,
+    compute_window_eeg_rdms,
+    correlate_window_rdms,
+    get_model,
+    get_model_layers_representations,
+    load_word_covariates,
+    standardize_rdms
+)
+
+STATUS_NAME = "sweep_status.json"
+LEVENSHTEIN_REPRS = ["levenshtein", "levenshtein_ipa"]
+
+
+def representation_name(repr_config: dict, layer: int) -> str:
+    if repr_config["name"] in LEVENSHTEIN_REPRS or layer == -1:
+        return repr_config["shortname"]
+    return f"{repr_config['shortname']}_layer_{layer}"
+
+
+def get_band_names(data_config) -> List[str]:
+    """ Frequency bands of the dataset (one table per band), known before loading the data """
+    bands = resolve_bands(data_config.get("bands", None))
+    return list(bands.keys()) if bands is not None and data_config.get("use_power", False) else [None]
+
+
+def build_table_path(save_folder: str, dataname: str, label: str, repr_name: str, window: dict, band: str) -> str:
+    tab_name = f"{repr_name}_{label}_t{window['timesteps']}_p{window['pad_step']}"
+    if band is not None:
+        tab_name += f"_{band}"
+    return os.path.join(save_folder, dataname, label, "csv", f"{tab_name}_correlations.csv")
+
+
+def build_label_table(dataset, dataname: str) -> pd.DataFrame:
+    """ Word annotations used to select the words of each label (the dataset is loaded once, unfiltered) """
+    if dataname == "kiloword":
+        return pd.concat([dataset.labels_df, dataset.labels[["MATERIAL"]]], axis=1).reset_index(drop=True)
+    return pd.DataFrame({"pos": dataset.data.column("pos")})
+
+
+def select_label_ids(label_table: pd.DataFrame, label: str) -> np.array:
+    if label == "ALL":
+        return np.arange(len(label_table))
+    if label == "OBJECT":
+        return np.where(label_table["MATERIAL"] == "YES")[0]
+    elif label == "ABSTRACT":
+        return np.where(label_table["MATERIAL"] != "YES")[0]
+    elif label in label_table.columns:
+        return np.where(label_table[label] == True)[0]
+    return np.where(label_table["pos"] == label)[0]
+
+
+def build_grid(config) -> List[dict]:
+    """
+
+    :return: one cell (= one correlations table) per dataset x label x representation x layer x window x band.
+             Layers are ignored for the levenshtein distances
+    """
+    cells = []
+    for dataname in config.grid.datasets:
+        for label, repr_config, window in product(config.grid.labels[dataname], config.grid.representations,
+                                                  config.grid.windows):
+            layers = [-1] if repr_config.name in LEVENSHTEIN_REPRS else config.grid.layers
+            for layer in layers:
+                cells.append({"dataset": dataname,
+                              "label": label,
+                              "representation": OmegaConf.to_container(repr_config),
+                              "layer": int(layer),
+                              "window": OmegaConf.to_container(window)})
+    return cells
+
+
+def list_pending_cells(config, dataname: str, cells: List[dict]) -> Tuple[List[dict], List[str]]:
+    """
+
+    :param cells: cells of the grid (build_grid), with their "repr_name"
+    :return: the cells of the dataset (one per band) whose table does not exist yet (or all of them with overwrite),
+             with their "band", "band_id" and "table_path", and the paths of the existing tables
+    """
+    band_names = get_band_names(config.datasets[dataname])
+    pending, existing = [], []
+    for cell in cells:
+        if cell["dataset"] != dataname:
+            continue
+        for band_id, band in enumerate(band_names):
+            band_cell = dict(cell, band=band, band_id=band_id,
+                             table_path=build_table_path(config.save_folder, dataname, cell["label"],
+                                                         cell["repr_name"], cell["window"], band))
+            if os.path.isfile(band_cell["table_path"]) and not config.overwrite:
+                existing.append(band_cell["table_path"])
+            else:
+                pending.append(band_cell)
+    return pending, existing
+
+
+def get_tab_attrs(config) -> List[str]:
+    """ Columns of the tables, with the confound regression columns when enabled """
+    tab_attrs = list(config.tab_attrs)
+    if config.get("confounds", None) is not None and config.confounds.enabled:
+        tab_attrs += confound_columns(list(config.confounds.covariates))
+    return tab_attrs
+
+
+def get_confound_rdms(confounds_config, dataname: str, words: np.array) -> Optional[Dict[str, np.array]]:
+    """ Covariate RDMs of the words (only the kiloword words have covariates), None if disabled """
+    if confounds_config is None or not confounds_config["enabled"] or dataname != "kiloword":
+        return None
+    covariates = load_word_covariates(confounds_config["metadata_path"], list(words),
+                                      list(confounds_config["covariates"]))
+    return compute_covariate_rdms(covariates)
+
+
+def compute_word_rdms(words: np.array, repr_config: dict, features: Dict[int, np.array],
+                      layer: int) -> Dict[str, np.array]:
+    if repr_config["name"] == "levenshtein":
+        return {"levenshtein": np.asarray(compute_all_dl_distance(all_pairs(words), normalize=True))}
+    if repr_config["name"] == "levenshtein_ipa":
+        import eng_to_ipa as ipa
+        ipa_words = [ipa.convert(word) for word in words]
+        return {"levenshtein": np.asarray(compute_all_dl_distance(all_pairs(ipa_words), normalize=True))}
+    return {"cosine": compute_rdm(features[layer], norm="cosine"), "l2": compute_rdm(features[layer], norm="l2")}
+
+
+def correlate_group(eeg: np.array,
+                    list_electrodes: List[str],
+                    window: dict,
+                    word_rdms: Dict[str, Dict[str, np.array]],
+                    tab_attrs: List[str],
+                    confound_rdms: Optional[Dict[str, np.array]] = None) -> Dict[str, pd.DataFrame]:
+    """
+    Correlates the EEG RDMs of every time window and channel with the word RDMs of several cells sharing the same
+    EEG data: the EEG RDMs (and their ranks) are computed once for all the representations and layers.
+
+    :param eeg: EEG signals of the words of the label, of shape (n_words, n_channels, n_timesteps)
+    :param word_rdms: {table path: {"cosine": rdm, "l2": rdm} or {"levenshtein": rdm}}
+    :param confound_rdms: {name: rdm} of the words, adds the partial correlations and regression columns
+    :return: {table path: correlations table} (same rows as analysis.compute_correlations)
+    """
+    eeg_rdms = compute_window_eeg_rdms(eeg, timesteps=window["timesteps"], pad_step=window["pad_step"])
+    standardized = {norm: [standardize_rdms(rdms) for rdms in eeg_rdms[norm]] for norm in ["cosine", "l2"]}
+    tables = {}
+    for table_path, rdms in word_rdms.items():
+        regressions = None if confound_rdms is None else build_confound_regressions(rdms, confound_rdms)
+        tables[table_path] = pd.DataFrame(correlate_window_rdms(eeg_rdms, rdms, list_electrodes,
+                                                                timesteps=window["timesteps"],
+                                                                standardized=standardized,
+                                                                regressions=regressions)).reindex(columns=tab_attrs)
+    return tables
+
+
+def _run_job(*args) -> tuple:
+    start = time.time()
+    return correlate_group(*args), time.time() - start
+
+
+def save_table(table: pd.DataFrame, table_path: str):
+    # Tables are written atomically: an existing table always means a completed cell
+    os.makedirs(os.path.dirname(table_path), exist_ok=True)
+    table.to_csv(table_path + ".tmp", index=False)
+    os.replace(table_path + ".tmp", table_path)
+
+
+def _save_status(save_folder: str, status: Dict[str, dict]):
+    status_path = os.path.join(save_folder, STATUS_NAME)
+    with open(status_path + ".tmp", "w") as f:
+        json.dump(status, f, indent=2)
+    os.replace(status_path + ".tmp", status_path)
+
+
+@hydra.main(config_path='../configs', config_name='sweep')
+def main(config):
+    os.makedirs(config.save_folder, exist_ok=True)
+    cells = build_grid(config)
+
+    for cell in cells:
+        cell["repr_name"] = representation_name(cell["representation"], cell["layer"])
+
+    # Shared inputs: each dataset is loaded once (unfiltered), each model once, all its layers in one pass
+    status, groups = {}, {}
+    confounds_config = OmegaConf.to_container(config.confounds, resolve=True) if "confounds" in config else None
+    for dataname in config.grid.datasets:
+        # Skip the cells whose table already exists
+        dataset_cells, existing = list_pending_cells(config, dataname, cells)
+        status.update({table_path: {"state": "skipped"} for table_path in existing})
+        if len(dataset_cells) == 0:
+            continue
+
+        data_config = config.datasets[dataname].copy()
+        data_config.labels = None
+        dataset = get_dataset(data_config, None, dataname)
+        eeg = dataset.eeg
+        list_electrodes = list(dataset.channels["#NAME"])
+        label_table = build_label_table(dataset, dataname)
+
+        features = {}
+        for repr_config in {cell["representation"]["name"]: cell["representation"] for cell in dataset_cells}.values():
+            if repr_config["name"] in LEVENSHTEIN_REPRS:
+                continue
+            layers = sorted(set(cell["layer"] for cell in dataset_cells
+                                if cell["representation"]["name"] == repr_config["name"]))
+            print(f"\nComputing the {repr_config['shortname']} representations of {len(dataset.words)} words"
+                  f" (layers {layers})")
+            model, tokenizer = get_model(repr_config["name"])
+            layer_features = get_model_layers_representations(list(dataset.words), model, layers, tokenizer)
+            features[repr_config["name"]] = layer_features
+
+        # Word RDMs are computed once per (label, representation, layer) and shared by windows and bands
+        word_rdms = {}
+        for cell in dataset_cells:
+            label_ids = select_label_ids(label_table, cell["label"])
+            rdm_key = (cell["label"], cell["repr_name"])
+            if rdm_key not in word_rdms:
+                repr_features = {layer: layer_feats[label_ids] for layer, layer_feats
+                                 in features.get(cell["representation"]["name"], {}).items()}
+                word_rdms[rdm_key] = compute_word_rdms(np.asarray(dataset.words)[label_ids], cell["representation"],
+                                                       repr_features, cell["layer"])
+            # Cells sharing the EEG data (label, window, band) form a single job
+            group_key = (dataname, cell["label"], json.dumps(cell["window"]), cell["band"])
+            if group_key not in groups:
+                band_eeg = eeg[:, cell["band_id"]] if eeg.ndim == 4 else eeg
+                groups[group_key] = {"eeg": band_eeg[label_ids], "list_electrodes": list_electrodes,
+                                     "window": cell["window"], "word_rdms": {},
+                                     "confound_rdms": get_confound_rdms(confounds_config, dataname,
+                                                                        np.asarray(dataset.words)[label_ids])}
+            groups[group_key]["word_rdms"][cell["table_path"]] = word_rdms[rdm_key]
+
+    print(f"\n{len(cells)} grid points, {len(status)} tables already computed,"
+          f" {sum(len(group['word_rdms']) for group in groups.values())} tables in {len(groups)} jobs")
+
+    tab_attrs = get_tab_attrs(config)
+    with ProcessPoolExecutor(max_workers=config.num_workers) as executor:
+        futures = {executor.submit(_run_job, group["eeg"], group["list_electrodes"], group["window"],
+                                   group["word_rdms"], tab_attrs, group["confound_rdms"]): group_key
+                   for group_key, group in groups.items()}
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Sweep jobs"):
+            group_key = futures[future]
+            try:
+                tables, seconds = future.result()
+                for table_path, table in tables.items():
+                    save_table(table, table_path)
+                    status[table_path] = {"state": "done", "job": list(group_key), "seconds": round(seconds, 1)}
+            except Exception as e:
+                for table_path in groups[group_key]["word_rdms"]:
+                    status[table_path] = {"state": "failed", "job": list(group_key), "error": repr(e)}
+            _save_status(config.save_folder, status)
+
+    states = pd.Series([cell_status["state"] for cell_status in status.values()]).value_counts()
+    for table_path, cell_status in status.items():
+        if cell_status["state"] == "failed":
+            print(f"\033[91m FAILED {table_path}: {cell_status['error']} \033[0m")
+    print(f"\033[96m Sweep done: {states.to_dict()} (status in {os.path.join(config.save_folder, STATUS_NAME)})"
+          f" \033[0m")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+import os
+
+import hydra
+import matplotlib
+import numpy as np
+
+from src.analysis import compute_temporal_generalization
+from src.dataset import get_dataset
+from src.sweep import build_label_table, get_band_names, select_label_ids
+
+
+def build_result_name(norm: str, label: str, window: dict, band: str) -> str:
+    name = f"tg_{norm}_{label}_t{window['timesteps']}_p{window['pad_step']}"
+    return name if band is None else f"{name}_{band}"
+
+
+def save_figures(generalization: dict, list_electrodes: list, times: list, time_label: str, name: str,
+                 dest_folder: str, channel_figures: bool = True, dpi: int = 100):
+    from src.vis import plot_temporal_generalization
+
+    os.makedirs(dest_folder, exist_ok=True)
+    methods = ["pearson", "spearman"]
+    plot_temporal_generalization(np.stack([np.nanmean(generalization[method], axis=0) for method in methods]),
+                                 times, titles=[f"{method} (mean over channels)" for method in methods],
+                                 time_label=time_label, suptitle=name, dpi=dpi,
+                                 savepath=os.path.join(dest_folder, f"{name}.png"))
+    if channel_figures:
+        for method in methods:
+            plot_temporal_generalization(generalization[method], times, titles=list_electrodes,
+                                         time_label=time_label, suptitle=f"{method} {name}", dpi=dpi,
+                                         savepath=os.path.join(dest_folder, f"{method}_{name}_channels.png"))
+
+
+@hydra.main(config_path='../configs', config_name='temporal_generalization')
+def main(config):
+    matplotlib.use("Agg")
+    tg_config = config.temporal_generalization
+    dtype = np.float32 if tg_config.float32 else np.float64
+
+    for dataname in config.grid.datasets:
+        data_config = config.datasets[dataname].copy()
+        data_config.labels = None
+        dataset = get_dataset(data_config, None, dataname)
+        list_electrodes = list(dataset.channels["#NAME"])
+        label_table = build_label_table(dataset, dataname)
+        sfreq = data_config.get("sfreq", None)
+
+        for label in config.grid.labels[dataname]:
+            label_ids = select_label_ids(label_table, label)
+            result_folder = os.path.join(config.save_folder, dataname, label, "npz")
+            os.makedirs(result_folder, exist_ok=True)
+            for band_id, band in enumerate(get_band_names(data_config)):
+                eeg = dataset.eeg[:, band_id] if dataset.eeg.ndim == 4 else dataset.eeg
+                for window in config.grid.windows:
+                    for norm in tg_config.norms:
+                        name = build_result_name(norm, label, window, band)
+                        result_path = os.path.join(result_folder, f"{name}.npz")
+                        if os.path.isfile(result_path) and not config.overwrite:
+                            continue
+                        print(f"Temporal generalization {dataname} {name} ({len(label_ids)} words)")
+                        generalization = compute_temporal_generalization(eeg[label_ids],
+                                                                         timesteps=window.timesteps,
+                                                                         pad_step=window.pad_step,
+                                                                         norm=norm,
+                                                                         dtype=dtype)
+                        np.savez(result_path, channels=np.array(list_electrodes), **generalization)
+
+                        if tg_config.figures:
+                            starts = np.array(generalization["starts"])
+                            times = starts if sfreq is None else starts * 1000 / sfreq
+                            time_label = "Window start (samples)" if sfreq is None else "Window start (ms)"
+                            save_figures(generalization, list_electrodes, list(times), time_label, name,
+                                         os.path.join(config.save_folder, dataname, label, "image"),
+                                         channel_figures=tg_config.channel_figures, dpi=config.vis.dpi)
+    print("Temporal generalization computed !")
+
+
+if __name__ == '__main__':
+    main()
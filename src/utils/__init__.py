@@ -1 +1,3 @@
-from .utils import *
\ No newline at end of file
+from .utils import *
+from .profiling import Profiler, enable_profiling, disable_profiling, stage
+from .streaming import prefetch, BackgroundWriter
@@ -0,0 +1,120 @@
+import os
+import json
+import resource
+import threading
+import time
+import tracemalloc
+from typing import Optional
+
+# Active profiler (None: profiling disabled, stage() returns a shared no-op context manager)
+_PROFILER = None
+
+
+class _NullStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage:
+    def __init__(self, profiler: "Profiler", name: str):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.profiler._enter(self.name)
+        return self
+
+    def __exit__(self, *args):
+        self.profiler._exit()
+        return False
+
+
+class Profiler:
+    """
+    Aggregates the wall time (total and self), the tracemalloc peak and the peak RSS of nested stages.
+    Stages are identified by their path (e.g. "main;compute_correlations;eeg_distances") and aggregated over calls.
+    Stage stacks are per thread, the memory peaks are process-wide.
+    """
+
+    def __init__(self, track_memory: bool = True):
+        self.track_memory = track_memory
+        self.records = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        if track_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def _stack(self) -> list:
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    def _enter(self, name: str):
+        stack = self._stack()
+        if self.track_memory:
+            if len(stack) > 0:
+                stack[-1]["peak"] = max(stack[-1]["peak"], tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+        path = name if len(stack) == 0 else f"{stack[-1]['path']};{name}"
+        stack.append({"path": path, "start": time.perf_counter(), "children": 0., "peak": 0})
+
+    def _exit(self):
+        stack = self._stack()
+        frame = stack.pop()
+        seconds = time.perf_counter() - frame["start"]
+        peak = max(frame["peak"], tracemalloc.get_traced_memory()[1]) if self.track_memory else 0
+        if len(stack) > 0:
+            stack[-1]["children"] += seconds
+            stack[-1]["peak"] = max(stack[-1]["peak"], peak)
+
+        # ru_maxrss is in kilobytes on Linux
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        with self._lock:
+            record = self.records.setdefault(frame["path"], {"calls": 0, "seconds": 0., "self_seconds": 0.,
+                                                             "tracemalloc_peak_mb": 0., "peak_rss_mb": 0.})
+            record["calls"] += 1
+            record["seconds"] += seconds
+            record["self_seconds"] += seconds - frame["children"]
+            record["tracemalloc_peak_mb"] = max(record["tracemalloc_peak_mb"], peak / 2 ** 20)
+            record["peak_rss_mb"] = max(record["peak_rss_mb"], peak_rss)
+
+    def report(self) -> dict:
+        return {path: {key: round(value, 4) if isinstance(value, float) else value for key, value in record.items()}
+                for path, record in sorted(self.records.items(), key=lambda item: -item[1]["seconds"])}
+
+    def save(self, report_path: str):
+        """ Writes the report as json and as collapsed stacks ({report}.folded, self time in microseconds),
+        readable by flamegraph.pl or speedscope """
+        os.makedirs(os.path.dirname(os.path.abspath(report_path)), exist_ok=True)
+        with open(report_path, "w") as f:
+            json.dump(self.report(), f, indent=2)
+        with open(os.path.splitext(report_path)[0] + ".folded", "w") as f:
+            for path, record in self.records.items():
+                f.write(f"{path} {int(record['self_seconds'] * 1e6)}\n")
+
+
+def enable_profiling(track_memory: bool = True) -> Profiler:
+    global _PROFILER
+    _PROFILER = Profiler(track_memory=track_memory)
+    return _PROFILER
+
+
+def disable_profiling() -> Optional[Profiler]:
+    global _PROFILER
+    profiler, _PROFILER = _PROFILER, None
+    if profiler is not None and profiler.track_memory:
+        tracemalloc.stop()
+    return profiler
+
+
+def stage(name: str):
+    """ Times the enclosed block as a stage of the active profiler (no-op when profiling is disabled) """
+    if _PROFILER is None:
+        return _NULL_STAGE
+    return _Stage(_PROFILER, name)
@@ -0,0 +1,117 @@
+import os
+import queue
+import threading
+from typing import Iterable, Iterator, List
+
+import pandas as pd
+
+# End of stream marker of the queues
+_DONE = object()
+
+
+class _ProducerError:
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+def prefetch(iterable: Iterable, maxsize: int = 2) -> Iterator:
+    """
+    Iterates over iterable in a background thread, at most maxsize items ahead of the consumer: the producer blocks
+    when the queue is full (backpressure), so the memory is bounded. The errors of the producer are raised in the
+    consumer. The producer is stopped if the consumer stops early.
+    """
+    items = queue.Queue(maxsize=maxsize)
+    stop = threading.Event()
+
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+        except BaseException as e:
+            put(_ProducerError(e))
+            return
+        put(_DONE)
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = items.get()
+            if item is _DONE:
+                break
+            if isinstance(item, _ProducerError):
+                raise item.error
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+class BackgroundWriter:
+    """
+    Appends chunks of rows to a table (CorrelationsTable) and to its csv in a background thread, the csv being
+    written incrementally (header then appended chunks) instead of being rewritten after each update.
+    write() blocks when maxsize chunks are waiting (backpressure). The errors of the writer are raised by write()
+    or close().
+    """
+
+    def __init__(self, table, maxsize: int = 4):
+        self.table = table
+        self._chunks = queue.Queue(maxsize=maxsize)
+        self._error = None
+        self._header = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            rows = self._chunks.get()
+            if rows is _DONE:
+                return
+            if self._error is not None:
+                continue
+            try:
+                self._append(rows)
+            except BaseException as e:
+                self._error = e
+
+    def _append(self, rows: List[dict]):
+        chunk = pd.DataFrame(rows, columns=self.table.table.columns)
+        self.table.table = chunk if len(self.table.table) == 0 else pd.concat([self.table.table, chunk],
+                                                                                 ignore_index=True)
+        os.makedirs(os.path.dirname(os.path.abspath(self.table.table_path)), exist_ok=True)
+        chunk.to_csv(self.table.table_path, mode="w" if self._header else "a", header=self._header, index=False)
+        self._header = False
+
+    def write(self, rows: List[dict]):
+        if self._error is not None:
+            raise self._error
+        self._chunks.put(rows)
+
+    def close(self):
+        self._chunks.put(_DONE)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.close()
+        else:
+            # Already failing: stop the writer without masking the error
+            self._chunks.put(_DONE)
+            self._thread.join()
+        return False
@@ -1,3 +1,6 @@
+import hashlib
+import json
+
 import pandas as pd
 import numpy as np
 import mne
@@ -40,6 +43,54 @@ def load_data_from_fif(datapath: str):
     return np.array(list_features)
 
 
+class RunningMoments:
+    """
+    Running mean and variance of a stream of arrays with the same shape (Welford's algorithm),
+    so that only one array needs to be in memory at a time.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = None
+        self._m2 = None
+
+    def update(self, x: np.array):
+        x = np.asarray(x, dtype=np.float64)
+        self.count += 1
+        if self.mean is None:
+            self.mean = x.copy()
+            self._m2 = np.zeros_like(self.mean)
+            return
+        delta = x - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (x - self.mean)
+
+    @property
+    def variance(self) -> np.array:
+        """ Unbiased variance of the arrays seen so far (zeros if a single array was seen) """
+        if self.count < 2:
+            return np.zeros_like(self.mean)
+        return self._m2 / (self.count - 1)
+
+
+def hash_content(*items) -> str:
+    """
+
+    :param items: arrays (hashed with their dtype and shape) or json serializable objects
+    :return: sha1 hex digest of the items
+    """
+    sha = hashlib.sha1()
+    for item in items:
+        if isinstance(item, np.ndarray):
+            item = np.ascontiguousarray(item)
+            sha.update(f"{item.dtype.str}{item.shape}".encode())
+            sha.update(item.tobytes())
+        else:
+            sha.update(json.dumps(item, sort_keys=True, default=str).encode())
+        sha.update(b"|")
+    return sha.hexdigest()
+
+
 def split_into_chunks(input_list: list, chunk_size: int = 10):
     # Using list comprehension to split the list into chunks
     return [input_list[i:i + chunk_size] for i in range(0, len(input_list), chunk_size)]
@@ -1,4 +1,9 @@
-from .topography import plot_2d_topomap
+from .topography import plot_2d_topomap, get_head_outline
+from .interpolation import TopomapInterpolator, get_topomap_interpolator
+from .raster import TopomapRasterizer, tile_frames
+from .temporal import plot_temporal_generalization
+from .figure_cache import FigureCache
 from .visualisation import *
 from .animation import *
-from .vis_utils import build_destination_folder
\ No newline at end of file
+from .vis_utils import build_destination_folder
+from .batch import build_render_specs, render_batch, list_layer_tables, load_layer_correlations, render_layer_figures
@@ -1,58 +1,122 @@
 import os
-import cv2
+from typing import Iterable, Iterator, List, Optional
 
+import imageio
+import numpy as np
+
+
+def _to_rgb(frame: np.array, background: int = 255) -> np.array:
+    """ Composites RGBA frames over a plain background and pads them to even sizes (required by H.264) """
+    frame = np.asarray(frame)
+    if frame.ndim == 2:
+        frame = np.repeat(frame[..., None], 3, axis=-1)
+    if frame.shape[-1] == 4:
+        alpha = frame[..., 3:].astype(np.uint16)
+        frame = ((frame[..., :3] * alpha + background * (255 - alpha)) // 255).astype(np.uint8)
+    pad_h, pad_w = frame.shape[0] % 2, frame.shape[1] % 2
+    if pad_h or pad_w:
+        frame = np.pad(frame, ((0, pad_h), (0, pad_w), (0, 0)), mode="edge")
+    return frame
+
+
+def _merge_identical_frames(frames: Iterable[np.array]) -> Iterator[tuple]:
+    """ Yields (frame, n_repeats) for each run of identical consecutive frames """
+    previous, n_repeats = None, 0
+    for frame in frames:
+        frame = np.asarray(frame)
+        if previous is not None and previous.shape == frame.shape and np.array_equal(previous, frame):
+            n_repeats += 1
+            continue
+        if previous is not None:
+            yield previous, n_repeats
+        previous, n_repeats = frame, 1
+    if previous is not None:
+        yield previous, n_repeats
+
+
+def write_animation(frames: Iterable[np.array], output_path: str, fps: float = 1., quality: int = 7,
+                    skip_duplicates: bool = True) -> str:
+    """
+    Streams frames into a compressed animation, frames are never written as intermediate images.
+
+    :param frames: arrays of shape (height, width, 3 or 4), dtype uint8 (any iterable, e.g. a generator)
+    :param output_path: .mp4 (H.264 through imageio-ffmpeg) or .gif
+    :param fps: number of frames per second
+    :param quality: H.264 quality, from 0 (lowest) to 10 (highest)
+    :param skip_duplicates: merge identical consecutive frames. A gif shows the kept frame longer;
+                            a video (constant frame rate) re-sends the converted frame, encoded as skipped blocks.
+    :return: the path of the animation
+    """
+    extension = os.path.splitext(output_path)[1].lower()
+    runs = _merge_identical_frames(frames) if skip_duplicates else ((np.asarray(frame), 1) for frame in frames)
+
+    if extension == ".gif":
+        # Durations are only known once the runs are complete: unique frames are kept until the end
+        unique_frames, durations = [], []
+        for frame, n_repeats in runs:
+            unique_frames.append(frame)
+            durations.append(n_repeats / fps)
+        imageio.mimwrite(output_path, unique_frames, format="GIF-PIL", duration=durations, subrectangles=True)
+    elif extension in [".mp4", ".mkv", ".avi"]:
+        with imageio.get_writer(output_path, format="FFMPEG", mode="I", fps=fps, codec="libx264", quality=quality,
+                                pixelformat="yuv420p", macro_block_size=1) as writer:
+            for frame, n_repeats in runs:
+                frame = _to_rgb(frame)
+                for _ in range(n_repeats):
+                    writer.append_data(frame)
+    else:
+        raise ValueError(f"Unsupported animation format {extension}")
+    return output_path
 
-# Video Generating function
-def create_valid_gif(save_path: str, model_name: str = "bert", labels: str = "", over_layers: bool = True) -> str:
-    image_folder = save_path  # make sure to use your folder
-    video_name = image_folder + f'/{model_name}_{labels}_topo_over_layers.avi' if over_layers \
-        else image_folder + f'/{model_name}_topography.avi'
 
-    os.chdir(save_path)
+def rasterized_frames(rasterizer, values: np.array, batch_size: int = 64) -> Iterator[np.array]:
+    """
 
+    :param rasterizer: TopomapRasterizer of the montage
+    :param values: electrode values of shape (n_frames, n_electrodes)
+    :return: generator of the RGBA frames, rendered by batches
+    """
+    for start in range(0, len(values), batch_size):
+        yield from rasterizer(values[start:start + batch_size])
+
+
+def read_frames(image_paths: List[str]) -> Iterator[np.array]:
+    for image_path in image_paths:
+        yield imageio.imread(image_path)
+
+
+def list_animation_images(image_folder: str, model_name: str = "bert", labels: str = "",
+                          over_layers: bool = True) -> List[str]:
+    """
+
+    :return: the paths of the topomaps of the model, ordered by time window (over_layers) or by layer
+    """
     if over_layers:
         images = [img for img in os.listdir(image_folder)
-                  if model_name in img and
-                  img.endswith("ms.png")]
-        reordered_images = [(int(img.split(f" ")[0].split("_")[-1]), img) for img in images]
-        reordered_images.sort()
+                  if model_name in img and labels in img and img.endswith("ms.png")]
+        reordered_images = [(int(img.split(" ")[0].split("_")[-1]), img) for img in images]
     else:
         images = [img for img in os.listdir(image_folder)
-                  if model_name in img and "layer" in img and
-                  img.endswith("png")]
-        reordered_images = [(int(img.split(f"layer_")[1].split("_")[0]), img) for img in images]
-        reordered_images.sort()
-    print(images)
-
-    images = [elt[1] for elt in reordered_images]
-    # Array images should only consider
-    # the image files ignoring others if any
-    print(images)
-
-    frame = cv2.imread(os.path.join(image_folder, images[0]))
-
-    # setting the frame width, height width
-    # the width, height of first image
-    height, width, layers = frame.shape
-    print(height, width)
-
-    video = cv2.VideoWriter(video_name, 0, 1, (width, height))
-
-    # Appending the images to the video one by one
-    for i, image in enumerate(images):
-        img = cv2.imread(os.path.join(image_folder, image))
-        BLACK = (255, 0, 255)
-        font = cv2.FONT_HERSHEY_SIMPLEX
-        font_size = 1.1
-        font_color = BLACK
-        font_thickness = 2
-        text = ''
-        x, y = 10, 650
-        img_text = cv2.putText(img, text, (x, y), font, font_size, font_color, font_thickness, cv2.LINE_AA)
-
-        video.write(img_text)
-
-    # Deallocating memories taken for window creation
-    cv2.destroyAllWindows()
-    video.release()  # releasing the video generated
-    return video_name
+                  if model_name in img and labels in img and "layer" in img and img.endswith("png")]
+        reordered_images = [(int(img.split("layer_")[1].split("_")[0]), img) for img in images]
+    reordered_images.sort()
+    return [os.path.join(image_folder, elt[1]) for elt in reordered_images]
+
+
+# Video Generating function
+def create_valid_gif(save_path: str, model_name: str = "bert", labels: str = "", over_layers: bool = True,
+                     extension: str = "mp4", fps: float = 1., output_path: Optional[str] = None) -> str:
+    """
+
+    :param save_path: folder containing the topomaps
+    :param extension: mp4 or gif
+    :return: the path of the animation, written in save_path unless output_path is given
+    """
+    if output_path is None:
+        video_name = f"{model_name}_{labels}_topo_over_layers" if over_layers else f"{model_name}_topography"
+        output_path = os.path.join(save_path, f"{video_name}.{extension}")
+
+    images = list_animation_images(save_path, model_name, labels, over_layers=over_layers)
+    if len(images) == 0:
+        raise FileNotFoundError(f"No {model_name} topomaps found in {save_path}")
+    return write_animation(read_frames(images), output_path, fps=fps)
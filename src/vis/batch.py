@@ -0,0 +1,247 @@
+import os
+import json
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from itertools import product
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from tqdm import tqdm
+
+from src.evaluation import CorrelationsTable
+from src.utils import extract_correlations_and_periods, split_into_chunks
+from src.vis.figure_cache import FigureCache
+from src.vis.vis_utils import build_destination_folder
+
+# Montage shared by the figures rendered in a worker process (see _init_render_worker)
+_WORKER_MONTAGE = {}
+
+
+def list_layer_tables(corr_save_folder: str, modelname: str) -> List[str]:
+    """
+
+    :param corr_save_folder: folder containing the correlations tables
+    :param modelname: short name of the language model
+    :return: the names of the tables computed on each layer of the model, ordered by layer
+    """
+    list_corr_names = [filename for filename in os.listdir(corr_save_folder)
+                       if modelname in filename and "random" not in filename and "layer" in filename]
+    reordered_list_corr_names = [(int(name.split("layer_")[1].split("_")[0]), name) for name in list_corr_names]
+    reordered_list_corr_names.sort()
+    return [elt[1] for elt in reordered_list_corr_names]
+
+
+def load_layer_correlations(corr_save_folder: str,
+                            list_corr_names: List[str],
+                            tab_attrs: List[str],
+                            distance: str) -> Tuple[Dict[str, np.array], List[str], str]:
+    """
+
+    :return: - the correlations {"pearson": array, "spearman": array} of shape (n_windows, n_layers, n_channels)
+             - the titles of the time windows
+             - the path of the last table (used to build the destination folder)
+    """
+    list_corr_tabs = [CorrelationsTable(name=tab_name,
+                                        table_folder=corr_save_folder,
+                                        table_columns=tab_attrs,
+                                        eval=True) for tab_name in list_corr_names]
+
+    # Re-order the table by time-wise
+    list_results_grouped_tabs = [corr.extract_sub_table(attribute="distance", value=distance,
+                                                        groupby_key="truncate_start") for corr in list_corr_tabs]
+
+    # Extract the correlations
+    pears_corr_values, spear_corr_values = [], []
+    window_titles = []
+    for layer_id in range(len(list_results_grouped_tabs)):
+        pears_corr_val, spear_corr_val, sub_title = extract_correlations_and_periods(
+            list_results_grouped_tabs[layer_id])
+        pears_corr_values.append(pears_corr_val)
+        spear_corr_values.append(spear_corr_val)
+        if layer_id == 0:
+            window_titles.extend(sub_title)
+
+    # Permute the time window and the layers
+    corr_values = {"pearson": np.transpose(pears_corr_values, (1, 0, 2)),
+                   "spearman": np.transpose(spear_corr_values, (1, 0, 2))}
+    return corr_values, window_titles, list_corr_tabs[-1].table_path
+
+
+def render_layer_figures(electrodes_pos: np.array,
+                         list_electrodes: List[str],
+                         corr_values: np.array,
+                         window_titles: List[str],
+                         modelname: str,
+                         dataname: str,
+                         vis_config: dict,
+                         dest_folder: str,
+                         file_prefix: str,
+                         interpolator=None,
+                         cache: Optional[FigureCache] = None,
+                         value_range: Optional[Tuple[float, float]] = None) -> List[str]:
+    """
+
+    :param corr_values: correlations of shape (n_windows, n_layers, n_channels)
+    :param file_prefix: figures are saved as {dest_folder}/{file_prefix}_{window_title}.png
+    :param value_range: (vmin, vmax) of the color scale, the default one of plot_2d_topomap if None
+    :param cache: if given, figures whose content key did not change are not re-rendered
+                  (the new keys are recorded in the cache, the caller saves it)
+    :return: the paths of the figures (one per time window, the layers being laid out on a grid)
+    """
+    from src.vis.topography import plot_2d_topomap
+
+    sub_titles = split_into_chunks([f"{modelname}_layer_{layer_id}" for layer_id in range(corr_values.shape[1])],
+                                   vis_config["chunk_size"])
+    n_rows, n_cols = len(sub_titles), len(sub_titles[0])
+
+    list_paths = []
+    for window_id, window_title in enumerate(window_titles):
+        savepath = os.path.join(dest_folder, f"{file_prefix}_{window_title}.png")
+        list_paths.append(savepath)
+        if cache is not None:
+            key = cache.key(corr_values[window_id], vis_config, dataname=dataname, title=window_title,
+                            sub_titles=sub_titles, electrodes=electrodes_pos[:, :2].tolist(),
+                            names=list(list_electrodes),
+                            **({} if value_range is None else {"value_range": list(value_range)}))
+            if cache.is_fresh(savepath, key):
+                continue
+        plot_2d_topomap(electrodes_pos[:, :2], split_into_chunks(corr_values[window_id], vis_config["chunk_size"]),
+                        dataname=dataname,
+                        grid_res=vis_config["grid_res"],
+                        rows=n_rows, size=vis_config["size"], cols=n_cols, edgecolor=vis_config["edgecolor"],
+                        subfig_name=sub_titles,
+                        coords_name=list_electrodes, dpi=vis_config["dpi"], title=window_title,
+                        interpolator=interpolator,
+                        savepath=savepath,
+                        **({} if value_range is None else {"vmin": value_range[0], "vmax": value_range[1]}))
+        if cache is not None:
+            cache.record(savepath, key)
+    return list_paths
+
+
+def _init_render_worker(electrodes_pos: np.array, list_electrodes: List[str]):
+    # Headless rendering, the montage is sent once per worker
+    import matplotlib
+    matplotlib.use("Agg")
+    _WORKER_MONTAGE["electrodes_pos"] = electrodes_pos
+    _WORKER_MONTAGE["list_electrodes"] = list_electrodes
+
+
+def _normalize_by_noise_ceiling(corr_values: np.array, spec: dict, config: dict, table_path: str) -> np.array:
+    """
+    Divides the correlations by the noise ceiling of config["noise_ceiling"], after checking that it was computed on
+    the words, windows and band of the tables (ValueError otherwise)
+
+    :param corr_values: correlations of shape (n_windows, n_layers, n_channels)
+    :param table_path: one of the tables of the correlations (they share the same windows)
+    """
+    import pandas as pd
+    from src.analysis.noise_ceiling import check_noise_ceiling, get_noise_ceiling, normalize_by_noise_ceiling
+
+    nc_config = config["noise_ceiling"]
+    windows = pd.read_csv(table_path, usecols=["truncate_start", "truncate_end"]).drop_duplicates()
+    starts = sorted(int(start) for start in windows["truncate_start"])
+    timesteps = int(windows["truncate_end"].iloc[0] - windows["truncate_start"].iloc[0] + 1)
+    pad_step = starts[1] - starts[0] if len(starts) > 1 else timesteps
+    # Word selection of the tables: the label folder, or the POS filter of the dataset of the tables
+    data_labels = config["data"].get("labels") or []
+    label = spec["label"] if config["label_folders"] else data_labels[0] if len(data_labels) == 1 else None
+
+    ceiling_path = nc_config["path"].format(label=spec["label"], band=nc_config.get("band"),
+                                            window=f"t{timesteps}_p{pad_step}")
+    with np.load(ceiling_path) as ceiling:
+        check_noise_ceiling(ceiling, starts, timesteps, band=nc_config.get("band"), label=label,
+                            n_sentences=config["data"].get("n_sentences"))
+        return normalize_by_noise_ceiling(corr_values, get_noise_ceiling(ceiling, spec["distance"], spec["corr"],
+                                                                         nc_config["bound"]))
+
+
+def render_spec(spec: dict, config: dict) -> dict:
+    """
+
+    :param spec: {"label": ..., "model": ..., "distance": ..., "corr": "pearson" or "spearman"}
+    :param config: plain (resolved) render configuration
+    :return: {"files": paths of the figures, "folder": their folder, "keys": keys of the re-rendered figures}
+             (the figure index is only written by the main process)
+    """
+    from src.vis.interpolation import get_topomap_interpolator
+
+    electrodes_pos = _WORKER_MONTAGE["electrodes_pos"]
+    # Either one results folder per label (as in correlations_over_layers.py) or a single one
+    save_folder = os.path.join(config["save_folder"], spec["label"]) if config["label_folders"] \
+        else config["save_folder"]
+    corr_save_folder = os.path.join(save_folder, "csv")
+    list_corr_names = list_layer_tables(corr_save_folder, spec["model"])
+    if len(list_corr_names) == 0:
+        return {"files": [], "folder": None, "keys": {}}
+    corr_values, window_titles, table_path = load_layer_correlations(corr_save_folder, list_corr_names,
+                                                                     config["tab_attrs"], spec["distance"])
+    dest_folder = build_destination_folder(table_path, config["data"]["dataname"], save_folder,
+                                           spec["distance"], spec["corr"])
+    values, value_range = corr_values[spec["corr"]], None
+    file_prefix = f"{spec['corr']}_{spec['model']}_{spec['label']}"
+    noise_ceiling = config.get("noise_ceiling") or {}
+    if noise_ceiling.get("path"):
+        # Normalized correlations: fraction of the explainable correlation (see src/noise_ceiling.py)
+        values = _normalize_by_noise_ceiling(values, spec, config, table_path)
+        file_prefix, value_range = f"nc_{noise_ceiling['bound']}_{file_prefix}", (-1., 1.)
+    cache = FigureCache(dest_folder) if config["use_cache"] else None
+    files = render_layer_figures(electrodes_pos,
+                                _WORKER_MONTAGE["list_electrodes"],
+                                values,
+                                window_titles,
+                                spec["model"],
+                                config["data"]["dataname"],
+                                config["vis"],
+                                dest_folder,
+                                file_prefix=file_prefix,
+                                interpolator=get_topomap_interpolator(electrodes_pos[:, :2],
+                                                                      grid_res=config["vis"]["grid_res"]),
+                                cache=cache,
+                                value_range=value_range)
+    return {"files": files, "folder": dest_folder, "keys": {} if cache is None else cache.new_entries}
+
+
+def build_render_specs(labels: List[str], models: List[str], distances: List[str], corrs: List[str]) -> List[dict]:
+    return [{"label": label, "model": model, "distance": distance, "corr": corr}
+            for label, model, distance, corr in product(labels, models, distances, corrs)]
+
+
+def render_batch(specs: List[dict],
+                 config: dict,
+                 electrodes_pos: np.array,
+                 list_electrodes: List[str],
+                 num_workers: Optional[int] = None,
+                 manifest_path: Optional[str] = None) -> dict:
+    """
+    Renders the figures of all the specs over a pool of processes (Agg backend).
+
+    :return: the manifest {"specs": [{**spec, "files": [...], "rendered": [...], "error": ...}], "files": [...]},
+             also written as json in manifest_path if given
+    """
+    manifest = {"specs": [], "files": []}
+    folder_keys = {}
+    with ProcessPoolExecutor(max_workers=num_workers, initializer=_init_render_worker,
+                             initargs=(electrodes_pos, list_electrodes)) as executor:
+        futures = {executor.submit(render_spec, spec, config): spec for spec in specs}
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Rendering figures"):
+            spec = futures[future]
+            try:
+                result, error = future.result(), None
+            except Exception as e:
+                result, error = {"files": [], "folder": None, "keys": {}}, repr(e)
+            manifest["specs"].append({**spec, "files": result["files"], "rendered": list(result["keys"]),
+                                      "error": error})
+            manifest["files"].extend(result["files"])
+            if len(result["keys"]) > 0:
+                folder_keys.setdefault(result["folder"], {}).update(result["keys"])
+
+    # Several specs may share a folder: the indexes are updated here rather than in the workers
+    for folder, keys in folder_keys.items():
+        cache = FigureCache(folder)
+        cache.update(keys)
+        cache.save()
+
+    if manifest_path is not None:
+        with open(manifest_path, "w") as f:
+            json.dump(manifest, f, indent=2)
+    return manifest
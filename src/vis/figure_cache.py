@@ -0,0 +1,56 @@
+import os
+import json
+from typing import Dict
+
+import numpy as np
+
+from src.utils import hash_content
+
+# Bump when the rendering of the figures changes (layout, colors...) to invalidate the cached figures
+RENDERER_VERSION = 1
+INDEX_NAME = "figure_index.json"
+
+
+class FigureCache:
+    """
+    Index {figure file name: content key} stored as figure_index.json next to the figures of a folder.
+    A figure is re-rendered only if its file is missing or if its key (values, vis config, renderer version)
+    changed since it was written.
+    """
+
+    def __init__(self, folder: str):
+        self.folder = folder
+        self.index_path = os.path.join(folder, INDEX_NAME)
+        self.index = {}
+        if os.path.isfile(self.index_path):
+            with open(self.index_path, "r") as f:
+                self.index = json.load(f)
+        self.new_entries = {}
+
+    @staticmethod
+    def key(values: np.array, vis_config: dict, **extra) -> str:
+        """
+
+        :param values: values plotted on the figure
+        :param vis_config: visualisation config (grid_res, dpi, chunk_size...)
+        :param extra: anything else changing the figure (titles, electrodes, dataset...)
+        """
+        return hash_content(np.asarray(values), dict(vis_config), extra, RENDERER_VERSION)
+
+    def is_fresh(self, figure_path: str, key: str) -> bool:
+        name = os.path.basename(figure_path)
+        return self.index.get(name) == key and os.path.isfile(figure_path)
+
+    def record(self, figure_path: str, key: str):
+        name = os.path.basename(figure_path)
+        self.index[name] = key
+        self.new_entries[name] = key
+
+    def update(self, entries: Dict[str, str]):
+        self.index.update(entries)
+
+    def save(self):
+        # Atomic write: a partially written index would invalidate every figure
+        with open(self.index_path + ".tmp", "w") as f:
+            json.dump(self.index, f, indent=1, sort_keys=True)
+        os.replace(self.index_path + ".tmp", self.index_path)
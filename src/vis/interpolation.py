@@ -0,0 +1,66 @@
+import numpy as np
+from scipy import sparse
+from scipy.interpolate import CloughTocher2DInterpolator, LinearNDInterpolator
+from scipy.spatial import Delaunay
+
+_INTERPOLATORS = {}
+
+
+class TopomapInterpolator:
+    """
+    Interpolates electrode values on the regular grid of a topomap.
+
+    The interpolation (piecewise linear or Clough-Tocher) is linear in the electrode values, so it is
+    computed once per montage and grid resolution as a sparse matrix of shape (grid_res ** 2, n_electrodes):
+    the Delaunay triangulation and the interpolation setup are not recomputed for each map, and any number
+    of value vectors (layers x windows) is turned into grids with a single sparse matrix product.
+    Grid points outside the convex hull of the electrodes are NaN, as with scipy.interpolate.griddata.
+    """
+
+    def __init__(self, coords: np.array, grid_res: int = 100, margin: float = 0.01, method: str = "cubic",
+                 tol: float = 1e-10):
+        self.coords = np.asarray(coords, dtype=float)[:, :2]
+        self.grid_res = grid_res
+        self.n_electrodes = len(self.coords)
+
+        grid_axis = np.linspace(self.coords.min() - margin, self.coords.max() + margin, grid_res)
+        self.grid_x, self.grid_y = np.meshgrid(grid_axis, grid_axis)
+        points = np.column_stack([self.grid_x.ravel(), self.grid_y.ravel()])
+
+        # Interpolate the canonical basis: column k holds the weights of electrode k on the grid
+        triangulation = Delaunay(self.coords)
+        basis = np.eye(self.n_electrodes)
+        if method == "cubic":
+            interpolator = CloughTocher2DInterpolator(triangulation, basis)
+        elif method == "linear":
+            interpolator = LinearNDInterpolator(triangulation, basis)
+        else:
+            raise ValueError(f"Unknown interpolation method {method}")
+        weights = interpolator(points)
+
+        self.outside = np.isnan(weights).any(axis=1)
+        weights[self.outside] = 0.
+        weights[np.abs(weights) < tol] = 0.
+        self.weights = sparse.csr_matrix(weights)
+
+    def __call__(self, values: np.array) -> np.array:
+        """
+
+        :param values: array of shape (..., n_electrodes)
+        :return: the interpolated grids, of shape (..., grid_res, grid_res)
+        """
+        values = np.asarray(values, dtype=float)
+        flat_values = values.reshape(-1, self.n_electrodes)
+        grids = np.asarray(self.weights @ flat_values.T).T
+        grids[:, self.outside] = np.nan
+        return grids.reshape(*values.shape[:-1], self.grid_res, self.grid_res)
+
+
+def get_topomap_interpolator(coords: np.array, grid_res: int = 100, margin: float = 0.01,
+                             method: str = "cubic") -> TopomapInterpolator:
+    """ Returns the interpolator of the given montage and grid (built only once per process) """
+    coords = np.ascontiguousarray(coords, dtype=float)[:, :2]
+    key = (coords.tobytes(), coords.shape, grid_res, margin, method)
+    if key not in _INTERPOLATORS:
+        _INTERPOLATORS[key] = TopomapInterpolator(coords, grid_res=grid_res, margin=margin, method=method)
+    return _INTERPOLATORS[key]
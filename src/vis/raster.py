@@ -0,0 +1,179 @@
+from typing import Optional, Sequence, Tuple
+
+import matplotlib.pyplot as plt
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from matplotlib.patches import PathPatch
+
+from src.vis.interpolation import TopomapInterpolator, get_topomap_interpolator
+from src.vis.topography import get_head_outline
+
+
+class TopomapRasterizer:
+    """
+    Renders topomaps directly as uint8 RGBA images, without building a matplotlib figure per map.
+
+    Everything that does not depend on the values is prepared once per montage:
+        - the interpolation weights (TopomapInterpolator)
+        - the colormap lookup table (n_colors entries + one transparent entry for the pixels outside the head)
+        - the head mask, and the head outline / electrode edges pre-rendered (with Agg) as an RGBA overlay
+        - the pixels covered by each electrode marker
+    A frame is then a sparse matrix product, a LUT lookup and an alpha blend on the overlay pixels only.
+    Images are returned top row first (as written by imageio / PIL).
+    """
+
+    def __init__(self,
+                 coords: np.array,
+                 dataname: str,
+                 grid_res: int = 100,
+                 margin: float = 0.01,
+                 scale: int = 1,
+                 cmap: str = "coolwarm",
+                 vmin: float = -0.5,
+                 vmax: float = 0.5,
+                 n_colors: int = 256,
+                 background: Tuple[int, int, int, int] = (255, 255, 255, 0),
+                 edgecolor: str = "navy",
+                 linewidth: float = 1.,
+                 marker_radius: int = 2,
+                 marker_edgecolor: Optional[str] = "grey",
+                 interpolator: TopomapInterpolator = None):
+        """
+
+        :param coords: 2D coordinates of the electrodes
+        :param dataname: name of the dataset (kiloword or ubira), used to draw the head
+        :param scale: integer upsampling factor of the interpolation grid (images are grid_res * scale pixels wide)
+        :param n_colors: number of entries of the colormap lookup table
+        :param background: RGBA color of the pixels outside the head
+        :param marker_radius: radius (in pixels) of the electrode markers, 0 to hide them
+        """
+        self.coords = np.asarray(coords, dtype=float)[:, :2]
+        self.interpolator = interpolator if interpolator is not None else \
+            get_topomap_interpolator(self.coords, grid_res=grid_res, margin=margin)
+        self.grid_res = self.interpolator.grid_res
+        self.scale = scale
+        self.size = self.grid_res * scale
+        self.vmin, self.vmax = vmin, vmax
+        self.n_colors = n_colors
+
+        # Colormap LUT, the extra last entry is used for the masked pixels
+        lut = np.empty((n_colors + 1, 4), dtype=np.uint8)
+        lut[:n_colors] = np.round(plt.get_cmap(cmap, n_colors)(np.arange(n_colors)) * 255)
+        lut[n_colors] = background
+        self.lut = lut
+
+        # Pixel grid: pixel centers lie on the interpolation grid points
+        grid_axis = self.interpolator.grid_x[0]
+        step = (grid_axis[-1] - grid_axis[0]) / (self.size - 1)
+        self.extent = (grid_axis[0] - step / 2, grid_axis[-1] + step / 2)
+        self._step = step
+
+        outline = get_head_outline(self.coords, dataname)
+        self.inside = self._head_mask(outline[-1])
+        self.marker_pixels, self.marker_electrodes = self._marker_pixels(marker_radius)
+        self.overlay_pixels, self.overlay_rgb, self.overlay_alpha = self._render_overlay(
+            outline, edgecolor, linewidth, marker_radius, marker_edgecolor)
+
+    def _pixel_centers(self) -> Tuple[np.array, np.array]:
+        centers = self.extent[0] + self._step * (np.arange(self.size) + 0.5)
+        # Top row first: y decreases with the row index
+        return np.meshgrid(centers, centers[::-1])
+
+    def _head_mask(self, head_path) -> np.array:
+        pixel_x, pixel_y = self._pixel_centers()
+        inside = head_path.contains_points(np.column_stack([pixel_x.ravel(), pixel_y.ravel()]))
+        return inside.reshape(self.size, self.size)
+
+    def _marker_pixels(self, marker_radius: int) -> Tuple[np.array, np.array]:
+        """ Flat indices of the pixels covered by the electrode markers, and the electrode of each pixel """
+        if marker_radius <= 0:
+            return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp)
+        cols = np.round((self.coords[:, 0] - self.extent[0]) / self._step - 0.5).astype(int)
+        rows = np.round((self.extent[1] - self.coords[:, 1]) / self._step - 0.5).astype(int)
+        offsets = np.arange(-marker_radius, marker_radius + 1)
+        d_rows, d_cols = np.meshgrid(offsets, offsets, indexing="ij")
+        disk = d_rows ** 2 + d_cols ** 2 <= marker_radius ** 2
+        d_rows, d_cols = d_rows[disk], d_cols[disk]
+
+        pixel_rows = (rows[:, None] + d_rows[None]).ravel()
+        pixel_cols = (cols[:, None] + d_cols[None]).ravel()
+        electrodes = np.repeat(np.arange(len(self.coords)), disk.sum())
+        valid = (pixel_rows >= 0) & (pixel_rows < self.size) & (pixel_cols >= 0) & (pixel_cols < self.size)
+        return pixel_rows[valid] * self.size + pixel_cols[valid], electrodes[valid]
+
+    def _render_overlay(self, outline, edgecolor, linewidth, marker_radius, marker_edgecolor):
+        """ Renders the head outline and the marker edges once, returns the non transparent pixels """
+        dpi = 100
+        fig = Figure(figsize=(self.size / dpi, self.size / dpi), dpi=dpi)
+        canvas = FigureCanvasAgg(fig)
+        fig.patch.set_alpha(0.)
+        ax = fig.add_axes([0, 0, 1, 1])
+        ax.set_axis_off()
+        ax.patch.set_alpha(0.)
+        ax.set_xlim(*self.extent)
+        ax.set_ylim(*self.extent)
+        for path in outline:
+            ax.add_patch(PathPatch(path, facecolor="none", edgecolor=edgecolor, linewidth=linewidth))
+        if marker_radius > 0 and marker_edgecolor is not None:
+            # Marker size in points^2 (1 pixel = 72 / dpi points)
+            ax.scatter(self.coords[:, 0], self.coords[:, 1], s=(2 * (marker_radius + 0.5) * 72 / dpi) ** 2,
+                       facecolors="none", edgecolors=marker_edgecolor, linewidths=0.5)
+        canvas.draw()
+        overlay = np.asarray(canvas.buffer_rgba()).reshape(-1, 4)
+
+        pixels = np.nonzero(overlay[:, 3])[0]
+        return pixels, overlay[pixels, :3].astype(np.uint16), overlay[pixels, 3:].astype(np.uint16)
+
+    def color_indices(self, values: np.array) -> np.array:
+        """ Maps values to LUT entries (NaN values are mapped to the background entry) """
+        scaled = (np.asarray(values, dtype=float) - self.vmin) * ((self.n_colors - 1) / (self.vmax - self.vmin))
+        indices = np.full(scaled.shape, self.n_colors, dtype=np.intp)
+        valid = ~np.isnan(scaled)
+        indices[valid] = np.clip(np.rint(scaled[valid]), 0, self.n_colors - 1)
+        return indices
+
+    def __call__(self, values: np.array) -> np.array:
+        """
+
+        :param values: electrode values of shape (..., n_electrodes)
+        :return: RGBA images of shape (..., size, size, 4), dtype uint8
+        """
+        values = np.asarray(values, dtype=float)
+        batch_shape = values.shape[:-1]
+        values = values.reshape(-1, values.shape[-1])
+
+        # Interpolate, flip to top row first and upsample (nearest)
+        indices = self.color_indices(self.interpolator(values))[:, ::-1]
+        if self.scale > 1:
+            indices = indices.repeat(self.scale, axis=1).repeat(self.scale, axis=2)
+        indices[:, ~self.inside] = self.n_colors
+
+        frames = self.lut[indices].reshape(len(values), -1, 4)
+        if len(self.marker_pixels) > 0:
+            frames[:, self.marker_pixels] = self.lut[self.color_indices(values)[:, self.marker_electrodes]]
+
+        # Alpha blend the overlay on the pixels it covers
+        under = frames[:, self.overlay_pixels].astype(np.uint16)
+        under[..., :3] = (under[..., :3] * (255 - self.overlay_alpha) + self.overlay_rgb * self.overlay_alpha) // 255
+        under[..., 3] = np.maximum(under[..., 3], self.overlay_alpha[:, 0])
+        frames[:, self.overlay_pixels] = under
+
+        return frames.reshape(*batch_shape, self.size, self.size, 4)
+
+
+def tile_frames(frames: np.array, cols: int, pad: int = 0, fill: Sequence[int] = (255, 255, 255, 255)) -> np.array:
+    """
+
+    :param frames: images of shape (n_images, height, width, channels)
+    :param cols: number of images per row (the last row is completed with fill)
+    :param pad: number of pixels between the images
+    :return: the single image of shape (rows * (height + pad) - pad, cols * (width + pad) - pad, channels)
+    """
+    n_images, height, width, channels = frames.shape
+    rows = -(-n_images // cols)
+    tiles = np.empty((rows, cols, height + pad, width + pad, channels), dtype=frames.dtype)
+    tiles[...] = np.asarray(fill, dtype=frames.dtype)[:channels]
+    tiles.reshape(rows * cols, height + pad, width + pad, channels)[:n_images, :height, :width] = frames
+    image = tiles.transpose(0, 2, 1, 3, 4).reshape(rows * (height + pad), cols * (width + pad), channels)
+    return image[:image.shape[0] - pad, :image.shape[1] - pad]
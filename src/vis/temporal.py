@@ -0,0 +1,67 @@
+from typing import List, Optional
+
+import matplotlib.pyplot as plt
+import numpy as np
+
+
+def plot_temporal_generalization(matrices: np.array,
+                                 times: List[float],
+                                 titles: Optional[List[str]] = None,
+                                 cols: Optional[int] = None,
+                                 size: float = 3,
+                                 cmap: str = "RdBu_r",
+                                 vmin: Optional[float] = None,
+                                 vmax: Optional[float] = None,
+                                 time_label: str = "Window start",
+                                 suptitle: Optional[str] = None,
+                                 savepath: Optional[str] = None,
+                                 dpi: int = 100):
+    """
+
+    :param matrices: temporal generalization matrices (rows: window t, columns: window t') of shape
+                     (n_windows, n_windows) or (n_maps, n_windows, n_windows), e.g. one per channel
+    :param times: time of each window (start, in samples or ms)
+    :param cols: maps per row (at most 6 by default)
+    :param vmin, vmax: color range, symmetric around 0 and scaled on the off-diagonal values by default
+                       (the diagonal is always 1)
+    :return: the figure (closed when saved)
+    """
+    matrices = np.asarray(matrices)
+    if matrices.ndim == 2:
+        matrices = matrices[None]
+    n_maps, n_windows = len(matrices), matrices.shape[-1]
+    if vmax is None:
+        off_diagonal = matrices[:, ~np.eye(n_windows, dtype=bool)]
+        vmax = float(np.nanmax(np.abs(off_diagonal))) if off_diagonal.size > 0 else 1.
+        vmax = vmax if np.isfinite(vmax) and vmax > 0 else 1.
+    vmin = -vmax if vmin is None else vmin
+
+    cols = cols or min(n_maps, 6)
+    rows = int(np.ceil(n_maps / cols))
+    fig, axs = plt.subplots(rows, cols, figsize=(size * cols + 1, size * rows), squeeze=False)
+
+    # Each window is a cell centered on its time
+    step = times[1] - times[0] if len(times) > 1 else 1
+    extent = [times[0] - step / 2, times[-1] + step / 2, times[0] - step / 2, times[-1] + step / 2]
+    image = None
+    for map_id, ax in enumerate(axs.ravel()):
+        if map_id >= n_maps:
+            ax.axis("off")
+            continue
+        image = ax.imshow(matrices[map_id], origin="lower", extent=extent, cmap=cmap, vmin=vmin, vmax=vmax,
+                          interpolation="nearest", aspect="equal")
+        ax.plot(extent[:2], extent[2:], color="k", linestyle="--", linewidth=0.5)
+        if titles is not None:
+            ax.set_title(titles[map_id])
+        if map_id % cols == 0:
+            ax.set_ylabel(f"{time_label} (t)")
+        if map_id >= n_maps - cols:
+            ax.set_xlabel(f"{time_label} (t')")
+
+    fig.colorbar(image, ax=axs, orientation="vertical", fraction=.05)
+    if suptitle is not None:
+        fig.suptitle(suptitle)
+    if savepath is not None:
+        fig.savefig(savepath, dpi=dpi)
+        plt.close(fig)
+    return fig
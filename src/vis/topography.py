@@ -1,147 +1,67 @@
+from typing import List
+
 import matplotlib.pyplot as plt
 import numpy as np
-from matplotlib.patches import Ellipse, Polygon
-from scipy.interpolate import griddata
-
-
-def _prepare_kiloword_topomap(electrodes, head_radius=0.2, cols=None, rows=None, size=3,  ax=None, **fig_kwargs):
-    left_ear = Ellipse(electrodes[6], height=head_radius / 4, width=head_radius / 8, facecolor="none", **fig_kwargs)
-    right_ear = Ellipse(electrodes[26], height=head_radius / 4, width=head_radius / 8, facecolor="none", **fig_kwargs)
-    nose = Polygon([electrodes[4] + np.array([abs(electrodes[4, 0] - electrodes[15, 0]) / 3, 0.]),
-                    electrodes[15] + np.array([0, 0.02]),
-                    electrodes[24] - np.array([abs(electrodes[4, 0] - electrodes[15, 0]) / 3, 0.])],
-                   facecolor="none", **fig_kwargs)
-    ellipse = Ellipse(electrodes[1], height=head_radius, width=head_radius, facecolor="white", **fig_kwargs)
-
-    if (rows, cols) in [(1, 1), (None, None)]:
-        if ax is None:
-            fig, ax = plt.subplots(figsize=(size * cols, size * rows), **fig_kwargs)
-        ax.add_patch(nose)
-        ax.add_patch(left_ear)
-        ax.add_patch(right_ear)
-        ax.add_patch(ellipse)
-        ax.set_aspect("equal")
-    elif rows == 1 and cols > 1:
-        if ax is None:
-            fig, ax = plt.subplots(rows, cols, figsize=(size * cols, size * rows), **fig_kwargs)
-        for j in range(cols):
-            left_ear = Ellipse(electrodes[6], height=head_radius / 4, width=head_radius / 8, facecolor="none",
-                               **fig_kwargs)
-            right_ear = Ellipse(electrodes[26], height=head_radius / 4, width=head_radius / 8, facecolor="none",
-                                **fig_kwargs)
-            nose = Polygon([electrodes[4] + np.array([abs(electrodes[4, 0] - electrodes[15, 0]) / 3, 0.]),
-                            electrodes[15] + np.array([0, 0.02]),
-                            electrodes[24] - np.array([abs(electrodes[4, 0] - electrodes[15, 0]) / 3, 0.])],
-                           facecolor="none", **fig_kwargs)
-            ellipse = Ellipse(electrodes[1], height=head_radius, width=head_radius, facecolor="white", **fig_kwargs)
-
-            ax[j].add_patch(nose)
-            ax[j].add_patch(left_ear)
-            ax[j].add_patch(right_ear)
-            ax[j].add_patch(ellipse)
-            ax[j].set_aspect("equal")
-    else:
-        if ax is None:
-            fig, ax = plt.subplots(rows, cols, figsize=(size * cols, size * rows), **fig_kwargs)
-        for i in range(rows):
-            for j in range(cols):
-                left_ear = Ellipse(electrodes[6], height=head_radius / 4, width=head_radius / 8, facecolor="none",
-                                   **fig_kwargs)
-                right_ear = Ellipse(electrodes[26], height=head_radius / 4, width=head_radius / 8, facecolor="none",
-                                    **fig_kwargs)
-                nose = Polygon([electrodes[4] + np.array([abs(electrodes[4, 0] - electrodes[15, 0]) / 3, 0.]),
-                                electrodes[15] + np.array([0, 0.02]),
-                                electrodes[24] - np.array([abs(electrodes[4, 0] - electrodes[15, 0]) / 3, 0.])],
-                               facecolor="none", **fig_kwargs)
-                ellipse = Ellipse(electrodes[1], height=head_radius, width=head_radius, facecolor="white", **fig_kwargs)
-
-                ax[i, j].add_patch(nose)
-                ax[i, j].add_patch(left_ear)
-                ax[i, j].add_patch(right_ear)
-                ax[i, j].add_patch(ellipse)
-                ax[i, j].set_aspect("equal")
-    return fig, ax
+from matplotlib.patches import Ellipse, PathPatch, Polygon
+from matplotlib.path import Path
+from src.vis.interpolation import TopomapInterpolator, get_topomap_interpolator
+
+
+# Electrodes ids used to draw the head of each montage
+_HEAD_LAYOUTS = {
+    "kiloword": {"ears": (6, 26), "nose": (4, 15, 24), "center": 1},
+    "ubira": {"ears": (8, 25), "nose": (0, 34, 31), "center": 23},
+}
+_HEAD_OUTLINES = {}
+
+
+def get_head_outline(electrodes: np.array, dataname: str) -> List[Path]:
+    """
+
+    :param electrodes: 2D (or 3D) coordinates of the electrodes
+    :param dataname: name of the dataset (kiloword or ubira)
+    :return: the paths (in data coordinates) of the nose, the ears and the head (last), computed once per montage
+    """
+    electrodes = np.ascontiguousarray(electrodes, dtype=float)[:, :2]
+    key = (dataname, electrodes.tobytes())
+    if key not in _HEAD_OUTLINES:
+        layout = _HEAD_LAYOUTS[dataname]
+        head_radius = np.linalg.norm(electrodes[25] - electrodes[8])
+        left, tip, right = layout["nose"]
+        nose_width = abs(electrodes[left, 0] - electrodes[tip, 0]) / 3
+        patches = [Polygon([electrodes[left] + np.array([nose_width, 0.]),
+                            electrodes[tip] + np.array([0, 0.02]),
+                            electrodes[right] - np.array([nose_width, 0.])]),
+                   *[Ellipse(electrodes[ear], height=head_radius / 4, width=head_radius / 8)
+                     for ear in layout["ears"]],
+                   Ellipse(electrodes[layout["center"]], height=head_radius, width=head_radius)]
+        _HEAD_OUTLINES[key] = [patch.get_patch_transform().transform_path(patch.get_path()) for patch in patches]
+    return _HEAD_OUTLINES[key]
+
+
+def _add_head_outline(ax, outline: List[Path], head_facecolor: str = "none", **fig_kwargs):
+    for path in outline[:-1]:
+        ax.add_patch(PathPatch(path, facecolor="none", **fig_kwargs))
+    ax.add_patch(PathPatch(outline[-1], facecolor=head_facecolor, **fig_kwargs))
+    ax.set_aspect("equal")
 
-def _prepare_ubira_topomap(electrodes, head_radius=0.2, cols=None, rows=None, size=3, axs=None, **fig_kwargs):
 
+def _prepare_topomap(electrodes, dataname, cols=None, rows=None, size=3, axs=None, **fig_kwargs):
+    outline = get_head_outline(electrodes, dataname)
 
-    if (rows, cols) in [(1, 1), (None, None)]:
-        left_ear = Ellipse(electrodes[8], height=head_radius / 4, width=head_radius / 8, facecolor="none", **fig_kwargs)
-        right_ear = Ellipse(electrodes[25], height=head_radius / 4, width=head_radius / 8, facecolor="none",
-                            **fig_kwargs)
-        nose = Polygon([electrodes[0] + np.array([abs(electrodes[0, 0] - electrodes[34, 0]) / 3, 0.]),
-                        electrodes[34] + np.array([0, 0.02]),
-                        electrodes[31] - np.array([abs(electrodes[0, 0] - electrodes[34, 0]) / 3, 0.])],
-                       facecolor="none", **fig_kwargs)
-        col = "white" if axs is None else "none"
-        ellipse = Ellipse(electrodes[23], height=head_radius, width=head_radius, facecolor=col, **fig_kwargs)
-        if axs is None:
-            fig, ax = plt.subplots(figsize=(size * cols, size * rows), **fig_kwargs)
-        else:
-            ax = axs
-        ax.add_patch(nose)
-        ax.add_patch(left_ear)
-        ax.add_patch(right_ear)
-        ax.add_patch(ellipse)
-        ax.set_aspect("equal")
-    elif rows == 1 and cols > 1:
-        if axs is None:
-            fig, ax = plt.subplots(rows, cols, figsize=(size * cols, size * rows), **fig_kwargs)
-        else:
-            ax = axs
-        for j in range(cols):
-            left_ear = Ellipse(electrodes[8], height=head_radius / 4, width=head_radius / 8, facecolor="none",
-                               **fig_kwargs)
-            right_ear = Ellipse(electrodes[25], height=head_radius / 4, width=head_radius / 8, facecolor="none",
-                                **fig_kwargs)
-            nose = Polygon([electrodes[0] + np.array([abs(electrodes[0, 0] - electrodes[34, 0]) / 3, 0.]),
-                            electrodes[34] + np.array([0, 0.02]),
-                            electrodes[31] - np.array([abs(electrodes[0, 0] - electrodes[34, 0]) / 3, 0.])],
-                           facecolor="none", **fig_kwargs)
-            col = "white" if axs is None else "none"
-            ellipse = Ellipse(electrodes[23], height=head_radius, width=head_radius, facecolor=col, **fig_kwargs)
-            ax[j].add_patch(nose)
-            ax[j].add_patch(left_ear)
-            ax[j].add_patch(right_ear)
-            ax[j].add_patch(ellipse)
-            ax[j].set_aspect("equal")
-    else:
-        if axs is None:
-            fig, ax = plt.subplots(rows, cols, figsize=(size * cols, size * rows), **fig_kwargs)
-        else:
-            ax = axs
-        for i in range(rows):
-            for j in range(cols):
-                left_ear = Ellipse(electrodes[8], height=head_radius / 4, width=head_radius / 8, facecolor="none",
-                                   **fig_kwargs)
-                right_ear = Ellipse(electrodes[25], height=head_radius / 4, width=head_radius / 8, facecolor="none",
-                                    **fig_kwargs)
-                nose = Polygon([electrodes[0] + np.array([abs(electrodes[0, 0] - electrodes[34, 0]) / 3, 0.]),
-                                electrodes[34] + np.array([0, 0.05]),
-                                electrodes[31] - np.array([abs(electrodes[0, 0] - electrodes[34, 0]) / 3, 0.])],
-                               facecolor="none", **fig_kwargs)
-                col = "white" if axs is None else "none"
-                ellipse = Ellipse(electrodes[23], height=head_radius, width=head_radius, facecolor=col, **fig_kwargs)
-                if axs is None:
-                    ax[i, j].add_patch(nose)
-                ax[i, j].add_patch(left_ear)
-                ax[i, j].add_patch(right_ear)
-                ax[i, j].add_patch(ellipse)
-                ax[i, j].set_aspect("equal")
+    # Re-draw the outline over existing axes
     if axs is not None:
-        return ax
+        for ax in np.atleast_1d(axs).ravel():
+            _add_head_outline(ax, outline, **fig_kwargs)
+        return axs
+
+    rows, cols = rows or 1, cols or 1
+    fig, ax = plt.subplots(rows, cols, figsize=(size * cols, size * rows), **fig_kwargs)
+    for sub_ax in np.atleast_1d(ax).ravel():
+        _add_head_outline(sub_ax, outline, head_facecolor="white", **fig_kwargs)
     return fig, ax
 
 
-def _prepare_topomap(electrodes, dataname, cols=None, rows=None, size=3, axs=None, **fig_kwargs):
-
-    if dataname == "kiloword":
-        head_radius = np.linalg.norm(electrodes[25, :2] - electrodes[8, :2])
-        return _prepare_kiloword_topomap(electrodes, head_radius, cols, rows, size, axs=axs, **fig_kwargs)
-    elif dataname == "ubira":
-        head_radius = np.linalg.norm(electrodes[25, :2] - electrodes[8, :2])
-        return _prepare_ubira_topomap(electrodes, head_radius, cols, rows, size, axs=axs, **fig_kwargs)
-
 def plot_2d_topomap(coords, values, dataname,
                     grid_res=100, cmap="coolwarm",
                     margin=0.01,
@@ -150,37 +70,42 @@ def plot_2d_topomap(coords, values, dataname,
                     subfig_name=None,
                     savepath=None,
                     dpi=100,
-                    vmin=-0.5,
-                    vmax=0.5,
+                    vmin=None,
+                    vmax=None,
                     title=None,
+                    interpolator: TopomapInterpolator = None,
                     **fig_kwargs):
     plt.rcParams["axes.spines.left"] = False
     plt.rcParams["axes.spines.right"] = False
     plt.rcParams["axes.spines.top"] = False
     plt.rcParams["axes.spines.bottom"] = False
 
-    grid_x, grid_y = np.meshgrid(np.linspace(coords.min() - margin, coords.max() + margin, grid_res),
-                                 np.linspace(coords.min() - margin, coords.max() + margin, grid_res))
+    # Interpolation weights are computed once per montage and grid
+    if interpolator is None:
+        interpolator = get_topomap_interpolator(coords, grid_res=grid_res, margin=margin)
+    grid_x, grid_y = interpolator.grid_x, interpolator.grid_y
 
     fig, ax = _prepare_topomap(coords, dataname, rows=rows, cols=cols, size=size, **fig_kwargs)
     list_contours = []
+    # Default color ranges: +-0.3 for a single row of maps, +-0.5 for the grids
+    row_vmin, row_vmax = -0.3 if vmin is None else vmin, 0.3 if vmax is None else vmax
+    vmin, vmax = -0.5 if vmin is None else vmin, 0.5 if vmax is None else vmax
 
     if (rows, cols) in [(1, 1), (None, None)]:
         print(rows, cols, len(values), len(values[0]), len(grid_x), len(grid_y), len(coords_name), len(subfig_name))
-        grid_z = griddata(coords, values, (grid_x, grid_y), method="cubic")
+        grid_z = interpolator(values)
 
-        contour = ax.contourf(grid_x, grid_y, grid_z, levels=15, cmap=cmap, vmin=-0.3, vmax=0.3)
+        contour = ax.contourf(grid_x, grid_y, grid_z, levels=15, cmap=cmap, vmin=row_vmin, vmax=row_vmax)
         plt.colorbar(contour)
         ax.scatter(coords[:, 0], coords[:, 1], c=values, edgecolors="k", cmap=cmap)
 
     elif rows == 1 and cols > 1:
+        grids_z = interpolator(np.stack(values[:cols]))
         for j in range(cols):
-            grid_z = griddata(coords, values[j], (grid_x, grid_y), method="cubic")
-            grid_x, grid_y = np.meshgrid(np.linspace(coords.min() - margin, coords.max() + margin, grid_res),
-                                         np.linspace(coords.min() - margin, coords.max() + margin, grid_res))
+            grid_z = grids_z[j]
 
-            contour = ax[j].contourf(grid_x, grid_y, grid_z,  levels=np.linspace(-0.3, 0.3, 21),
-                                     cmap=cmap, vmin=-0.3, vmax=0.3)
+            contour = ax[j].contourf(grid_x, grid_y, grid_z,  levels=np.linspace(row_vmin, row_vmax, 21),
+                                     cmap=cmap, vmin=row_vmin, vmax=row_vmax)
             list_contours.append(contour)
             ax[j].scatter(coords[:, 0], coords[:, 1], c=values[j], edgecolors="k", cmap=cmap)
             if coords_name is not None:
@@ -198,14 +123,16 @@ def plot_2d_topomap(coords, values, dataname,
         # fig.colorbar(contour, ax=ax.ravel().tolist())
         # fig.tight_layout()
     else:
+        # Interpolate all the maps at once (the last row may be incomplete)
+        grids_z = interpolator(np.stack([values[i][j] for i in range(rows)
+                                         for j in range(min(cols, len(values[i])))]))
+        grid_id = 0
         for i in range(rows):
             for j in range(cols):
                 if j > len(values[i]) - 1:
                     break
-                grid_x, grid_y = np.meshgrid(np.linspace(coords.min() - margin, coords.max() + margin, grid_res),
-                                             np.linspace(coords.min() - margin, coords.max() + margin, grid_res))
-
-                grid_z = griddata(coords, values[i][j], (grid_x, grid_y), method="cubic")
+                grid_z = grids_z[grid_id]
+                grid_id += 1
                 contour = ax[i, j].contourf(grid_x, grid_y, grid_z,  levels=np.linspace(vmin, vmax, 25),
                                      cmap=cmap, vmin=vmin, vmax=vmax)
                 list_contours.append(contour)
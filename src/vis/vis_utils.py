@@ -12,11 +12,9 @@ def build_destination_folder(table_path: str = "",
 
     if dataset_name not in save_folder:
         save_folder = os.path.join(save_folder, dataset_name)
-        if not os.path.exists(save_folder):
-            os.mkdir(save_folder)
+        os.makedirs(save_folder, exist_ok=True)
 
-    if not os.path.exists(os.path.join(save_folder, "image")):
-        os.mkdir(os.path.join(save_folder, "image"))
+    os.makedirs(os.path.join(save_folder, "image"), exist_ok=True)
 
     dest_file_path = os.path.join(save_folder, "image", corr_type, distance_type)
 
@@ -30,69 +30,112 @@ def group_by_labels(labels: list):
     return result
 
 
+def _sample_ids(ids: np.array, n_max: int, rng: np.random.Generator) -> np.array:
+    if len(ids) <= n_max:
+        return ids
+    return np.sort(rng.choice(ids, n_max, replace=False))
+
+
+def _compact(values: np.array, decimals: int = 3) -> np.array:
+    # float32 rounded coordinates: the figure json is several times smaller
+    return np.round(values.astype(np.float32), decimals)
+
+
 def plot_features(features: np.array,
                   vocab: list,
                   color: list,
+                  large_n_threshold: int = 2000,
+                  max_text_labels: int = 300,
+                  density_threshold: int = 50000,
+                  density_bins: int = 200,
+                  seed: int = 0,
+                  show: bool = True,
                   **fig_kwargs):
+    """
+
+    :param features: 2D or 3D embeddings of shape (n_samples, h)
+    :param vocab: word of each sample
+    :param color: label (POS) of each sample, one trace per label
+    :param large_n_threshold: above this number of samples, points are drawn with WebGL (Scattergl), words are only
+                              shown on hover and as text for a random subset of max_text_labels samples
+    :param density_threshold: above this number of 2D samples, the points are replaced by a 2D histogram
+                              (density_bins x density_bins) computed in numpy, with the labelled subset on top.
+                              3D embeddings are randomly subsampled to density_threshold points instead
+    :return: the plotly figure
+    """
     n_samples, h = features.shape
-    dict_labels = group_by_labels(color)
     assert (h <= 3)
+    dict_labels = {key: np.asarray(ids) for key, ids in group_by_labels(color).items()}
+    vocab = np.asarray(vocab, dtype=object)
+    rng = np.random.default_rng(seed)
+    large_n = n_samples > large_n_threshold
     fig = go.Figure()
-    labels_names = list(dict_labels.keys())
 
-    for j, key in enumerate(dict_labels.keys()):
-        if key in COLORS.keys():
-            color = COLORS[key]
-        ids = dict_labels[key]
-        # Add trace
+    if not large_n:
+        for key, ids in dict_labels.items():
+            key_color = COLORS.get(key)
+            coords = dict(x=features[ids, 0], y=features[ids, 1])
+            if h == 3:
+                coords["z"] = features[ids, 2]
+            scatter = go.Scatter3d if h == 3 else go.Scatter
+            fig.add_trace(scatter(**coords,
+                                  mode="markers+text",
+                                  marker_color=key_color,
+                                  name=key,
+                                  text=vocab[ids].tolist(),
+                                  marker_size=8,
+                                  textposition="bottom center",
+                                  textfont_color=key_color))
+        fig.update(**fig_kwargs)
+        if show:
+            fig.show()
+        return fig
+
+    # Large N: markers without text, words on hover, text only for a (stratified) random subset
+    density = h == 2 and n_samples > density_threshold
+    if density:
+        counts, x_edges, y_edges = np.histogram2d(features[:, 0], features[:, 1], bins=density_bins)
+        fig.add_trace(go.Heatmap(x=_compact((x_edges[:-1] + x_edges[1:]) / 2),
+                                 y=_compact((y_edges[:-1] + y_edges[1:]) / 2),
+                                 z=np.log1p(counts.T).astype(np.float32),
+                                 colorscale="Greys", showscale=False, name="density", hoverinfo="skip"))
+
+    for key, ids in dict_labels.items():
+        key_color = COLORS.get(key)
+        n_text = max(1, int(round(max_text_labels * len(ids) / n_samples)))
+        text_ids = _sample_ids(ids, n_text, rng)
+        if not density:
+            point_ids = ids if h == 2 else _sample_ids(ids, max(1, density_threshold * len(ids) // n_samples), rng)
+            if h == 3:
+                fig.add_trace(go.Scatter3d(x=_compact(features[point_ids, 0]),
+                                           y=_compact(features[point_ids, 1]),
+                                           z=_compact(features[point_ids, 2]),
+                                           mode="markers", marker_color=key_color, marker_size=2,
+                                           name=key, legendgroup=key,
+                                           hovertext=vocab[point_ids].tolist(), hoverinfo="text"))
+            else:
+                fig.add_trace(go.Scattergl(x=_compact(features[point_ids, 0]),
+                                           y=_compact(features[point_ids, 1]),
+                                           mode="markers", marker_color=key_color, marker_size=4,
+                                           name=key, legendgroup=key,
+                                           hovertext=vocab[point_ids].tolist(), hoverinfo="text"))
+
+        coords = dict(x=_compact(features[text_ids, 0]), y=_compact(features[text_ids, 1]))
         if h == 3:
-            fig.add_trace(go.Scatter3d(x=features[ids, 0],
-                                       y=features[ids, 1],
-                                       z=features[ids, 2],
-                                       mode="markers+text",
-                                       marker_color=color,
-                                       name=key,
-                                       text=[vocab[i] for i in ids],
-                                       marker_size=8,
-                                       textposition="bottom center",
-                                       textfont_color=color))
-        else:
-            fig.add_trace(go.Scatter(x=features[ids, 0],
-                                     y=features[ids, 1],
-                                     mode="markers+text",
-                                     marker_color=color,
-                                     name=key,
-                                     text=[vocab[i] for i in ids],
-                                     marker_size=8,
-                                     textposition="bottom center",
-                                     textfont_color=color))
-
-    # if h == 3:
-    #     for i in range(n_samples):
-    #         fig.add_trace(go.Scatter3d(x=[features[i][0]],
-    #                                    y=[features[i][1]],
-    #                                    z=[features[i][2]],
-    #                                    mode="markers+text",
-    #                                    marker_color=COLORS[color[i]],
-    #                                    name=vocab[i],
-    #                                    text=vocab[i],
-    #                                    marker_size=8,
-    #                                    textposition="bottom center",
-    #                                    textfont_color=COLORS[color[i]]))
-    # elif h == 2:
-    #     for i in range(n_samples):
-    #         fig.add_trace(go.Scatter(x=[features[i][0]],
-    #                                    y=[features[i][1]],
-    #                                    mode="markers+text",
-    #                                    marker_color=COLORS[color[i]],
-    #                                    name=vocab[i],
-    #                                    text=vocab[i],
-    #                                    marker_size=8,
-    #                                    textposition="bottom center",
-    #                                    textfont_color=COLORS[color[i]]))
+            coords["z"] = _compact(features[text_ids, 2])
+        text_scatter = go.Scatter3d if h == 3 else go.Scattergl
+        fig.add_trace(text_scatter(**coords,
+                                   mode="markers+text" if density else "text",
+                                   marker_color=key_color,
+                                   text=vocab[text_ids].tolist(),
+                                   textposition="bottom center",
+                                   textfont_color=key_color,
+                                   name=key, legendgroup=key, showlegend=density))
 
     fig.update(**fig_kwargs)
-    fig.show()
+    if show:
+        fig.show()
+    return fig
 
 
 def plot_corr_evolution(time: list, correls: list, color: str, **fig_kwargs):
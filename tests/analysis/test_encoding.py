@@ -0,0 +1,41 @@
+"""
+Checks the SVD ridge of the encoding models against sklearn:
+
+    python -m pytest tests/analysis
+"""
+import numpy as np
+import pytest
+from sklearn.linear_model import RidgeCV
+
+from src.analysis.encoding import _ridge_fold, compute_encoding_scores, get_cv_splits
+
+ALPHAS = np.logspace(-2, 5, 15)
+
+
+def _generate_regression(n_words: int, n_features: int, n_targets: int, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    features = rng.standard_normal((n_words, n_features))
+    # Signals of different strengths, so that different alphas are selected for the targets
+    weights = rng.standard_normal((n_features, n_targets)) * np.logspace(-2, 0, n_targets)
+    targets = features @ weights + rng.standard_normal((n_words, n_targets)) + 3.
+    return features, targets
+
+
+@pytest.mark.parametrize("n_features", [20, 300], ids=["p<n", "p>n"])
+def test_ridge_fold_matches_ridge_cv(n_features):
+    features, targets = _generate_regression(n_words=120, n_features=n_features, n_targets=8)
+    train, test = get_cv_splits(len(features), n_folds=5, seed=0)[0]
+
+    predictions, best = _ridge_fold(features, targets, train, test, ALPHAS, standardize=False)
+    ridge = RidgeCV(alphas=ALPHAS, alpha_per_target=True, gcv_mode="svd").fit(features[train], targets[train])
+    np.testing.assert_allclose(ALPHAS[best], ridge.alpha_)
+    np.testing.assert_allclose(predictions, ridge.predict(features[test]), rtol=1e-6, atol=1e-8)
+
+
+def test_encoding_scores_shapes():
+    features, targets = _generate_regression(n_words=60, n_features=10, n_targets=6)
+    splits = get_cv_splits(len(features), n_folds=3, seed=0)
+    scores = compute_encoding_scores(features, targets.reshape(60, 2, 3), ALPHAS, splits)
+    assert scores["r2"].shape == (2, 3)
+    assert scores["alphas"].shape == (3, 2, 3)
+    assert np.isin(scores["alphas"], ALPHAS).all()
@@ -0,0 +1,11 @@
+import pytest
+
+try:
+    import pytest_benchmark  # noqa: F401 (provides the benchmark fixture)
+except ImportError:
+    from src.benchmarks import Benchmark
+
+    @pytest.fixture
+    def benchmark():
+        """ Single timed round when pytest-benchmark is not installed """
+        return Benchmark(rounds=1, warmup=0)
@@ -0,0 +1,72 @@
+"""
+Runs the benchmark cases under pytest (pytest-benchmark when installed), on tiny sizes by default:
+
+    python -m pytest tests/benchmarks
+    python -m pytest tests/benchmarks --benchmark-only -k window_correlations  # with pytest-benchmark
+"""
+import numpy as np
+import pytest
+
+from src.benchmarks import (
+    CASES,
+    Benchmark,
+    compare_to_baseline,
+    generate_coords,
+    generate_eeg,
+    generate_features,
+    generate_words,
+    run_benchmarks
+)
+
+# Enough words for a few distinct pairs, small enough for a smoke run
+TEST_N_WORDS = 12
+
+
+def _case_params():
+    params = []
+    for name, case in CASES.items():
+        n_words = None if case["n_words"] == [None] else TEST_N_WORDS
+        for dataname in case["datasets"]:
+            params.append(pytest.param(name, n_words, dataname, id=f"{name}-{dataname}"))
+    return params
+
+
+@pytest.mark.parametrize("name,n_words,dataname", _case_params())
+def test_case(benchmark, name, n_words, dataname):
+    CASES[name]["fn"](benchmark, n_words=n_words, dataname=dataname, seed=0)
+
+
+def test_generators_are_seeded():
+    assert generate_words(20, seed=1) == generate_words(20, seed=1)
+    assert len(set(generate_words(20, seed=1))) == 20
+    np.testing.assert_array_equal(generate_features(5, seed=2), generate_features(5, seed=2))
+    assert generate_features(5, n_dims=16).shape == (5, 16)
+    assert generate_eeg(4, "kiloword").shape == (4, 29, 256)
+    assert generate_eeg(4, "ubira", n_bands=2).shape == (4, 2, 64, 276)
+    assert generate_coords(29).shape[0] == 29
+
+
+def test_benchmark_stats():
+    benchmark = Benchmark(rounds=3, warmup=1)
+    assert benchmark(sum, [1, 2, 3]) == 6
+    assert benchmark.stats["rounds"] == 3
+    assert benchmark.stats["min"] <= benchmark.stats["median"] <= benchmark.stats["max"]
+
+
+def test_run_benchmarks_smoke():
+    results = run_benchmarks(CASES, names=["rdm", "dl_distance"], n_words=[TEST_N_WORDS], rounds=1, warmup=0)
+    assert [result["name"] for result in results] == [f"rdm[{TEST_N_WORDS}]", f"dl_distance[{TEST_N_WORDS}]"]
+    assert all(result["stats"] is not None and result["peak_rss_mb"] > 0 for result in results)
+
+
+def test_compare_to_baseline():
+    def result(name, median):
+        return {"name": name, "stats": None if median is None else {"median": median}}
+
+    results = [result("slower", 2.), result("faster", 0.5), result("same", 1.05), result("added", 1.),
+               result("broken", None)]
+    baseline = {name: result(name, 1.) for name in ["slower", "faster", "same", "broken"]}
+    comparison = {row["name"]: row for row in compare_to_baseline(results, baseline, tolerance=0.2)}
+    assert {name: row["status"] for name, row in comparison.items()} == {
+        "slower": "regression", "faster": "improvement", "same": "unchanged", "added": "new", "broken": "failed"}
+    assert comparison["slower"]["ratio"] == pytest.approx(2.)